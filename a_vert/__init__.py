@@ -7,6 +7,8 @@ from a_vert.grouping import get_available_methods as get_available_grouping_meth
 from a_vert.logger import get_logger
 from a_vert import processing
 from a_vert import embedding_tools
+from a_vert import embedding_store
+from a_vert import candidate_scores
 
 __all__ = [
     "setup",
@@ -15,5 +17,7 @@ __all__ = [
     "get_logger",
     "processing",
     "embedding_tools",
+    "embedding_store",
+    "candidate_scores",
     "AvertConfig",
 ]
@@ -0,0 +1,252 @@
+"""
+Sidecar file of per-candidate scores (`AVERT_SCORES_PATH`).
+
+`get_candidate_groups_embedings_ranking` reduces the score of every candidate
+to a distribution over the groups. When a scores file is configured, the raw
+scores are also written to it, one row per candidate, with the group and, if
+given, the enhancement label of the candidate (the `track_labels` of
+`construct_candidate_groups(..., return_references=True)`). Grouping methods,
+thresholds or enhancement ablations can then be evaluated offline, without
+calling the endpoint again (see `iter_candidate_scores`).
+
+The file is Parquet (requires pyarrow), with the columns:
+- `task`, `group`, `label`: dictionary-encoded strings;
+- `sample`: number of the sample within its task, in scoring order;
+- `response_hash`: 64-bit digest of the model response, to join the scores
+  with the sample logs of the harness;
+- `candidate`: position of the candidate in the scored batch;
+- `score`: float32 score of the candidate.
+
+Rows are buffered per task and written as a row group once a task has
+`row_group_rows` of them, so memory stays bounded during long runs. The rest
+is written, and the file completed, when the process exits (or on `close`);
+the file cannot be read before. The A-VERT settings that produced the scores
+are stored in the file metadata.
+"""
+
+import atexit
+import collections
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+from a_vert.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Settings stored in the file metadata
+_METADATA_KEY = b"a_vert"
+
+# Rows written per row group (about 2 MiB in memory)
+_ROW_GROUP_ROWS = 65536
+
+# Writers of the process, one per file
+_WRITERS: dict = {}
+_WRITERS_LOCK = threading.Lock()
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as exc:
+        raise ImportError(
+            "The candidate scores file requires pyarrow, install it with "
+            "`pip install a-vert[parquet]`."
+        ) from exc
+    return pyarrow
+
+
+def _response_hash(text):
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+class CandidateScoreWriter:
+    """Buffers the candidate scores of every task and writes them to the
+    Parquet file `path`, one row group per `row_group_rows` rows of a task
+    (and the rest on `close`). `{pid}` in `path` is replaced by the process
+    id, so that every process of a multi-process run writes its own file.
+    """
+
+    def __init__(self, path, metadata=None, row_group_rows=_ROW_GROUP_ROWS):
+        _import_pyarrow()
+        self.path = path.format(pid=os.getpid())
+        self.metadata = metadata or dict()
+        self.row_group_rows = row_group_rows
+        self._tasks = collections.defaultdict(list)
+        self._rows = collections.Counter()
+        self._samples = collections.Counter()
+        self._lock = threading.Lock()
+        # Row groups are written one at a time, outside of `add`'s lock
+        self._write_lock = threading.Lock()
+        self._writer = None
+        self._finished = False
+        self._written = collections.Counter()
+        self.closed = False
+
+    def add(self, task, model_response, groups, scores, labels=None):
+        """Add the `scores` of the candidates of one sample. `groups` holds
+        the group of every candidate and `labels` their enhancement labels.
+        """
+        if labels is not None and len(labels) != len(scores):
+            raise ValueError(
+                f"Got {len(labels)} candidate labels for {len(scores)} candidates."
+            )
+        response_hash = _response_hash(model_response)
+        scores = np.asarray(scores, dtype=np.float32)
+        with self._lock:
+            if self.closed:
+                raise ValueError(f"The candidate scores file '{self.path}' is closed.")
+            sample = self._samples[task]
+            self._samples[task] += 1
+            self._tasks[task].append((sample, response_hash, groups, labels, scores))
+            self._rows[task] += len(scores)
+            if self._rows[task] < self.row_group_rows:
+                return
+            samples = self._tasks.pop(task)
+            del self._rows[task]
+        self._write_row_group(task, samples)
+
+    def _write_row_group(self, task, samples):
+        pyarrow = _import_pyarrow()
+        table = self._task_table(pyarrow, task, samples)
+        with self._write_lock:
+            if self._finished:
+                raise ValueError(f"The candidate scores file '{self.path}' is closed.")
+            if self._writer is None:
+                schema = table.schema.with_metadata(
+                    {_METADATA_KEY: json.dumps(self.metadata)}
+                )
+                self._writer = pyarrow.parquet.ParquetWriter(self.path, schema)
+            self._writer.write_table(table, row_group_size=len(table))
+            self._written[task] += len(samples)
+
+    def _task_table(self, pyarrow, task, samples):
+        n_rows = sum(len(scores) for *_, scores in samples)
+        groups = list()
+        labels = list()
+        for _, _, sample_groups, sample_labels, scores in samples:
+            groups += sample_groups
+            labels += (
+                sample_labels if sample_labels is not None else [None] * len(scores)
+            )
+        return pyarrow.table(
+            {
+                "task": pyarrow.array([task] * n_rows).dictionary_encode(),
+                "sample": np.repeat(
+                    [s[0] for s in samples], [len(s[4]) for s in samples]
+                ).astype(np.int64),
+                "response_hash": np.repeat(
+                    np.array([s[1] for s in samples], dtype=np.uint64),
+                    [len(s[4]) for s in samples],
+                ),
+                "candidate": np.concatenate(
+                    [np.arange(len(s[4]), dtype=np.int32) for s in samples]
+                ),
+                "group": pyarrow.array(groups, pyarrow.string()).dictionary_encode(),
+                "label": pyarrow.array(labels, pyarrow.string()).dictionary_encode(),
+                "score": np.concatenate([s[4] for s in samples]),
+            }
+        )
+
+    def close(self):
+        """Write the buffered scores, one row group per task, and complete the
+        file.
+        """
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            tasks, self._tasks = self._tasks, dict()
+        try:
+            for task, samples in tasks.items():
+                self._write_row_group(task, samples)
+        finally:
+            with self._write_lock:
+                self._finished = True
+                if self._writer is not None:
+                    self._writer.close()
+        if self._written:
+            logger.info(
+                "Candidate scores written",
+                path=self.path,
+                tasks=len(self._written),
+                samples=sum(self._written.values()),
+            )
+
+
+def close_candidate_score_writers():
+    """Write the scores buffered by every writer of the process now, and
+    complete their files.
+    """
+    for writer in list(_WRITERS.values()):
+        try:
+            writer.close()
+        except Exception as exc:
+            logger.error(
+                "Failed to write the candidate scores", path=writer.path, error=exc
+            )
+
+
+def get_candidate_score_writer(path, metadata=None):
+    """Return the writer of the scores file `path`, created on first use and
+    closed when the process exits. `metadata` can also be a function
+    returning it, only called when the writer is created.
+    """
+    writer = _WRITERS.get(path)
+    if writer is None:
+        with _WRITERS_LOCK:
+            writer = _WRITERS.get(path)
+            if writer is None:
+                if not _WRITERS:
+                    atexit.register(close_candidate_score_writers)
+                if callable(metadata):
+                    metadata = metadata()
+                writer = CandidateScoreWriter(path, metadata)
+                _WRITERS[path] = writer
+    return writer
+
+
+def iter_candidate_scores(path):
+    """Yield the samples of a scores file as dicts with their `task`,
+    `sample`, `response_hash`, and the `scores` and `labels` of every group
+    (dicts of group name to a float32 array and a list of labels), in the
+    order of the candidates. Use it to recompute the group distributions,
+    e.g. with another grouping method (see `a_vert.grouping`).
+    """
+    pyarrow = _import_pyarrow()
+    parquet_file = pyarrow.parquet.ParquetFile(path)
+    for row_group in range(parquet_file.num_row_groups):
+        table = parquet_file.read_row_group(row_group).to_pydict()
+        # Rows of a sample are contiguous
+        start = 0
+        n_rows = len(table["sample"])
+        while start < n_rows:
+            end = start
+            while end < n_rows and table["sample"][end] == table["sample"][start]:
+                end += 1
+            scores = dict()
+            labels = dict()
+            for idx in range(start, end):
+                group = table["group"][idx]
+                scores.setdefault(group, list()).append(table["score"][idx])
+                labels.setdefault(group, list()).append(table["label"][idx])
+            yield dict(
+                task=table["task"][start],
+                sample=table["sample"][start],
+                response_hash=table["response_hash"][start],
+                scores={g: np.array(s, dtype=np.float32) for g, s in scores.items()},
+                labels=labels,
+            )
+            start = end
+
+
+def read_candidate_scores_metadata(path):
+    """Return the A-VERT settings stored in a scores file."""
+    pyarrow = _import_pyarrow()
+    metadata = pyarrow.parquet.read_schema(path).metadata or dict()
+    return json.loads(metadata.get(_METADATA_KEY, b"{}"))
@@ -0,0 +1,204 @@
+"""
+Command line interface (`a-vert`).
+
+Subcommands:
+- `rescore`: score lm-eval sample logs again (see `a_vert.rescore`);
+- `score`: score JSON lines from stdin to stdout (see `a_vert.stream`);
+- `serve`: run a local scoring service (see `a_vert.server`).
+
+The A-VERT configuration comes from the `AVERT_*` environment variables.
+"""
+
+import argparse
+import os
+import sys
+
+
+def _rescore(args):
+    from a_vert import rescore
+
+    scored = rescore.rescore(
+        args.samples_files,
+        args.utils,
+        args.output,
+        output_format=args.format,
+        concurrency=args.concurrency,
+        chunk_size=args.chunk_size,
+        retry_errors=args.retry_errors,
+    )
+    print(f"Scored {scored} samples into {args.output}", file=sys.stderr)
+
+
+def _score(args):
+    import a_vert
+    from a_vert import stream
+
+    if args.resume and args.output is None:
+        sys.exit("--resume requires --output")
+    config = a_vert.setup(instruction_map=dict())
+    skip = None
+    if args.output is None:
+        output = sys.stdout
+    elif args.resume:
+        output, skip = stream.resume_output(args.output, args.retry_errors)
+    else:
+        output = open(args.output, "w")
+    try:
+        stream.score_stream(
+            args.input,
+            output,
+            config,
+            concurrency=args.concurrency,
+            ordered=args.ordered,
+            max_pending=args.max_pending,
+            skip=skip,
+        )
+    except BrokenPipeError:
+        # The output was closed (e.g. piped to `head`), silence the final flush
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+def _serve(args):
+    import a_vert
+    from a_vert import server
+
+    scoring_server = server.ScoringServer(
+        a_vert.setup(instruction_map=dict()),
+        host=args.host,
+        port=args.port,
+        max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait_ms / 1000,
+        workers=args.workers,
+        cache_size=args.cache_size,
+    )
+    try:
+        scoring_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="a-vert", description="A-VERT scoring tools.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    rescore_parser = subparsers.add_parser(
+        "rescore",
+        help="Score lm-eval sample logs again.",
+        description="Score the responses of lm-eval sample logs "
+        "(samples_*.jsonl) again with the process_results function of their "
+        "task, writing the metrics to a directory of part files. Interrupted "
+        "runs resume from the checkpoint of the output directory.",
+    )
+    rescore_parser.add_argument(
+        "samples_files", nargs="+", help="lm-eval samples_*.jsonl files"
+    )
+    rescore_parser.add_argument(
+        "--utils",
+        required=True,
+        help="utils.py of the task (defines process_results), e.g. "
+        "lm-eval_tasks/mmlu_chat/chat_zero-shot_a-vert/utils.py",
+    )
+    rescore_parser.add_argument("--output", required=True, help="Output directory")
+    rescore_parser.add_argument(
+        "--format",
+        choices=("parquet", "jsonl"),
+        default="parquet",
+        help="Format of the part files (parquet needs pyarrow)",
+    )
+    rescore_parser.add_argument(
+        "--concurrency", type=int, default=16, help="Samples scored at the same time"
+    )
+    rescore_parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=1000,
+        help="Samples per part file (and checkpoint)",
+    )
+    rescore_parser.add_argument(
+        "--retry-errors",
+        action="store_true",
+        help="Score again the samples that failed in a previous run",
+    )
+    rescore_parser.set_defaults(func=_rescore)
+
+    score_parser = subparsers.add_parser(
+        "score",
+        help="Score JSON lines from stdin to stdout.",
+        description="Score JSON lines with a response and its correct and wrong "
+        "answers (see a_vert.stream for the fields) and write the group "
+        "distribution of every line as it completes.",
+    )
+    score_parser.add_argument(
+        "--input",
+        type=argparse.FileType("r"),
+        default=sys.stdin,
+        help="Input file (stdin by default)",
+    )
+    score_parser.add_argument(
+        "--output", default=None, help="Output file (stdout by default)"
+    )
+    score_parser.add_argument(
+        "--concurrency", type=int, default=16, help="Lines scored at the same time"
+    )
+    score_parser.add_argument(
+        "--ordered", action="store_true", help="Write the results in input order"
+    )
+    score_parser.add_argument(
+        "--max-pending",
+        type=int,
+        default=None,
+        help="Lines read but not written yet (4 x concurrency by default)",
+    )
+    score_parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Append to --output, skipping the input lines already in it",
+    )
+    score_parser.add_argument(
+        "--retry-errors",
+        action="store_true",
+        help="With --resume, score again the lines that failed",
+    )
+    score_parser.set_defaults(func=_score)
+
+    serve_parser = subparsers.add_parser(
+        "serve",
+        help="Run a local scoring service.",
+        description="Serve /score and /score_batch over HTTP, batching the "
+        "records of all the clients (see a_vert.server).",
+    )
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8765)
+    serve_parser.add_argument(
+        "--max-batch-size", type=int, default=64, help="Records scored together"
+    )
+    serve_parser.add_argument(
+        "--max-wait-ms",
+        type=float,
+        default=5.0,
+        help="Milliseconds a record waits for others to batch with",
+    )
+    serve_parser.add_argument(
+        "--workers", type=int, default=4, help="Batches scored at the same time"
+    )
+    serve_parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=100000,
+        help="Embeddings kept in the cache (0 to disable it)",
+    )
+    serve_parser.set_defaults(func=_serve)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,8 @@ from typing import Dict, Any, Optional
 import codecs
 
 from a_vert import grouping
+from a_vert import embedding_tools
+from a_vert import candidate_scores
 from a_vert.logger import get_logger
 
 logger = get_logger(__name__)
@@ -32,6 +34,36 @@ class AvertConfig:
         avert_model_name: Optional[str],
         instruction_map: Dict[str, str],
         instruction_flag: bool = False,
+        batch_size: int = 32,
+        timeout: float = 20,
+        max_retries: int = 3,
+        max_concurrency: int = 1,
+        pool_size: int = 10,
+        endpoint_limits: Optional[Dict[str, int]] = None,
+        max_batch_tokens: Optional[int] = None,
+        chars_per_token: float = 4.0,
+        sort_by_length: bool = False,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30.0,
+        breaker_threshold: int = 5,
+        breaker_cooldown: float = 30.0,
+        health_check_interval: float = 10.0,
+        hedge_percentile: Optional[float] = None,
+        adaptive_concurrency: bool = False,
+        max_requests_per_second: Optional[float] = None,
+        max_texts_per_second: Optional[float] = None,
+        rate_limit_dir: Optional[str] = None,
+        embedding_encoding: str = "float",
+        dtype: str = "float32",
+        embedding_dimensions: Optional[int] = None,
+        embedding_store: Optional[str] = None,
+        rescore_top_k: int = 4,
+        embedding_arena: Optional[str] = None,
+        embedding_arena_capacity: int = 262144,
+        local_backend: str = "torch",
+        record_mode: Optional[str] = None,
+        record_path: Optional[str] = None,
+        scores_path: Optional[str] = None,
     ):
         """
         Initialize AvertConfig.
@@ -42,11 +74,62 @@ class AvertConfig:
             query_template: Template for query formatting (can be None)
             grouping: Grouping method to use
             enhance: Whether to enhance candidate groups
-            avert_model_endpoint: Endpoint URL for the model
+            avert_model_endpoint: Endpoint URL for the model, or comma-separated
+                URLs of replicas serving the same model
             avert_endpoint_type: Type of endpoint (e.g., 'vllm', 'openai')
             avert_model_name: Name of the model (can be None for some endpoints)
             instruction_map: Dictionary mapping task names to instructions
             instruction_flag: Whether instruction injection is enabled
+            batch_size: Maximum number of texts sent in a single endpoint request
+            timeout: Timeout (in seconds) of each endpoint request
+            max_retries: Number of attempts per endpoint request
+            max_concurrency: Maximum number of in-flight requests per call
+            pool_size: Maximum number of pooled HTTP connections per host
+            endpoint_limits: Limits published by the endpoint (see
+                `embedding_tools.discover_endpoint_limits`), empty if unknown
+            max_batch_tokens: Estimated token budget of a single endpoint
+                request (None to split batches by text count only)
+            chars_per_token: Characters per token used to estimate text lengths
+            sort_by_length: Whether to sort texts by length before batching
+            backoff_base: Base delay (in seconds) of the exponential retry backoff
+            backoff_max: Maximum delay (in seconds) between retries
+            breaker_threshold: Consecutive failures that open the circuit
+                breaker (0 disables it)
+            breaker_cooldown: Seconds the circuit stays open before a trial call
+            health_check_interval: Seconds between health checks of the
+                replicas out of rotation
+            hedge_percentile: Latency percentile after which a slow request is
+                duplicated (None disables hedging)
+            adaptive_concurrency: Whether to adapt the number of in-flight
+                requests (up to max_concurrency) to the endpoint load
+            max_requests_per_second: Requests per second allowed to each host,
+                shared by all the processes of the node (None for no limit)
+            max_texts_per_second: Texts per second allowed to each host,
+                shared by all the processes of the node (None for no limit)
+            rate_limit_dir: Directory of the files holding the shared rate
+                limit state (None for the system temporary directory)
+            embedding_encoding: Transport of vLLM/OpenAI embeddings ('float'
+                or 'base64')
+            dtype: Floating point type of the embeddings and scores, from
+                decoding to grouping ('float16', 'float32' or 'float64')
+            embedding_dimensions: Number of (Matryoshka) embedding dimensions
+                to keep (None for the full embeddings)
+            embedding_store: Quantization of the in-memory store of candidate
+                embeddings ('int8' or 'binary', None for no store), 'max'
+                grouping only
+            rescore_top_k: Stored candidates of each group rescored with their
+                exact embeddings
+            embedding_arena: File shared by the processes of the node to hold
+                the embedding store (None for a store per process)
+            embedding_arena_capacity: Embeddings the shared file can hold
+            local_backend: Runtime of the in-process models of the 'local'
+                endpoint type ('torch' or 'onnx')
+            record_mode: Whether to record the endpoint responses to
+                record_path ('record') or to serve them from it ('replay'),
+                None for neither
+            record_path: Recording file of the endpoint responses
+            scores_path: Parquet file where the score of every candidate is
+                written (None to not keep them)
         """
         self.avert_method = avert_method
         self.document_template = document_template
@@ -58,6 +141,36 @@ class AvertConfig:
         self.avert_model_name = avert_model_name
         self.instruction_map = instruction_map
         self.instruction_flag = instruction_flag
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.max_concurrency = max_concurrency
+        self.pool_size = pool_size
+        self.endpoint_limits = endpoint_limits if endpoint_limits is not None else {}
+        self.max_batch_tokens = max_batch_tokens
+        self.chars_per_token = chars_per_token
+        self.sort_by_length = sort_by_length
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.health_check_interval = health_check_interval
+        self.hedge_percentile = hedge_percentile
+        self.adaptive_concurrency = adaptive_concurrency
+        self.max_requests_per_second = max_requests_per_second
+        self.max_texts_per_second = max_texts_per_second
+        self.rate_limit_dir = rate_limit_dir
+        self.embedding_encoding = embedding_encoding
+        self.dtype = dtype
+        self.embedding_dimensions = embedding_dimensions
+        self.embedding_store = embedding_store
+        self.rescore_top_k = rescore_top_k
+        self.embedding_arena = embedding_arena
+        self.embedding_arena_capacity = embedding_arena_capacity
+        self.local_backend = local_backend
+        self.record_mode = record_mode
+        self.record_path = record_path
+        self.scores_path = scores_path
 
     @classmethod
     def from_dict(cls, config_dict: Dict[str, Any]) -> "AvertConfig":
@@ -81,6 +194,38 @@ class AvertConfig:
             avert_model_name=config_dict.get("AVERT_MODEL_NAME"),
             instruction_map=config_dict.get("INSTRUCTION_MAP", {}),
             instruction_flag=config_dict.get("INSTRUCTION_FLAG", False),
+            batch_size=config_dict.get("BATCH_SIZE", 32),
+            timeout=config_dict.get("TIMEOUT", 20),
+            max_retries=config_dict.get("MAX_RETRIES", 3),
+            max_concurrency=config_dict.get("MAX_CONCURRENCY", 1),
+            pool_size=config_dict.get("POOL_SIZE", 10),
+            endpoint_limits=config_dict.get("ENDPOINT_LIMITS", {}),
+            max_batch_tokens=config_dict.get("MAX_BATCH_TOKENS"),
+            chars_per_token=config_dict.get("CHARS_PER_TOKEN", 4.0),
+            sort_by_length=config_dict.get("SORT_BY_LENGTH", False),
+            backoff_base=config_dict.get("BACKOFF_BASE", 0.5),
+            backoff_max=config_dict.get("BACKOFF_MAX", 30.0),
+            breaker_threshold=config_dict.get("BREAKER_THRESHOLD", 5),
+            breaker_cooldown=config_dict.get("BREAKER_COOLDOWN", 30.0),
+            health_check_interval=config_dict.get("HEALTH_CHECK_INTERVAL", 10.0),
+            hedge_percentile=config_dict.get("HEDGE_PERCENTILE"),
+            adaptive_concurrency=config_dict.get("ADAPTIVE_CONCURRENCY", False),
+            max_requests_per_second=config_dict.get("MAX_REQUESTS_PER_SECOND"),
+            max_texts_per_second=config_dict.get("MAX_TEXTS_PER_SECOND"),
+            rate_limit_dir=config_dict.get("RATE_LIMIT_DIR"),
+            embedding_encoding=config_dict.get("EMBEDDING_ENCODING", "float"),
+            dtype=config_dict.get("DTYPE", "float32"),
+            embedding_dimensions=config_dict.get("EMBEDDING_DIMENSIONS"),
+            embedding_store=config_dict.get("EMBEDDING_STORE"),
+            rescore_top_k=config_dict.get("RESCORE_TOP_K", 4),
+            embedding_arena=config_dict.get("EMBEDDING_ARENA"),
+            embedding_arena_capacity=config_dict.get(
+                "EMBEDDING_ARENA_CAPACITY", 262144
+            ),
+            local_backend=config_dict.get("LOCAL_BACKEND", "torch"),
+            record_mode=config_dict.get("RECORD_MODE"),
+            record_path=config_dict.get("RECORD_PATH"),
+            scores_path=config_dict.get("SCORES_PATH"),
         )
 
     def to_dict(self) -> Dict[str, Any]:
@@ -101,6 +246,36 @@ class AvertConfig:
             "AVERT_MODEL_NAME": self.avert_model_name,
             "INSTRUCTION_MAP": self.instruction_map,
             "INSTRUCTION_FLAG": self.instruction_flag,
+            "BATCH_SIZE": self.batch_size,
+            "TIMEOUT": self.timeout,
+            "MAX_RETRIES": self.max_retries,
+            "MAX_CONCURRENCY": self.max_concurrency,
+            "POOL_SIZE": self.pool_size,
+            "ENDPOINT_LIMITS": self.endpoint_limits,
+            "MAX_BATCH_TOKENS": self.max_batch_tokens,
+            "CHARS_PER_TOKEN": self.chars_per_token,
+            "SORT_BY_LENGTH": self.sort_by_length,
+            "BACKOFF_BASE": self.backoff_base,
+            "BACKOFF_MAX": self.backoff_max,
+            "BREAKER_THRESHOLD": self.breaker_threshold,
+            "BREAKER_COOLDOWN": self.breaker_cooldown,
+            "HEALTH_CHECK_INTERVAL": self.health_check_interval,
+            "HEDGE_PERCENTILE": self.hedge_percentile,
+            "ADAPTIVE_CONCURRENCY": self.adaptive_concurrency,
+            "MAX_REQUESTS_PER_SECOND": self.max_requests_per_second,
+            "MAX_TEXTS_PER_SECOND": self.max_texts_per_second,
+            "RATE_LIMIT_DIR": self.rate_limit_dir,
+            "EMBEDDING_ENCODING": self.embedding_encoding,
+            "DTYPE": self.dtype,
+            "EMBEDDING_DIMENSIONS": self.embedding_dimensions,
+            "EMBEDDING_STORE": self.embedding_store,
+            "RESCORE_TOP_K": self.rescore_top_k,
+            "EMBEDDING_ARENA": self.embedding_arena,
+            "EMBEDDING_ARENA_CAPACITY": self.embedding_arena_capacity,
+            "LOCAL_BACKEND": self.local_backend,
+            "RECORD_MODE": self.record_mode,
+            "RECORD_PATH": self.record_path,
+            "SCORES_PATH": self.scores_path,
         }
 
 
@@ -121,6 +296,63 @@ PREDEFINED_TEMPLATES = {
 }
 
 
+def _get_numeric_env(name: str, default, cast=int, min_value=1, strict=False):
+    """
+    Read a numeric environment variable and validate its lower bound.
+
+    Args:
+        name: Name of the environment variable
+        default: Value returned when the variable is not set
+        cast: Type used to parse the value (int or float)
+        min_value: Smallest accepted value
+        strict: If True, `min_value` itself is not accepted
+
+    Returns:
+        The parsed value, or `default` if the variable is not set.
+
+    Raises:
+        ValueError: If the value cannot be parsed or is below `min_value`.
+    """
+    raw_value = os.getenv(name, None)
+    if raw_value is None or raw_value.strip() == "":
+        return default
+    try:
+        value = cast(raw_value)
+    except ValueError:
+        raise ValueError(
+            f"Invalid {name} value: '{raw_value}'. Must be a {cast.__name__}."
+        )
+    if value < min_value or (strict and value == min_value):
+        raise ValueError(
+            f"Invalid {name} value: '{raw_value}'. "
+            f"Must be {'>' if strict else '>='} {min_value}."
+        )
+    return value
+
+
+def _get_bool_env(name: str, default: str) -> bool:
+    """
+    Read a boolean environment variable.
+
+    Args:
+        name: Name of the environment variable
+        default: Value used when the variable is not set
+
+    Returns:
+        True if the value is one of: true, 1, yes.
+
+    Raises:
+        ValueError: If the value is not a recognized boolean string.
+    """
+    value = os.getenv(name, default).lower()
+    if value not in ("true", "false", "1", "0", "yes", "no"):
+        raise ValueError(
+            f"Invalid {name} value: '{value}'. "
+            "Must be one of: true, false, 1, 0, yes, no"
+        )
+    return value in ("true", "1", "yes")
+
+
 def setup(instruction_map={}) -> AvertConfig:
     """
     Setup and validate A-VERT configuration from environment variables.
@@ -237,13 +469,163 @@ def setup(instruction_map={}) -> AvertConfig:
         )
     config["GROUPING"] = grouping_method
 
-    enhance_str = os.getenv("AVERT_ENHANCE", "true").lower()
-    if enhance_str not in ("true", "false", "1", "0", "yes", "no"):
+    config["ENHANCE"] = _get_bool_env("AVERT_ENHANCE", "true")
+
+    # --- Performance Configuration ---
+    # Tune endpoint throughput per deployment without code changes
+    config["BATCH_SIZE"] = _get_numeric_env("AVERT_BATCH_SIZE", 32)
+    config["TIMEOUT"] = _get_numeric_env(
+        "AVERT_TIMEOUT", 20.0, cast=float, min_value=0, strict=True
+    )
+    config["MAX_RETRIES"] = _get_numeric_env("AVERT_MAX_RETRIES", 3)
+    config["MAX_CONCURRENCY"] = _get_numeric_env("AVERT_MAX_CONCURRENCY", 1)
+    config["ADAPTIVE_CONCURRENCY"] = _get_bool_env(
+        "AVERT_ADAPTIVE_CONCURRENCY", "false"
+    )
+    config["POOL_SIZE"] = _get_numeric_env("AVERT_POOL_SIZE", 10)
+    config["MAX_BATCH_TOKENS"] = _get_numeric_env("AVERT_MAX_BATCH_TOKENS", None)
+    config["CHARS_PER_TOKEN"] = _get_numeric_env(
+        "AVERT_CHARS_PER_TOKEN", 4.0, cast=float, min_value=0, strict=True
+    )
+    config["SORT_BY_LENGTH"] = _get_bool_env("AVERT_SORT_BY_LENGTH", "false")
+    config["EMBEDDING_ENCODING"] = os.getenv("AVERT_EMBEDDING_ENCODING", "float")
+    if config["EMBEDDING_ENCODING"] not in ("base64", "float"):
         raise ValueError(
-            f"Invalid AVERT_ENHANCE value: '{enhance_str}'. "
-            "Must be one of: true, false, 1, 0, yes, no"
+            f"Invalid AVERT_EMBEDDING_ENCODING value: '{config['EMBEDDING_ENCODING']}'. "
+            "Must be 'base64' or 'float'."
+        )
+    config["DTYPE"] = os.getenv("AVERT_DTYPE", "float32")
+    if config["DTYPE"] not in ("float16", "float32", "float64"):
+        raise ValueError(
+            f"Invalid AVERT_DTYPE value: '{config['DTYPE']}'. "
+            "Must be 'float16', 'float32' or 'float64'."
+        )
+    config["EMBEDDING_DIMENSIONS"] = _get_numeric_env(
+        "AVERT_EMBEDDING_DIMENSIONS", None
+    )
+    config["EMBEDDING_STORE"] = os.getenv("AVERT_EMBEDDING_STORE", "none")
+    if config["EMBEDDING_STORE"] not in ("none", "int8", "binary"):
+        raise ValueError(
+            f"Invalid AVERT_EMBEDDING_STORE value: '{config['EMBEDDING_STORE']}'. "
+            "Must be 'none', 'int8' or 'binary'."
+        )
+    if config["EMBEDDING_STORE"] == "none":
+        config["EMBEDDING_STORE"] = None
+    config["RESCORE_TOP_K"] = _get_numeric_env("AVERT_RESCORE_TOP_K", 4)
+    if config["EMBEDDING_STORE"] is not None and config["GROUPING"] != "max":
+        # Only the best stored candidates of each group get their exact score,
+        # the other groupings would be computed on approximate scores
+        raise ValueError(
+            "AVERT_EMBEDDING_STORE requires AVERT_GROUPING=max, "
+            f"got '{config['GROUPING']}'."
+        )
+    config["EMBEDDING_ARENA"] = os.getenv("AVERT_EMBEDDING_ARENA") or None
+    if config["EMBEDDING_ARENA"] is not None and config["EMBEDDING_STORE"] is None:
+        raise ValueError(
+            "AVERT_EMBEDDING_ARENA requires AVERT_EMBEDDING_STORE ('int8' or 'binary')."
+        )
+    config["EMBEDDING_ARENA_CAPACITY"] = _get_numeric_env(
+        "AVERT_EMBEDDING_ARENA_CAPACITY", 262144
+    )
+    config["LOCAL_BACKEND"] = os.getenv("AVERT_LOCAL_BACKEND", "torch")
+    if config["LOCAL_BACKEND"] not in ("torch", "onnx"):
+        raise ValueError(
+            f"Invalid AVERT_LOCAL_BACKEND value: '{config['LOCAL_BACKEND']}'. "
+            "Must be 'torch' or 'onnx'."
+        )
+
+    # --- Retry backoff and circuit breaker ---
+    config["BACKOFF_BASE"] = _get_numeric_env(
+        "AVERT_BACKOFF_BASE", 0.5, cast=float, min_value=0
+    )
+    config["BACKOFF_MAX"] = _get_numeric_env(
+        "AVERT_BACKOFF_MAX", 30.0, cast=float, min_value=0
+    )
+    config["BREAKER_THRESHOLD"] = _get_numeric_env(
+        "AVERT_CIRCUIT_BREAKER_THRESHOLD", 5, min_value=0
+    )
+    config["BREAKER_COOLDOWN"] = _get_numeric_env(
+        "AVERT_CIRCUIT_BREAKER_COOLDOWN", 30.0, cast=float, min_value=0
+    )
+    config["HEALTH_CHECK_INTERVAL"] = _get_numeric_env(
+        "AVERT_HEALTH_CHECK_INTERVAL", 10.0, cast=float, min_value=0
+    )
+
+    # --- Hedged requests (optional) ---
+    config["HEDGE_PERCENTILE"] = _get_numeric_env(
+        "AVERT_HEDGE_PERCENTILE", None, cast=float, min_value=0, strict=True
+    )
+    if config["HEDGE_PERCENTILE"] is not None and config["HEDGE_PERCENTILE"] >= 100:
+        raise ValueError(
+            f"Invalid AVERT_HEDGE_PERCENTILE value: '{config['HEDGE_PERCENTILE']}'. "
+            "Must be < 100."
+        )
+
+    # --- Node-wide rate limit (optional) ---
+    # Shared by all the processes of the node calling the same endpoint
+    config["MAX_REQUESTS_PER_SECOND"] = _get_numeric_env(
+        "AVERT_MAX_REQUESTS_PER_SECOND", None, cast=float, min_value=0, strict=True
+    )
+    config["MAX_TEXTS_PER_SECOND"] = _get_numeric_env(
+        "AVERT_MAX_TEXTS_PER_SECOND", None, cast=float, min_value=0, strict=True
+    )
+    config["RATE_LIMIT_DIR"] = os.getenv("AVERT_RATE_LIMIT_DIR")
+    if config["RATE_LIMIT_DIR"] is not None and not os.path.isdir(
+        config["RATE_LIMIT_DIR"]
+    ):
+        raise ValueError(
+            f"Invalid AVERT_RATE_LIMIT_DIR value: '{config['RATE_LIMIT_DIR']}'. "
+            "Must be an existing directory."
+        )
+
+    # --- Recorded endpoint responses (optional) ---
+    # Record every response to a file, or replay them without any network call
+    config["RECORD_MODE"] = os.getenv("AVERT_RECORD_MODE", "none")
+    if config["RECORD_MODE"] not in ("none", "record", "replay"):
+        raise ValueError(
+            f"Invalid AVERT_RECORD_MODE value: '{config['RECORD_MODE']}'. "
+            "Must be 'none', 'record' or 'replay'."
+        )
+    if config["RECORD_MODE"] == "none":
+        config["RECORD_MODE"] = None
+    config["RECORD_PATH"] = os.getenv("AVERT_RECORD_PATH")
+    if config["RECORD_MODE"] is not None and not config["RECORD_PATH"]:
+        raise ValueError(
+            f"AVERT_RECORD_MODE='{config['RECORD_MODE']}' requires AVERT_RECORD_PATH."
+        )
+    if config["RECORD_MODE"] == "replay" and not os.path.isfile(config["RECORD_PATH"]):
+        raise ValueError(
+            f"Invalid AVERT_RECORD_PATH value: '{config['RECORD_PATH']}'. "
+            "Must be an existing recording to replay."
+        )
+
+    # --- Per-candidate scores file (optional) ---
+    # Keep the raw candidate scores to recompute the groupings offline
+    config["SCORES_PATH"] = os.getenv("AVERT_SCORES_PATH") or None
+    if config["SCORES_PATH"] is not None:
+        # Fail now rather than when the first scores are written
+        candidate_scores._import_pyarrow()
+
+    # --- Endpoint capability discovery (optional) ---
+    # Probe the endpoint for the limits it publishes and size requests to them
+    config["ENDPOINT_LIMITS"] = {}
+    if _get_bool_env("AVERT_DISCOVER_LIMITS", "false"):
+        config["ENDPOINT_LIMITS"] = embedding_tools.discover_endpoint_limits(
+            avert_endpoint,
+            avert_endpoint_type,
+            model_name=avert_model_name,
+            timeout=config["TIMEOUT"],
+        )
+        # Use the largest batch the server accepts unless the user fixed one
+        discovered_batch_size = config["ENDPOINT_LIMITS"].get("max_batch_size")
+        if discovered_batch_size and os.getenv("AVERT_BATCH_SIZE") is None:
+            config["BATCH_SIZE"] = discovered_batch_size
+
+    if config["AVERT_METHOD"] == "rerank" and config["BATCH_SIZE"] < 2:
+        raise ValueError(
+            "Invalid AVERT_BATCH_SIZE value for 'rerank' method. "
+            "Must be >= 2 (one slot is reserved for the query)."
         )
-    config["ENHANCE"] = enhance_str in ("true", "1", "yes")
 
     # --- Instruction map loading & structural validation (no injection here) ---
     instruction_path = os.getenv("AVERT_INSTRUCTION_CONFIG_PATH")
@@ -0,0 +1,426 @@
+"""
+Quantized store of candidate embeddings.
+
+Candidate texts are shared by many samples (options, refusal and formulation
+mistake groups), so their embeddings are kept in memory between calls. They
+are stored quantized, with one scale per vector:
+- `int8`: every dimension is rounded to an int8 after dividing the vector by
+  its largest absolute value / 127 (4x less memory than float32);
+- `binary`: only the sign of every dimension is kept, packed in bits, and the
+  scale is the mean absolute value of the vector (32x less than float32).
+
+Similarities computed on the stored vectors are approximate; see
+`a_vert.embedding_tools.calculate_embedding_distances` for the exact
+rescoring of the best candidates.
+
+With `AVERT_EMBEDDING_ARENA`, the store lives in a memory-mapped file shared
+by all the processes of the node (see `SharedEmbeddingArena`), so its memory
+does not grow with the number of worker processes.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import threading
+
+import numpy as np
+
+from a_vert.logger import get_logger
+
+try:
+    import fcntl
+except ImportError:  # Windows, the arena needs a file lock
+    fcntl = None
+
+logger = get_logger(__name__)
+
+QUANTIZATIONS = ("int8", "binary")
+
+# Stores shared by all the calls to the same model
+_EMBEDDING_STORES: dict = {}
+_EMBEDDING_STORES_LOCK = threading.Lock()
+
+# Rows allocated when a store is created
+_INITIAL_CAPACITY = 1024
+
+# Arena file header: magic, identity of the model, capacity, slots of the
+# index, dimensions and bytes per row; the row count follows it
+_ARENA_MAGIC = b"AVERT-ARENA-1\n\0\0"
+_ARENA_HEADER = struct.Struct("<16sQQQII")
+_ARENA_COUNT_OFFSET = _ARENA_HEADER.size
+_ARENA_DATA_OFFSET = 64
+
+
+def _text_key(text):
+    """64-bit digest of `text`, used instead of the text to index the store."""
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+    # Zero marks the empty slots of the arena index
+    return int.from_bytes(digest, "little") or 1
+
+
+class QuantizedEmbeddingStore:
+    """Embeddings of texts, stored quantized (`int8` or `binary`) with one
+    float32 scale per vector. Texts are indexed by a 64-bit digest. Rows are
+    appended to arrays that grow by doubling, reads need no lock.
+    """
+
+    def __init__(self, quantization="int8"):
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(
+                f"Unknown embedding quantization: '{quantization}'. "
+                f"Must be one of: {', '.join(QUANTIZATIONS)}"
+            )
+        self.quantization = quantization
+        self.dimensions = None
+        self._rows = dict()
+        self._codes = None
+        self._scales = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._rows)
+
+    @property
+    def nbytes(self):
+        """Bytes used by the stored vectors and scales."""
+        if self._codes is None:
+            return 0
+        return len(self) * (self._codes.shape[1] + self._scales.itemsize)
+
+    def lookup(self, texts):
+        """Return the row of every text in the store, -1 for missing texts."""
+        return np.array([self._rows.get(_text_key(t), -1) for t in texts], dtype=int)
+
+    def _quantize(self, embeddings):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if self.quantization == "int8":
+            scales = np.abs(embeddings).max(axis=1) / 127
+            scales[scales == 0] = 1
+            codes = np.rint(embeddings / scales[:, None]).astype(np.int8)
+        else:
+            scales = np.abs(embeddings).mean(axis=1)
+            codes = np.packbits(embeddings > 0, axis=1)
+        return codes, scales.astype(np.float32)
+
+    def _reserve(self, n_rows, width):
+        """Grow the arrays so that `n_rows` more rows fit. Needs the lock."""
+        if self._codes is None:
+            capacity = max(_INITIAL_CAPACITY, n_rows)
+            self._codes = np.empty((capacity, width), dtype=np.uint8)
+            if self.quantization == "int8":
+                self._codes = self._codes.view(np.int8)
+            self._scales = np.empty(capacity, dtype=np.float32)
+            return
+        needed = len(self._rows) + n_rows
+        if needed <= len(self._codes):
+            return
+        capacity = max(needed, 2 * len(self._codes))
+        codes = np.empty((capacity, width), dtype=self._codes.dtype)
+        codes[: len(self._rows)] = self._codes[: len(self._rows)]
+        scales = np.empty(capacity, dtype=np.float32)
+        scales[: len(self._rows)] = self._scales[: len(self._rows)]
+        # Readers still holding the old arrays see the same rows
+        self._codes, self._scales = codes, scales
+
+    def add(self, texts, embeddings):
+        """Quantize and store the `embeddings` of `texts`. Texts already in
+        the store are skipped.
+        """
+        if len(texts) == 0:
+            return
+        if self.dimensions is None:
+            self.dimensions = embeddings.shape[1]
+        elif embeddings.shape[1] != self.dimensions:
+            raise ValueError(
+                f"Embeddings have {embeddings.shape[1]} dimensions, the store "
+                f"holds {self.dimensions}."
+            )
+        codes, scales = self._quantize(embeddings)
+        with self._lock:
+            new = dict()
+            for idx, text in enumerate(texts):
+                key = _text_key(text)
+                if key not in self._rows and key not in new:
+                    new[key] = idx
+            if not new:
+                return
+            self._reserve(len(new), codes.shape[1])
+            start = len(self._rows)
+            idxs = list(new.values())
+            self._codes[start : start + len(idxs)] = codes[idxs]
+            self._scales[start : start + len(idxs)] = scales[idxs]
+            # Rows are published once their data is written
+            for offset, key in enumerate(new):
+                self._rows[key] = start + offset
+
+    def get(self, rows):
+        """Return the dequantized (float32) embeddings of `rows`."""
+        codes = self._codes[rows]
+        scales = self._scales[rows]
+        if self.quantization == "int8":
+            embeddings = codes.astype(np.float32)
+        else:
+            bits = np.unpackbits(codes, axis=1, count=self.dimensions)
+            embeddings = bits.astype(np.float32) * 2 - 1
+        embeddings *= scales[:, None]
+        return embeddings
+
+
+class SharedEmbeddingArena(QuantizedEmbeddingStore):
+    """Quantized store in a memory-mapped file (`path`), shared by all the
+    processes of a node. Processes map the file instead of holding their own
+    copy of the embeddings, so reads need no copy nor lock.
+
+    A single process fills the arena: the first one to add embeddings takes
+    an exclusive lock on `path.lock`, held while it lives; when it exits the
+    next process that adds embeddings takes over. The others only read, the
+    embeddings they miss are fetched from the endpoint as usual.
+
+    The file holds an open-addressing index (64-bit text digest to row) and
+    `capacity` preallocated rows, written in place, so the mapping of the
+    readers never moves. Rows are written before their index slot, and the
+    digest is the last value written, so readers never see a partial entry.
+    Rows are reserved before they are written, so a filler killed midway
+    leaves unused rows but no corrupted entry. Once full, the arena stops
+    growing. `identity` (the endpoint, model, dimensions and quantization)
+    is checked when the file is opened, an arena of another model raises
+    `ValueError`.
+    """
+
+    def __init__(self, path, quantization="int8", identity="", capacity=262144):
+        super().__init__(quantization)
+        if fcntl is None:
+            raise ValueError("The shared embedding arena requires fcntl (POSIX).")
+        self.path = path
+        self.capacity = capacity
+        self.identity = _text_key(f"{identity}|{quantization}")
+        self._mmap = None
+        self._writable = False
+        self._filler_pid = None
+        self._lock_fd = None
+        self._warned_full = False
+
+    def __len__(self):
+        if not self._attach():
+            return 0
+        return int(self._count[0])
+
+    def _attach(self, writable=False):
+        """Map the arena file if it exists. Returns whether it is mapped."""
+        if self._mmap is not None and (self._writable or not writable):
+            return True
+        try:
+            f = open(self.path, "r+b" if writable else "rb")
+        except FileNotFoundError:
+            return False
+        with f:
+            header = f.read(_ARENA_HEADER.size)
+            if len(header) < _ARENA_HEADER.size:
+                return False
+            magic, identity, capacity, n_slots, dimensions, width = (
+                _ARENA_HEADER.unpack(header)
+            )
+            if magic != _ARENA_MAGIC:
+                raise ValueError(f"'{self.path}' is not an A-VERT embedding arena.")
+            if identity != self.identity:
+                raise ValueError(
+                    f"The embedding arena '{self.path}' holds the embeddings of "
+                    "another model, dimensions or quantization."
+                )
+            buffer = mmap.mmap(
+                f.fileno(),
+                0,
+                access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ,
+            )
+        self.capacity = capacity
+        self.dimensions = dimensions
+        self._n_slots = n_slots
+        self._count = np.ndarray(
+            1, dtype=np.uint64, buffer=buffer, offset=_ARENA_COUNT_OFFSET
+        )
+        self._slot_keys = np.ndarray(
+            n_slots, dtype=np.uint64, buffer=buffer, offset=_ARENA_DATA_OFFSET
+        )
+        # Row + 1 of every slot, 0 until the row is published
+        self._slot_rows = np.ndarray(
+            n_slots,
+            dtype=np.int64,
+            buffer=buffer,
+            offset=_ARENA_DATA_OFFSET + 8 * n_slots,
+        )
+        codes_offset = _ARENA_DATA_OFFSET + 16 * n_slots
+        self._codes = np.ndarray(
+            (capacity, width),
+            dtype=np.int8 if self.quantization == "int8" else np.uint8,
+            buffer=buffer,
+            offset=codes_offset,
+        )
+        self._scales = np.ndarray(
+            capacity,
+            dtype=np.float32,
+            buffer=buffer,
+            offset=codes_offset + -(-capacity * width // 8) * 8,
+        )
+        self._mmap = buffer
+        self._writable = writable
+        return True
+
+    def _create(self, dimensions, width):
+        """Write an empty arena file. Needs the filler lock."""
+        # Twice the capacity, so probes stay short when full
+        n_slots = 1 << (2 * self.capacity - 1).bit_length()
+        size = (
+            _ARENA_DATA_OFFSET
+            + 16 * n_slots
+            + -(-self.capacity * width // 8) * 8
+            + 4 * self.capacity
+        )
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            # Sparse, pages are only allocated when written
+            f.truncate(size)
+            f.write(
+                _ARENA_HEADER.pack(
+                    _ARENA_MAGIC,
+                    self.identity,
+                    self.capacity,
+                    n_slots,
+                    dimensions,
+                    width,
+                )
+            )
+        os.replace(tmp_path, self.path)
+        logger.info(
+            "Embedding arena created",
+            path=self.path,
+            capacity=self.capacity,
+            dimensions=dimensions,
+            size=size,
+        )
+
+    def _is_filler(self):
+        """Whether this process fills the arena, taking the filler lock if
+        it is free.
+        """
+        if self._filler_pid == os.getpid():
+            return True
+        if self._filler_pid is not None:
+            # Forked from the filler: the lock belongs to the parent
+            os.close(self._lock_fd)
+            self._filler_pid = None
+            self._lock_fd = None
+            self._mmap = None
+        fd = os.open(f"{self.path}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        self._filler_pid = os.getpid()
+        logger.debug("Filling the embedding arena", path=self.path)
+        return True
+
+    def _probe(self, keys):
+        """Slot of every key, or of the empty slot where it would go."""
+        mask = np.uint64(self._n_slots - 1)
+        slots = (keys & mask).astype(np.int64)
+        pending = np.arange(len(keys))
+        while len(pending):
+            slot_keys = self._slot_keys[slots[pending]]
+            pending = pending[(slot_keys != keys[pending]) & (slot_keys != 0)]
+            slots[pending] = (slots[pending] + 1) & (self._n_slots - 1)
+        return slots
+
+    def lookup(self, texts):
+        """Return the row of every text in the arena, -1 for missing texts."""
+        if not self._attach():
+            return np.full(len(texts), -1, dtype=int)
+        keys = np.array([_text_key(t) for t in texts], dtype=np.uint64)
+        slots = self._probe(keys)
+        found = self._slot_keys[slots] == keys
+        return np.where(found, self._slot_rows[slots], 0).astype(int) - 1
+
+    def add(self, texts, embeddings):
+        """Quantize and store the `embeddings` of `texts`, if this process
+        fills the arena. Texts already in the arena are skipped.
+        """
+        if len(texts) == 0:
+            return
+        with self._lock:
+            if not self._is_filler():
+                return
+            codes, scales = self._quantize(embeddings)
+            if not self._attach(writable=True):
+                self._create(embeddings.shape[1], codes.shape[1])
+                self._attach(writable=True)
+            if embeddings.shape[1] != self.dimensions:
+                raise ValueError(
+                    f"Embeddings have {embeddings.shape[1]} dimensions, the arena "
+                    f"holds {self.dimensions}."
+                )
+            new = dict()
+            for idx, text in enumerate(texts):
+                new.setdefault(_text_key(text), idx)
+            keys = np.array(list(new), dtype=np.uint64)
+            idxs = np.array(list(new.values()))
+            missing = self._slot_keys[self._probe(keys)] != keys
+            keys, idxs = keys[missing], idxs[missing]
+            start = int(self._count[0])
+            n_rows = min(len(keys), self.capacity - start)
+            if n_rows < len(keys) and not self._warned_full:
+                logger.warning(
+                    "Embedding arena full", path=self.path, capacity=self.capacity
+                )
+                self._warned_full = True
+            if n_rows <= 0:
+                return
+            # Rows are reserved first, then written, then published
+            self._count[0] = start + n_rows
+            self._codes[start : start + n_rows] = codes[idxs[:n_rows]]
+            self._scales[start : start + n_rows] = scales[idxs[:n_rows]]
+            for offset, key in enumerate(keys[:n_rows]):
+                slot = self._probe(key[None])[0]
+                self._slot_rows[slot] = start + offset + 1
+                self._slot_keys[slot] = key
+
+
+def get_embedding_store(
+    quantization,
+    endpoint,
+    model_name=None,
+    dimensions=None,
+    arena_path=None,
+    arena_capacity=262144,
+):
+    """Return the store shared by all the calls to the same endpoint, model
+    and number of dimensions, created on first use. With an `arena_path`, the
+    store is a `SharedEmbeddingArena` in that file, shared with the other
+    processes of the node.
+    """
+    key = (str(endpoint), model_name, dimensions, quantization, arena_path)
+    store = _EMBEDDING_STORES.get(key)
+    if store is None:
+        with _EMBEDDING_STORES_LOCK:
+            store = _EMBEDDING_STORES.get(key)
+            if store is None:
+                if arena_path is not None:
+                    store = SharedEmbeddingArena(
+                        arena_path,
+                        quantization,
+                        identity=f"{endpoint}|{model_name}|{dimensions}",
+                        capacity=arena_capacity,
+                    )
+                else:
+                    store = QuantizedEmbeddingStore(quantization)
+                _EMBEDDING_STORES[key] = store
+    return store
+
+
+def get_embedding_store_stats():
+    """Return the number of vectors and bytes held by every store."""
+    return {
+        key: {"vectors": len(store), "nbytes": store.nbytes}
+        for key, store in _EMBEDDING_STORES.items()
+    }
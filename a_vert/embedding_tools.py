@@ -1,153 +1,2421 @@
 import numpy as np
 import requests
 import json
+import collections
+import asyncio
+import contextvars
+import base64
+import email.utils
+import hashlib
+import operator
+import os
+import random
+import struct
+import tempfile
+import threading
+import time
+import urllib.parse
+import weakref
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
 from scipy import spatial
 
+from a_vert import local_backend as local_models
+from a_vert import recording
 from a_vert.logger import get_logger
 
+try:
+    import fcntl
+except ImportError:  # Windows, the rate limit is then enforced per process
+    fcntl = None
+
+try:
+    import orjson
+except ImportError:  # Optional, falls back to the standard json module
+    orjson = None
+
 logger = get_logger(__name__)
 
 _RETRY_EXCEPTIONS = (requests.exceptions.Timeout, requests.exceptions.ConnectionError)
 
+# Status codes and error messages returned when a request carries too many or
+# too long texts (413 Payload Too Large, TEI 422 validation, vLLM 400)
+_PAYLOAD_TOO_LARGE_STATUS = (400, 413, 422)
+_PAYLOAD_TOO_LARGE_MESSAGES = (
+    "too long",
+    "too large",
+    "too many",
+    "must have less than",
+    "maximum context length",
+    "exceeds",
+)
+
+# Overload status codes, retried with backoff
+_RETRY_STATUS = (429, 502, 503, 504)
+
+# Endpoint call counters, circuit breakers (one per host), replica pools and
+# adaptive concurrency limiters (one per endpoint)
+_ENDPOINT_STATS: collections.Counter = collections.Counter()
+_CIRCUIT_BREAKERS: dict = {}
+_REPLICA_POOLS: dict = {}
+_CONCURRENCY_LIMITERS: dict = {}
+_STATS_LOCK = threading.Lock()
+
+# Duration of the HTTP round trip of the last request sent by each thread (by
+# each asyncio task for the async API), read by the adaptive concurrency limiter
+_ROUND_TRIP = threading.local()
+_AROUND_TRIP = contextvars.ContextVar("avert_round_trip", default=None)
+
+# Hedged requests: latencies kept per replica pool, observations needed before
+# hedging, and threads running the hedged calls
+_LATENCY_WINDOW = 500
+_HEDGE_MIN_OBSERVATIONS = 20
+_HEDGE_MAX_WORKERS = 64
+_HEDGE_EXECUTOR = None
+
+# Cross-process rate limiters (one per host) and the layout of their shared
+# state file: request tokens, text tokens and time of the last update
+_RATE_LIMITERS: dict = {}
+_RATE_LIMIT_STATE = struct.Struct("ddd")
+
+# Embedding URLs that rejected the base64 encoding format, served as floats
+_FLOAT_ENCODING_URLS: set = set()
+
+# Embedding URLs that rejected reduced dimensions, truncated on the client
+_FULL_DIMENSIONS_URLS: set = set()
+
+# Largest batch size that worked and smallest one rejected as too large, per
+# (endpoint, method), once the endpoint rejected a batch
+_BATCH_SIZE_LIMITS: dict = {}
+_BATCH_SIZE_LIMITS_LOCK = threading.Lock()
+
+# Pooled HTTP sessions, one per connection pool size
+_SESSIONS: dict = {}
+_SESSIONS_LOCK = threading.Lock()
+
+# aiohttp sessions of the asyncio API, per event loop and connection pool size
+_ASYNC_SESSIONS: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+# Semaphores of the asyncio API bounding the batches in flight, per event loop,
+# endpoint and concurrency
+_ASYNC_SEMAPHORES: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+class EndpointError(ValueError):
+    """The endpoint replied with a non-200 status code."""
+
+    def __init__(self, message, status_code=None, response_body=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.response_body = response_body
+
+
+class PayloadTooLargeError(EndpointError):
+    """The endpoint rejected the request because the batch was too large."""
+
+
+class CircuitOpenError(EndpointError):
+    """The circuit breaker of the endpoint is open, the call was not sent."""
+
+
+class RetriesExhaustedError(EndpointError):
+    """The endpoint kept failing (network errors or overload replies) until
+    the retries ran out. `status_code` is the one of the last attempt, None if
+    it failed at the network level.
+    """
+
+
+class _CircuitBreaker:
+    """Consecutive-failure circuit breaker for a single host.
+
+    After `threshold` consecutive failed attempts (network errors or 5xx
+    replies) the circuit opens and calls fail fast with `CircuitOpenError`.
+    Once `cooldown` seconds have passed, a single trial
+    call is let through (half-open): if it succeeds the circuit closes,
+    otherwise it opens again. A trial that raises or is cancelled counts as
+    failed, and one that has not reported back after `cooldown` seconds is
+    given up and replaced by a new one. A `threshold` of 0 disables the
+    breaker.
+    """
+
+    def __init__(self, host, threshold=5, cooldown=30.0):
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trial_started = 0.0
+        self._lock = threading.Lock()
+
+    def before_request(self):
+        """Raise `CircuitOpenError` if the call must not be sent. Returns
+        whether the call is the trial of the half-open circuit, whose outcome
+        must then be recorded whatever happens (see `trial_failed`).
+        """
+        if self.threshold <= 0:
+            return False
+        with self._lock:
+            if self.state == "closed":
+                return False
+            now = time.monotonic()
+            cooldown_passed = self.state == "open" and (
+                now - self.opened_at >= self.cooldown
+            )
+            trial_expired = self.state == "half_open" and (
+                now - self.trial_started >= self.cooldown
+            )
+            if cooldown_passed or trial_expired:
+                # Let a single trial call through
+                if trial_expired:
+                    logger.warning("Circuit breaker trial expired", host=self.host)
+                self.state = "half_open"
+                self.trial_started = now
+                logger.info("Circuit breaker half-open", host=self.host)
+                return True
+        _increment_stat("circuit_rejected")
+        raise CircuitOpenError(
+            f"Circuit breaker open for {self.host}, endpoint call not sent."
+        )
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                logger.info("Circuit breaker closed", host=self.host)
+            self.state = "closed"
+            self.consecutive_failures = 0
+
+    def trial_failed(self, trial):
+        """Record a failure if the interrupted call was the trial, so that the
+        circuit does not stay half-open.
+        """
+        if trial and self.state == "half_open":
+            self.record_failure()
+
+    def record_failure(self):
+        if self.threshold <= 0:
+            return
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == "half_open" or (
+                self.state == "closed" and self.consecutive_failures >= self.threshold
+            ):
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                _increment_stat("circuit_opened")
+                logger.warning(
+                    "Circuit breaker opened",
+                    host=self.host,
+                    consecutive_failures=self.consecutive_failures,
+                    cooldown=self.cooldown,
+                )
+
+
+def _host_of(url):
+    """Return the `scheme://host:port` part of `url`."""
+    parsed_url = urllib.parse.urlsplit(url)
+    return f"{parsed_url.scheme}://{parsed_url.netloc}"
+
+
+def _get_circuit_breaker(url, threshold=5, cooldown=30.0):
+    """Return the circuit breaker shared by all the calls to the host of `url`."""
+    host = _host_of(url)
+    breaker = _CIRCUIT_BREAKERS.get(host)
+    if breaker is None:
+        with _STATS_LOCK:
+            breaker = _CIRCUIT_BREAKERS.setdefault(
+                host, _CircuitBreaker(host, threshold=threshold, cooldown=cooldown)
+            )
+    breaker.threshold = threshold
+    breaker.cooldown = cooldown
+    return breaker
+
+
+def _parse_endpoints(endpoint):
+    """Return the list of replica URLs of `endpoint`, given either as a list or
+    as a comma-separated string.
+    """
+    if isinstance(endpoint, (list, tuple)):
+        replicas = [str(replica).strip() for replica in endpoint]
+    else:
+        replicas = [replica.strip() for replica in endpoint.split(",")]
+    replicas = [replica for replica in replicas if replica != ""]
+    if len(replicas) == 0:
+        raise ValueError("At least one endpoint URL is required.")
+    return replicas
+
+
+class _ReplicaPool:
+    """Router over the replicas serving the same A-VERT model.
+
+    Each call goes to the available replica with the fewest outstanding
+    requests. A replica is taken out of rotation while its circuit breaker is
+    open (see `_CircuitBreaker`); calls that hit an open circuit fail over to
+    the next replica. Every `health_check_interval` seconds the `/health`
+    route of the replicas out of rotation is probed, and the ones that answer
+    are put back.
+
+    Calls can be hedged: if a call has not answered within a percentile of the
+    recently observed latencies, a duplicate is sent (to another replica when
+    there is one) and the first response wins. The duplicate takes a slot of
+    the concurrency limit of the call (adaptive limiter or asyncio semaphore)
+    and is not sent when none is free; like every request, it waits for the
+    rate limit of its replica.
+
+    `acall` is the asyncio version of `call`, with the same routing.
+    """
+
+    def __init__(self, replicas, health_check_interval=10.0):
+        self.replicas = list(replicas)
+        self.key = ",".join(self.replicas)
+        self.health_check_interval = health_check_interval
+        self.outstanding = {replica: 0 for replica in self.replicas}
+        self.requests = {replica: 0 for replica in self.replicas}
+        self.latencies = collections.deque(maxlen=_LATENCY_WINDOW)
+        self._last_health_check = time.monotonic()
+        self._lock = threading.Lock()
+
+    def is_available(self, replica):
+        """Check whether `replica` is in rotation."""
+        breaker = _CIRCUIT_BREAKERS.get(_host_of(replica))
+        if breaker is None or breaker.state == "closed":
+            return True
+        # Open circuits (and expired trials) are tried again once their
+        # cooldown has passed
+        if breaker.state == "open":
+            return time.monotonic() - breaker.opened_at >= breaker.cooldown
+        return time.monotonic() - breaker.trial_started >= breaker.cooldown
+
+    def check_health(self):
+        """Probe the replicas out of rotation and close the circuit of the ones
+        that answer.
+        """
+        for replica in self.replicas:
+            breaker = _CIRCUIT_BREAKERS.get(_host_of(replica))
+            if breaker is None or breaker.state == "closed":
+                continue
+            try:
+                response = _get_session().get(replica + "/health", timeout=2)
+            except requests.exceptions.RequestException:
+                continue
+            if response.status_code == 200:
+                breaker.record_success()
+                logger.info("Replica back in rotation", replica=replica)
+
+    def _health_check_due(self):
+        """Whether the replicas out of rotation are due to be probed. A due
+        check is claimed by the caller, so that a single thread runs it.
+        """
+        if len(self.replicas) < 2:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_health_check < self.health_check_interval:
+                return False
+            self._last_health_check = now
+        return True
+
+    def _maybe_check_health(self):
+        if self._health_check_due():
+            self.check_health()
+
+    def acquire(self, exclude=(), check_health=True):
+        """Reserve the available replica with the fewest outstanding requests.
+        If no replica is available, the least loaded one is returned so that the
+        call fails with the error of its circuit breaker.
+        """
+        if check_health:
+            self._maybe_check_health()
+        with self._lock:
+            candidates = [r for r in self.replicas if r not in exclude]
+            candidates = candidates or list(self.replicas)
+            available = [r for r in candidates if self.is_available(r)]
+            replica = min(available or candidates, key=self.outstanding.get)
+            self.outstanding[replica] += 1
+            self.requests[replica] += 1
+        return replica
+
+    def release(self, replica):
+        with self._lock:
+            self.outstanding[replica] -= 1
+
+    def call(self, replica_call, hedge_percentile=None, limiter=None):
+        """Run `replica_call(replica)` on the least loaded available replica,
+        failing over to another replica when the circuit of the first is open.
+        If `hedge_percentile` is given, the call is hedged (see `_hedged_call`),
+        within the request slots of `limiter` (see `_AdaptiveLimiter`).
+        """
+        _increment_stat("batch_calls")
+        if hedge_percentile:
+            return self._hedged_call(replica_call, hedge_percentile, limiter)
+        return self._failover_call(replica_call)
+
+    def _failover_call(self, replica_call, avoid=(), chosen=None):
+        tried = list()
+        while True:
+            replica = self.acquire(exclude=tried + list(avoid))
+            if chosen is not None:
+                chosen.append(replica)
+            start = time.monotonic()
+            try:
+                result = replica_call(replica)
+            except CircuitOpenError:
+                tried.append(replica)
+                if len(tried) >= len(self.replicas):
+                    raise
+                _increment_stat("replica_failovers")
+                logger.warning("Replica out of rotation, failing over", replica=replica)
+            else:
+                self.latencies.append(time.monotonic() - start)
+                return result
+            finally:
+                self.release(replica)
+
+    def latency_percentile(self, percentile):
+        """Percentile of the recent call latencies, None if there are not enough
+        observations yet.
+        """
+        latencies = list(self.latencies)
+        if len(latencies) < _HEDGE_MIN_OBSERVATIONS:
+            return None
+        return float(np.percentile(latencies, percentile))
+
+    def _hedged_call(self, replica_call, hedge_percentile, limiter=None):
+        """Send the call and, if it has not answered within `hedge_percentile`
+        of the recent latencies, send a duplicate to another replica. The first
+        successful response wins, the other one is discarded. The duplicate is
+        only sent if a request slot of `limiter` is free, and holds it until
+        it completes.
+        """
+        hedge_delay = self.latency_percentile(hedge_percentile)
+        if hedge_delay is None:
+            return self._failover_call(replica_call)
+
+        executor = _get_hedge_executor()
+        chosen = list()
+        primary = executor.submit(
+            self._timed_failover_call, replica_call, chosen=chosen
+        )
+        done, _ = concurrent.futures.wait([primary], timeout=hedge_delay)
+        if done:
+            return self._hedge_result(primary)
+        if limiter is not None and not limiter.try_acquire():
+            # No request slot for the duplicate, wait for the original call
+            _increment_stat("hedges_skipped")
+            return self._hedge_result(primary)
+
+        _increment_stat("hedged_requests")
+        hedge = executor.submit(
+            self._timed_failover_call, replica_call, avoid=chosen[:1]
+        )
+        if limiter is not None:
+            hedge.add_done_callback(lambda _: limiter.release())
+        pending = {primary, hedge}
+        while True:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in (primary, hedge):
+                if future in done and future.exception() is None:
+                    if future is hedge:
+                        _increment_stat("hedge_wins")
+                    return self._hedge_result(future)
+            if not pending:
+                # Both failed, report the error of the original call
+                return self._hedge_result(primary)
+
+    def _timed_failover_call(self, replica_call, **kwargs):
+        """`_failover_call` run on a hedge thread, returned with the round trip
+        time of its request.
+        """
+        _ROUND_TRIP.seconds = None
+        return self._failover_call(replica_call, **kwargs), _ROUND_TRIP.seconds
+
+    @staticmethod
+    def _hedge_result(future):
+        """Result of a hedge thread call, its round trip time is passed on to
+        the calling thread.
+        """
+        result, _ROUND_TRIP.seconds = future.result()
+        return result
+
+    async def acall(
+        self, replica_call, hedge_percentile=None, semaphore=None, limiter=None
+    ):
+        """Asyncio version of `call`, `replica_call(replica)` is a coroutine
+        function. The losing call of a hedged pair is cancelled. The duplicate
+        of a hedged call is only sent if `semaphore` (the concurrency bound of
+        the call, see `_aget_semaphore`) and `limiter` have a free slot.
+        """
+        _increment_stat("batch_calls")
+        hedge_delay = None
+        if hedge_percentile:
+            hedge_delay = self.latency_percentile(hedge_percentile)
+        if hedge_delay is None:
+            return await self._afailover_call(replica_call)
+
+        chosen = list()
+        primary = asyncio.ensure_future(
+            self._afailover_call(replica_call, chosen=chosen)
+        )
+        done, _ = await asyncio.wait([primary], timeout=hedge_delay)
+        if done:
+            return primary.result()
+        if (semaphore is not None and semaphore.locked()) or (
+            limiter is not None and not limiter.try_acquire()
+        ):
+            # No request slot for the duplicate, wait for the original call
+            _increment_stat("hedges_skipped")
+            return await primary
+        if semaphore is not None:
+            await semaphore.acquire()
+
+        _increment_stat("hedged_requests")
+        hedge = asyncio.ensure_future(
+            self._afailover_call(replica_call, avoid=chosen[:1])
+        )
+        if semaphore is not None:
+            hedge.add_done_callback(lambda _: semaphore.release())
+        if limiter is not None:
+            hedge.add_done_callback(lambda _: limiter.release())
+        pending = {primary, hedge}
+        try:
+            while True:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in (primary, hedge):
+                    if future in done and future.exception() is None:
+                        if future is hedge:
+                            _increment_stat("hedge_wins")
+                        return future.result()
+                if not pending:
+                    # Both failed, report the error of the original call
+                    return primary.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def _afailover_call(self, replica_call, avoid=(), chosen=None):
+        if self._health_check_due():
+            # Probing the replicas blocks, keep it off the event loop
+            await asyncio.to_thread(self.check_health)
+        tried = list()
+        while True:
+            replica = self.acquire(exclude=tried + list(avoid), check_health=False)
+            if chosen is not None:
+                chosen.append(replica)
+            start = time.monotonic()
+            try:
+                result = await replica_call(replica)
+            except CircuitOpenError:
+                tried.append(replica)
+                if len(tried) >= len(self.replicas):
+                    raise
+                _increment_stat("replica_failovers")
+                logger.warning("Replica out of rotation, failing over", replica=replica)
+            else:
+                self.latencies.append(time.monotonic() - start)
+                return result
+            finally:
+                self.release(replica)
+
+    def stats(self):
+        with self._lock:
+            return {
+                replica: {
+                    "available": self.is_available(replica),
+                    "outstanding": self.outstanding[replica],
+                    "requests": self.requests[replica],
+                }
+                for replica in self.replicas
+            }
+
+
+def _get_hedge_executor():
+    """Return the thread pool running hedged calls."""
+    global _HEDGE_EXECUTOR
+    if _HEDGE_EXECUTOR is None:
+        with _STATS_LOCK:
+            if _HEDGE_EXECUTOR is None:
+                _HEDGE_EXECUTOR = ThreadPoolExecutor(
+                    max_workers=_HEDGE_MAX_WORKERS, thread_name_prefix="avert-hedge"
+                )
+    return _HEDGE_EXECUTOR
+
+
+def _get_replica_pool(endpoint, health_check_interval=10.0):
+    """Return the replica pool shared by all the calls to `endpoint`."""
+    replicas = _parse_endpoints(endpoint)
+    key = ",".join(replicas)
+    pool = _REPLICA_POOLS.get(key)
+    if pool is None:
+        with _STATS_LOCK:
+            pool = _REPLICA_POOLS.setdefault(
+                key, _ReplicaPool(replicas, health_check_interval)
+            )
+    pool.health_check_interval = health_check_interval
+    return pool
+
+
+class _AdaptiveLimiter:
+    """AIMD limit on the number of requests in flight to one endpoint.
+
+    Every successful call whose latency stays below `latency_tolerance` times
+    the baseline (the lowest recent latency) raises the limit by `1 / limit`,
+    so the limit grows by about one per round of requests. Slower calls mean
+    the server is queueing, they shrink the limit by `latency_backoff`.
+    Failed calls (timeouts, overload replies and 5xx errors left after the
+    retries, open circuit) shrink it by `error_backoff`; other rejections
+    (4xx) leave it unchanged. The limit stays between 1 and `max_limit`.
+
+    Latencies are those of the HTTP round trip alone (rate limit waits and
+    retry backoffs are not counted) divided by the number of texts of the
+    batch, so that batches of different sizes compare.
+
+    `acall` is the asyncio version of `call`; the slots are shared by the
+    threads and the event loops calling the same endpoint.
+    """
+
+    def __init__(
+        self,
+        key,
+        max_limit,
+        latency_tolerance=2.0,
+        latency_backoff=0.9,
+        error_backoff=0.5,
+    ):
+        self.key = key
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.latency_backoff = latency_backoff
+        self.error_backoff = error_backoff
+        self.limit = 1.0
+        self.in_flight = 0
+        self.min_latency = None
+        self._condition = threading.Condition()
+        # (event loop, future) of the coroutines waiting for a slot
+        self._async_waiters = list()
+
+    def acquire(self):
+        """Block until a request slot is free and take it."""
+        with self._condition:
+            while self.in_flight >= max(1, int(self.limit)):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def try_acquire(self):
+        """Take a request slot if one is free, without waiting. Returns
+        whether it was taken.
+        """
+        with self._condition:
+            if self.in_flight >= max(1, int(self.limit)):
+                return False
+            self.in_flight += 1
+            return True
+
+    async def aacquire(self):
+        """Asyncio version of `acquire`, waiting on the event loop."""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                if self.in_flight < max(1, int(self.limit)):
+                    self.in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            await waiter
+
+    def release(self, latency=None, failed=False):
+        """Free a request slot and update the limit with its outcome. Calls
+        with neither a latency nor a failure leave the limit unchanged.
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if failed:
+                self.limit = max(1.0, self.limit * self.error_backoff)
+            elif latency is not None:
+                if self.min_latency is None:
+                    self.min_latency = latency
+                else:
+                    # The baseline drifts up slowly, so that it follows lasting
+                    # changes of the server speed
+                    self.min_latency = min(latency, self.min_latency * 1.001)
+                if latency > self.latency_tolerance * self.min_latency:
+                    self.limit = max(1.0, self.limit * self.latency_backoff)
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+            waiters, self._async_waiters = self._async_waiters, list()
+        for loop, waiter in waiters:
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(_wake_waiter, waiter)
+
+    def call(self, batch_call, batch):
+        """Run `batch_call(batch)` inside a request slot."""
+        self.acquire()
+        _ROUND_TRIP.seconds = None
+        start = time.monotonic()
+        try:
+            result = batch_call(batch)
+        except BaseException as exc:
+            self.release(failed=self._is_failure(exc))
+            raise
+        self._release_success(_ROUND_TRIP.seconds, start, batch)
+        return result
+
+    async def acall(self, batch_call, batch):
+        """Asyncio version of `call`, `batch_call(batch)` is a coroutine."""
+        await self.aacquire()
+        _AROUND_TRIP.set(None)
+        start = time.monotonic()
+        try:
+            result = await batch_call(batch)
+        except BaseException as exc:
+            self.release(failed=self._is_failure(exc))
+            raise
+        self._release_success(_AROUND_TRIP.get(), start, batch)
+        return result
+
+    @staticmethod
+    def _is_failure(exc):
+        """Whether the error of a call means the server is overloaded."""
+        if isinstance(
+            exc,
+            (RetriesExhaustedError, CircuitOpenError) + _RETRY_EXCEPTIONS,
+        ):
+            return True
+        # Server errors mean overload, client errors (including batches too
+        # large) say nothing about the server load
+        return isinstance(exc, EndpointError) and (exc.status_code or 0) >= 500
+
+    def _release_success(self, latency, start, batch):
+        if latency is None:
+            # Not an HTTP call (local model or replayed response)
+            latency = time.monotonic() - start
+        self.release(latency=latency / max(1, len(batch)))
+
+
+def _wake_waiter(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+def _get_concurrency_limiter(key, max_concurrency):
+    """Return the adaptive concurrency limiter shared by all the calls to the
+    endpoint `key`, capped at `max_concurrency`.
+    """
+    limiter = _CONCURRENCY_LIMITERS.get(key)
+    if limiter is None:
+        with _STATS_LOCK:
+            limiter = _CONCURRENCY_LIMITERS.setdefault(
+                key, _AdaptiveLimiter(key, max_concurrency)
+            )
+    limiter.max_limit = max_concurrency
+    return limiter
+
+
+class _RateLimiter:
+    """Token-bucket rate limit shared by every process of the node.
+
+    The buckets (requests per second and texts per second, each holding up to
+    one second of tokens) live in a small file under `rate_limit_dir`, updated
+    under an exclusive `flock`, so all the processes calling the same host
+    draw from the same budget. A caller takes its tokens right away, even if
+    that leaves the bucket in debt, and then sleeps until the debt is paid.
+    Callers are thus served in arrival order, without polling the file.
+    """
+
+    def __init__(
+        self, host, requests_per_second=None, texts_per_second=None, rate_limit_dir=None
+    ):
+        self.host = host
+        self.requests_per_second = requests_per_second
+        self.texts_per_second = texts_per_second
+        digest = hashlib.sha1(host.encode("utf-8")).hexdigest()[:16]
+        self.path = os.path.join(
+            rate_limit_dir or tempfile.gettempdir(), f"a-vert-rate-{digest}.bin"
+        )
+        self._lock = threading.Lock()
+        self._fd = None
+
+    def _reserve(self, n_texts):
+        """Take the tokens of one request of `n_texts` texts and return the
+        time (in seconds) to wait before sending it.
+        """
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            now = time.time()
+            state = os.pread(self._fd, _RATE_LIMIT_STATE.size, 0)
+            if len(state) == _RATE_LIMIT_STATE.size:
+                request_tokens, text_tokens, updated = _RATE_LIMIT_STATE.unpack(state)
+            else:
+                request_tokens, text_tokens, updated = float("inf"), float("inf"), now
+            elapsed = max(0.0, now - updated)
+            delay = 0.0
+            if self.requests_per_second:
+                request_tokens = min(
+                    self.requests_per_second,
+                    request_tokens + elapsed * self.requests_per_second,
+                )
+                request_tokens -= 1
+                delay = max(delay, -request_tokens / self.requests_per_second)
+            if self.texts_per_second:
+                # A request larger than the bucket must still get through
+                capacity = max(self.texts_per_second, n_texts)
+                text_tokens = min(
+                    capacity, text_tokens + elapsed * self.texts_per_second
+                )
+                text_tokens -= n_texts
+                delay = max(delay, -text_tokens / self.texts_per_second)
+            os.pwrite(
+                self._fd,
+                _RATE_LIMIT_STATE.pack(request_tokens, text_tokens, now),
+                0,
+            )
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return delay
+
+    def reserve(self, n_texts=1):
+        """Take the tokens of a request of `n_texts` texts and return the time
+        (in seconds) to wait before sending it.
+        """
+        with self._lock:
+            delay = self._reserve(n_texts)
+        if delay > 0:
+            _increment_stat("rate_limited")
+            _increment_stat("rate_limit_wait", delay)
+        return delay
+
+    def acquire(self, n_texts=1):
+        """Block until a request of `n_texts` texts can be sent."""
+        delay = self.reserve(n_texts)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _get_rate_limiter(
+    url, requests_per_second=None, texts_per_second=None, rate_limit_dir=None
+):
+    """Return the rate limiter of the host of `url`, or None if no rate is set."""
+    if not requests_per_second and not texts_per_second:
+        return None
+    host = _host_of(url)
+    key = (host, rate_limit_dir)
+    limiter = _RATE_LIMITERS.get(key)
+    if limiter is None:
+        with _STATS_LOCK:
+            limiter = _RATE_LIMITERS.setdefault(
+                key,
+                _RateLimiter(
+                    host,
+                    requests_per_second=requests_per_second,
+                    texts_per_second=texts_per_second,
+                    rate_limit_dir=rate_limit_dir,
+                ),
+            )
+    limiter.requests_per_second = requests_per_second
+    limiter.texts_per_second = texts_per_second
+    return limiter
+
+
+def _count_texts(payload):
+    """Number of texts carried by an endpoint request payload."""
+    for field in ("inputs", "input", "texts", "documents"):
+        texts = payload.get(field)
+        if isinstance(texts, list):
+            return len(texts)
+    return 1
+
+
+def _increment_stat(name, value=1):
+    with _STATS_LOCK:
+        _ENDPOINT_STATS[name] += value
+
+
+def get_endpoint_stats():
+    """Return the endpoint call counters (requests, retries, failures, circuit
+    breaker events, hedged requests and wins, ...), the hedge rate, the
+    current state of every circuit breaker, the current adaptive concurrency
+    limit of every endpoint and the load of every replica when an endpoint
+    has several.
+    """
+    with _STATS_LOCK:
+        stats = dict(_ENDPOINT_STATS)
+        stats["circuit_breakers"] = {
+            host: breaker.state for host, breaker in _CIRCUIT_BREAKERS.items()
+        }
+        stats["concurrency_limits"] = {
+            key: limiter.limit for key, limiter in _CONCURRENCY_LIMITERS.items()
+        }
+        pools = list(_REPLICA_POOLS.values())
+    if stats.get("batch_calls"):
+        stats["hedge_rate"] = stats.get("hedged_requests", 0) / stats["batch_calls"]
+    stats["replicas"] = dict()
+    for pool in pools:
+        if len(pool.replicas) > 1:
+            stats["replicas"].update(pool.stats())
+    return stats
+
+
+def reset_endpoint_stats():
+    """Reset the endpoint call counters."""
+    with _STATS_LOCK:
+        _ENDPOINT_STATS.clear()
+
+
+def _json_dumps(payload):
+    """Encode a request payload to JSON bytes, with orjson when installed."""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload).encode("utf-8")
+
+
+def _json_loads(body):
+    """Decode a JSON response body (bytes), with orjson when installed."""
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def _body_text(response_body):
+    """Response body as text, for error messages."""
+    if isinstance(response_body, bytes):
+        return response_body.decode("utf-8", errors="replace")
+    return response_body
+
+
+def _is_payload_too_large(status_code, response_body):
+    """Check whether an error response rejects the size of the request."""
+    if status_code == 413:
+        return True
+    if status_code in _PAYLOAD_TOO_LARGE_STATUS:
+        body = response_body.lower()
+        return any(message in body for message in _PAYLOAD_TOO_LARGE_MESSAGES)
+    return False
+
+
+def _get_session(pool_size=10):
+    """Return a shared `requests.Session` whose connection pool keeps up to
+    `pool_size` connections per host alive, so consecutive calls reuse them.
+    """
+    session = _SESSIONS.get(pool_size)
+    if session is None:
+        with _SESSIONS_LOCK:
+            session = _SESSIONS.get(pool_size)
+            if session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=pool_size, pool_maxsize=pool_size
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _SESSIONS[pool_size] = session
+    return session
+
+
+def _get_retry_after(response):
+    """Return the delay (in seconds) requested by the `Retry-After` header of
+    `response`, or None if it is missing or cannot be parsed.
+    """
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is None:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_date = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_date.timestamp() - time.time())
+
+
+def _backoff_delay(attempt, backoff_base=0.5, backoff_max=30.0, retry_after=None):
+    """Delay before the next attempt: exponential backoff with full jitter, or
+    the server `Retry-After` value when given. Both are capped at `backoff_max`.
+    """
+    if retry_after is not None:
+        return min(retry_after, backoff_max)
+    return random.uniform(0, min(backoff_max, backoff_base * 2 ** (attempt - 1)))
+
+
+def _post_with_retry(
+    url,
+    payload,
+    timeout=20,
+    max_retries=3,
+    pool_size=10,
+    backoff_base=0.5,
+    backoff_max=30.0,
+    breaker_threshold=5,
+    breaker_cooldown=30.0,
+    max_requests_per_second=None,
+    max_texts_per_second=None,
+    rate_limit_dir=None,
+    record_mode=None,
+    record_path=None,
+    **log_context,
+):
+    """POST to `url` with timeout and retry on transient errors.
+
+    Network errors (Timeout/ConnectionError) and overload status codes
+    (429, 502, 503, 504) are retried after an exponential backoff with jitter
+    (see `_backoff_delay`), honoring the `Retry-After` header when present.
+    A circuit breaker per host (see `_CircuitBreaker`) fails fast while the
+    endpoint is down. If `max_requests_per_second` or `max_texts_per_second`
+    are given, every attempt waits for its turn in the rate limit that all
+    the processes of the node share (see `_RateLimiter`).
+
+    The payload is encoded with orjson when installed, and the bytes sent and
+    received are counted in the endpoint stats (see `get_endpoint_stats`).
 
-def _post_with_retry(url, payload, timeout=20, max_retries=3, **log_context):
-    """POST to `url` with timeout and retry on transient network errors.
+    With `record_mode="record"`, the final response is appended to the
+    recording file `record_path`; with `record_mode="replay"`, it is read
+    from that file instead and nothing is sent (see `a_vert.recording`).
 
-    Returns the raw `requests.Response` on HTTP 200. Raises `ValueError` after
-    exhausting retries (on Timeout/ConnectionError) or immediately when the
-    server replies with a non-200 status code.
+    Returns the response body (bytes) on HTTP 200. Raises
+    `RetriesExhaustedError` (a `ValueError`) after exhausting retries, `CircuitOpenError` if the circuit is open, or
+    `EndpointError` (a `ValueError`) immediately when the server replies with
+    a non-retryable non-200 status code. Rejections of the request size raise
+    `PayloadTooLargeError`.
     """
     if max_retries < 1:
         raise ValueError("max_retries must be >= 1")
+    if record_mode == "replay":
+        return _replay_response(url, payload, record_path, **log_context)
     headers = {"Content-Type": "application/json"}
-    last_exc = None
+    session = _get_session(pool_size)
+    breaker = _get_circuit_breaker(url, breaker_threshold, breaker_cooldown)
+    rate_limiter = _get_rate_limiter(
+        url, max_requests_per_second, max_texts_per_second, rate_limit_dir
+    )
+    n_texts = _count_texts(payload)
+    data = _json_dumps(payload)
+    failure = None
     for attempt in range(1, max_retries + 1):
+        trial = breaker.before_request()
         try:
-            response = requests.post(
-                url, data=json.dumps(payload), headers=headers, timeout=timeout
-            )
-            break
+            if rate_limiter is not None:
+                rate_limiter.acquire(n_texts)
+            _count_attempt(attempt, len(data))
+            sent = time.monotonic()
+            response = session.post(url, data=data, headers=headers, timeout=timeout)
         except _RETRY_EXCEPTIONS as exc:
-            last_exc = exc
-            logger.warning(
-                "Endpoint call failed, retrying",
-                attempt=attempt,
-                max_retries=max_retries,
-                url=url,
-                error=str(exc),
-                **log_context,
+            failure = _network_failure(breaker, exc)
+        except BaseException:
+            breaker.trial_failed(trial)
+            raise
+        else:
+            failure = _status_failure(
+                breaker,
+                response.status_code,
+                response.content,
+                _get_retry_after(response),
             )
-    else:
-        logger.error(
-            "Endpoint call failed after all retries",
+            if failure is None:
+                _ROUND_TRIP.seconds = time.monotonic() - sent
+                break
+        delay = _retry_delay(
+            breaker,
+            attempt,
+            failure,
+            url,
             max_retries=max_retries,
-            url=url,
+            backoff_base=backoff_base,
+            backoff_max=backoff_max,
             **log_context,
         )
-        raise ValueError("Failed to call endpoint after retries.") from last_exc
+        if delay is not None:
+            time.sleep(delay)
+    else:
+        _give_up(failure, url, max_retries, **log_context)
 
-    if response.status_code != 200:
-        logger.error(
-            "Endpoint returned non-200 status",
-            status_code=response.status_code,
-            response_body=response.text,
-            url=url,
-            **log_context,
+    _increment_stat("bytes_received", len(response.content))
+    if record_mode == "record":
+        _record_response(
+            url, payload, record_path, response.status_code, response.content
         )
-        raise ValueError("Failed to call endpoint.")
+    _raise_for_status(
+        response.status_code, response.content, url, payload=payload, **log_context
+    )
+    return response.content
+
 
-    return response
+def _replay_response(url, payload, record_path, **log_context):
+    """Serve a request from the recording at `record_path`."""
+    status_code, response_body = recording.get_recording(record_path).replay(
+        url, payload
+    )
+    _increment_stat("replayed")
+    _raise_for_status(status_code, response_body, url, payload=payload, **log_context)
+    return response_body
 
 
-def tei_embedding_call(text, tei_endpoint, timeout=20, max_retries=3):
-    """Calls the Text-Embedding-Inference endpoint and return the embeddings
-    array.
+def _record_response(url, payload, record_path, status_code, response_body):
+    """Append the final response of a request to the recording at
+    `record_path`.
     """
-    payload = {"inputs": text, "truncate": True, "truncation_direction": "Left"}
-    response = _post_with_retry(
-        tei_endpoint + "/embed", payload, timeout=timeout, max_retries=max_retries
+    recording.get_recording(record_path).record(
+        url, payload, status_code, response_body
     )
-    return np.array(json.loads(response.text))
+    _increment_stat("recorded")
 
 
-def vllm_embedding_call(
-    text, vllm_endpoint, vllm_model_name, max_len=-1, timeout=20, max_retries=3
+def _count_attempt(attempt, bytes_sent):
+    _increment_stat("requests")
+    _increment_stat("bytes_sent", bytes_sent)
+    if attempt > 1:
+        _increment_stat("retries")
+
+
+def _network_failure(breaker, exc):
+    """Record a network error, returns the (error, message, retry_after) of
+    the failed attempt.
+    """
+    breaker.record_failure()
+    _increment_stat("network_errors")
+    return exc, str(exc), None
+
+
+def _status_failure(breaker, status_code, response_body, retry_after=None):
+    """Record the status code of a reply. Returns None if it must not be
+    retried, else the (error, message, retry_after) of the failed attempt.
+    Every 5xx reply counts as a failure of the endpoint, only the overload
+    ones are retried.
+    """
+    if status_code not in _RETRY_STATUS:
+        if status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return None
+    # 429 means the server is alive but busy, do not count it as down
+    if status_code == 429:
+        breaker.record_success()
+    else:
+        breaker.record_failure()
+    _increment_stat(f"status_{status_code}")
+    error = EndpointError(
+        "Failed to call endpoint.",
+        status_code=status_code,
+        response_body=_body_text(response_body),
+    )
+    return error, f"HTTP {status_code}", retry_after
+
+
+def _retry_delay(
+    breaker,
+    attempt,
+    failure,
+    url,
+    max_retries=3,
+    backoff_base=0.5,
+    backoff_max=30.0,
+    **log_context,
+):
+    """Return the delay before the next attempt, None after the last one.
+    Raises `CircuitOpenError` if the failure opened the circuit breaker.
+    """
+    last_exc, error, retry_after = failure
+    if breaker.state == "open":
+        # The endpoint is considered down, do not wait for the next attempt
+        _increment_stat("failures")
+        raise CircuitOpenError(
+            f"Circuit breaker open for {breaker.host}, giving up retries."
+        ) from last_exc
+    if attempt >= max_retries:
+        return None
+    delay = _backoff_delay(
+        attempt,
+        backoff_base=backoff_base,
+        backoff_max=backoff_max,
+        retry_after=retry_after,
+    )
+    logger.warning(
+        "Endpoint call failed, retrying",
+        attempt=attempt,
+        max_retries=max_retries,
+        url=url,
+        error=error,
+        delay=round(delay, 3),
+        **log_context,
+    )
+    return delay
+
+
+def _give_up(failure, url, max_retries, **log_context):
+    last_exc = failure[0]
+    _increment_stat("failures")
+    logger.error(
+        "Endpoint call failed after all retries",
+        max_retries=max_retries,
+        url=url,
+        **log_context,
+    )
+    raise RetriesExhaustedError(
+        "Failed to call endpoint after retries.",
+        status_code=getattr(last_exc, "status_code", None),
+        response_body=getattr(last_exc, "response_body", None),
+    ) from last_exc
+
+
+def _raise_for_status(status_code, response_body, url, payload=None, **log_context):
+    """Raise `PayloadTooLargeError` or `EndpointError` on a non-200 reply to
+    the request `payload`.
+    """
+    if status_code == 200:
+        return
+    response_body = _body_text(response_body)
+    error_class = EndpointError
+    if _is_payload_too_large(status_code, response_body):
+        # Handled by splitting the batch, see `_call_with_bisection`, which
+        # logs it once per endpoint
+        log_fn = logger.debug
+        error_class = PayloadTooLargeError
+        _increment_stat("payload_too_large")
+    elif payload is not None and (
+        _rejects_base64(payload, status_code, response_body)
+        or _rejects_dimensions(payload, status_code, response_body)
+    ):
+        # Handled by a fallback request, see `_encoding_fallback` and
+        # `_dimensions_fallback`, which log it once per endpoint
+        log_fn = logger.debug
+    else:
+        log_fn = logger.error
+        _increment_stat("failures")
+    log_fn(
+        "Endpoint returned non-200 status",
+        status_code=status_code,
+        response_body=response_body,
+        url=url,
+        **log_context,
+    )
+    raise error_class(
+        "Failed to call endpoint.",
+        status_code=status_code,
+        response_body=response_body,
+    )
+
+
+def discover_endpoint_limits(endpoint, endpoint_type, model_name=None, timeout=20):
+    """Probe the endpoint for the limits it publishes and return them as a
+    dictionary with (a subset of) the following keys:
+    - `max_batch_size` : Maximum number of texts accepted in one request
+                         (TEI `max_client_batch_size`).
+    - `max_batch_tokens` : Maximum number of tokens the server batches
+                           together (TEI `max_batch_tokens`).
+    - `max_input_length` : Maximum number of tokens of a single input
+                           (TEI `max_input_length`, vLLM `max_model_len`).
+    When the endpoint has several replicas, the smallest limits are returned.
+    Returns an empty dictionary if the endpoint does not publish its limits.
+    """
+    limits = dict()
+    if endpoint_type == "local":
+        return limits
+    for replica in _parse_endpoints(endpoint):
+        replica_limits = _discover_replica_limits(
+            replica, endpoint_type, model_name=model_name, timeout=timeout
+        )
+        for key, value in replica_limits.items():
+            limits[key] = min(value, limits.get(key, value))
+    return limits
+
+
+def _discover_replica_limits(endpoint, endpoint_type, model_name=None, timeout=20):
+    """Probe the limits published by a single replica, see
+    `discover_endpoint_limits`.
+    """
+    session = _get_session()
+    limits = dict()
+    try:
+        if endpoint_type == "tei":
+            response = session.get(endpoint + "/info", timeout=timeout)
+            response.raise_for_status()
+            info = json.loads(response.text)
+            for info_key, limit_key in (
+                ("max_client_batch_size", "max_batch_size"),
+                ("max_batch_tokens", "max_batch_tokens"),
+                ("max_input_length", "max_input_length"),
+            ):
+                if info.get(info_key) is not None:
+                    limits[limit_key] = int(info[info_key])
+        elif endpoint_type == "vllm" or endpoint_type == "openai":
+            response = session.get(endpoint + "/v1/models", timeout=timeout)
+            response.raise_for_status()
+            models = json.loads(response.text).get("data", [])
+            for model in models:
+                if model.get("id") == model_name and model.get("max_model_len"):
+                    limits["max_input_length"] = int(model["max_model_len"])
+        else:
+            raise ValueError("Endpoint type not supported")
+    except (requests.exceptions.RequestException, json.JSONDecodeError) as exc:
+        logger.warning(
+            "Could not discover endpoint limits",
+            endpoint=endpoint,
+            endpoint_type=endpoint_type,
+            error=str(exc),
+        )
+        return dict()
+
+    logger.info(
+        "Discovered endpoint limits",
+        endpoint=endpoint,
+        endpoint_type=endpoint_type,
+        **limits,
+    )
+    return limits
+
+
+def _apply_endpoint_limits(max_batch_size, max_len, max_batch_tokens, endpoint_limits):
+    """Clip the batch size, the truncation length and the batch token budget
+    to the endpoint limits.
+    """
+    if endpoint_limits:
+        if endpoint_limits.get("max_batch_size"):
+            max_batch_size = min(max_batch_size, endpoint_limits["max_batch_size"])
+        if endpoint_limits.get("max_input_length"):
+            if max_len is None or max_len < 0:
+                max_len = endpoint_limits["max_input_length"]
+            else:
+                max_len = min(max_len, endpoint_limits["max_input_length"])
+        if endpoint_limits.get("max_batch_tokens"):
+            if not max_batch_tokens:
+                max_batch_tokens = endpoint_limits["max_batch_tokens"]
+            else:
+                max_batch_tokens = min(
+                    max_batch_tokens, endpoint_limits["max_batch_tokens"]
+                )
+    return max_batch_size, max_len, max_batch_tokens
+
+
+# Endpoint requests are described by their URL, JSON payload, parser of the
+# response body and log context, shared by the blocking and asyncio APIs
+
+
+def _normalize_embeddings(embeddings):
+    """Scale the rows of `embeddings` to unit norm, in place."""
+    norms = np.sqrt(np.einsum("...i,...i->...", embeddings, embeddings))
+    norms[norms == 0] = 1
+    embeddings /= norms[..., None]
+
+
+def _truncate_embeddings(embeddings, dimensions):
+    """Keep the first `dimensions` of the (Matryoshka) `embeddings` and scale
+    them back to unit norm. Embeddings that already have `dimensions` are
+    returned as they are.
+    """
+    if dimensions is None or embeddings.shape[-1] == dimensions:
+        return embeddings
+    if embeddings.shape[-1] < dimensions:
+        raise ValueError(
+            f"Requested {dimensions} embedding dimensions, but the endpoint "
+            f"returns {embeddings.shape[-1]}."
+        )
+    embeddings = np.ascontiguousarray(embeddings[..., :dimensions])
+    _normalize_embeddings(embeddings)
+    return embeddings
+
+
+def _tei_embedding_request(text, tei_endpoint, dtype="float32", dimensions=None):
+    payload = {"inputs": text, "truncate": True, "truncation_direction": "Left"}
+
+    def parse(body):
+        embeddings = np.array(_json_loads(body), dtype=dtype)
+        return _truncate_embeddings(embeddings, dimensions)
+
+    return tei_endpoint + "/embed", payload, parse, dict()
+
+
+def _decode_embedding(embedding):
+    """Decode an OpenAI-style embedding, given either as a list of floats or
+    as the base64 string of its little-endian float32 values.
+    """
+    if isinstance(embedding, str):
+        return np.frombuffer(base64.b64decode(embedding), dtype="<f4")
+    return embedding
+
+
+def _vllm_embedding_request(
+    text,
+    vllm_endpoint,
+    vllm_model_name,
+    max_len=-1,
+    encoding_format="float",
+    dtype="float32",
+    dimensions=None,
 ):
-    """Calls the vLLM endpoint and return the embeddings array."""
+    url = vllm_endpoint + "/v1/embeddings"
+    if url in _FLOAT_ENCODING_URLS:
+        encoding_format = "float"
     payload = {
         "input": text,
         "model": vllm_model_name,
-        "encoding_format": "float",
+        "encoding_format": encoding_format,
         "truncate_prompt_tokens": max_len,
     }
-    response = _post_with_retry(
-        vllm_endpoint + "/v1/embeddings",
-        payload,
+    if dimensions is not None and url not in _FULL_DIMENSIONS_URLS:
+        payload["dimensions"] = dimensions
+
+    def parse(body):
+        data = _json_loads(body)["data"]
+        first = _decode_embedding(data[0]["embedding"])
+        # Full size embeddings are truncated while they are copied in
+        width = len(first) if dimensions is None else min(len(first), dimensions)
+        embeddings = np.empty((len(data), width), dtype=dtype)
+        embeddings[0] = first[:width]
+        for idx in range(1, len(data)):
+            embeddings[idx] = _decode_embedding(data[idx]["embedding"])[:width]
+        if width < len(first):
+            _normalize_embeddings(embeddings)
+        return _truncate_embeddings(embeddings, dimensions)
+
+    log_context = dict(model=vllm_model_name)
+    return url, payload, parse, log_context
+
+
+def _rejects_base64(payload, status_code, response_body):
+    """Whether the reply rejects the base64 encoding of the request."""
+    if payload.get("encoding_format") != "base64":
+        return False
+    if status_code not in (400, 422) or response_body is None:
+        return False
+    body = response_body.lower()
+    return "base64" in body or "encoding_format" in body
+
+
+def _rejects_dimensions(payload, status_code, response_body):
+    """Whether the reply rejects the reduced dimensions of the request."""
+    if "dimensions" not in payload:
+        return False
+    if status_code not in (400, 422) or response_body is None:
+        return False
+    body = response_body.lower()
+    return "dimension" in body or "matryoshka" in body
+
+
+def _encoding_fallback(request, exc):
+    """If the endpoint rejected a base64 embedding request, remember it and
+    return the same request asking for floats. Returns None otherwise.
+    """
+    url, payload, parse, log_context = request
+    if not _rejects_base64(payload, exc.status_code, exc.response_body):
+        return None
+    if url not in _FLOAT_ENCODING_URLS:
+        logger.warning(
+            "Endpoint does not support base64 embeddings, falling back to floats",
+            url=url,
+        )
+    _FLOAT_ENCODING_URLS.add(url)
+    payload = dict(payload, encoding_format="float")
+    return url, payload, parse, log_context
+
+
+def _dimensions_fallback(request, exc):
+    """If the endpoint rejected reduced embedding dimensions (e.g. the model
+    is not a Matryoshka model), remember it and return the same request for
+    the full embeddings, which the parser truncates. Returns None otherwise.
+    """
+    url, payload, parse, log_context = request
+    if not _rejects_dimensions(payload, exc.status_code, exc.response_body):
+        return None
+    if url not in _FULL_DIMENSIONS_URLS:
+        logger.warning(
+            "Endpoint does not support reduced dimensions, truncating on the client",
+            url=url,
+            dimensions=payload["dimensions"],
+        )
+    _FULL_DIMENSIONS_URLS.add(url)
+    payload = {key: value for key, value in payload.items() if key != "dimensions"}
+    return url, payload, parse, log_context
+
+
+def _parse_rerank_results(
+    results, query, targets, response, score_key="score", dtype="float32"
+):
+    """Return the scores of the rerank `results` in the order of `targets`."""
+    total_ranks = len(results)
+    if total_ranks != len(targets):
+        logger.error(
+            "Mismatch between response and target count",
+            query=query,
+            num_targets=len(targets),
+            num_responses=total_ranks,
+            targets=targets,
+            response=response,
+        )
+        raise ValueError(
+            "Received less scores than targets from endpoint, cannot continue."
+        )
+
+    # Scores in the order of the targets, read straight into the output array
+    ranked = sorted(results, key=operator.itemgetter("index"))
+    if any(result["index"] != idx for idx, result in enumerate(ranked)):
+        raise ValueError("Endpoint returned invalid rerank result indexes.")
+    return np.fromiter(
+        (result[score_key] for result in ranked), dtype=dtype, count=total_ranks
+    )
+
+
+def _tei_rerank_request(query, targets, tei_rerank_endpoint, dtype="float32"):
+    payload = {
+        "query": query,
+        "texts": targets,
+        "truncate": True,
+        "truncation_direction": "Left",
+        # Do not echo the targets back in the response
+        "return_text": False,
+    }
+
+    def parse(body):
+        response = _json_loads(body)
+        return _parse_rerank_results(response, query, targets, response, dtype=dtype)
+
+    return tei_rerank_endpoint + "/rerank", payload, parse, dict()
+
+
+def _vllm_rerank_request(
+    query, targets, vllm_rerank_endpoint, vllm_model_name, max_len=-1, dtype="float32"
+):
+    payload = {
+        "query": query,
+        "documents": targets,
+        "model": vllm_model_name,
+        "truncate_prompt_tokens": max_len,
+        # Do not echo the documents back in the results
+        "return_documents": False,
+    }
+
+    def parse(body):
+        response = _json_loads(body)
+        return _parse_rerank_results(
+            response["results"],
+            query,
+            targets,
+            response,
+            score_key="relevance_score",
+            dtype=dtype,
+        )
+
+    log_context = dict(model=vllm_model_name)
+    return vllm_rerank_endpoint + "/v1/rerank", payload, parse, log_context
+
+
+def _check_endpoint_type(endpoint_type, model_name=None):
+    if endpoint_type in ("vllm", "openai"):
+        if model_name is None:
+            raise ValueError("Model name is required for vllm/openai endpoint.")
+    elif endpoint_type not in ("tei", "local"):
+        raise ValueError("Endpoint type not supported")
+
+
+def _embedding_request(
+    text,
+    replica,
+    endpoint_type,
+    model_name=None,
+    max_len=-1,
+    encoding_format="float",
+    dtype="float32",
+    dimensions=None,
+):
+    if endpoint_type == "tei":
+        return _tei_embedding_request(text, replica, dtype=dtype, dimensions=dimensions)
+    return _vllm_embedding_request(
+        text,
+        replica,
+        model_name,
+        max_len=max_len,
+        encoding_format=encoding_format,
+        dtype=dtype,
+        dimensions=dimensions,
+    )
+
+
+def _rerank_request(
+    query, targets, replica, endpoint_type, model_name=None, max_len=-1, dtype="float32"
+):
+    if endpoint_type == "tei":
+        return _tei_rerank_request(query, targets, replica, dtype=dtype)
+    return _vllm_rerank_request(
+        query, targets, replica, model_name, max_len=max_len, dtype=dtype
+    )
+
+
+def _local_embedding_call(
+    text, model_name, backend="torch", max_len=-1, dtype="float32", dimensions=None
+):
+    """Embed `text` with the in-process model `model_name` (see
+    `a_vert.local_backend`), with the same results as the endpoint calls.
+    """
+    embeddings = local_models.local_embedding_call(
+        text, model_name, backend=backend, max_len=max_len
+    )
+    return _truncate_embeddings(embeddings.astype(dtype, copy=False), dimensions)
+
+
+def _local_rerank_call(
+    query, targets, model_name, backend="torch", max_len=-1, dtype="float32"
+):
+    """Rerank `targets` with the in-process model `model_name` (see
+    `a_vert.local_backend`), with the same results as the endpoint calls.
+    """
+    scores = local_models.local_rerank_call(
+        query, targets, model_name, backend=backend, max_len=max_len
+    )
+    return scores.astype(dtype, copy=False)
+
+
+def _endpoint_call(request, timeout=20, max_retries=3, **post_kwargs):
+    """Send an endpoint `request` (see `_tei_embedding_request`) and parse the
+    response. Additional keyword arguments are forwarded to `_post_with_retry`.
+    """
+    url, payload, parse, log_context = request
+    try:
+        response_body = _post_with_retry(
+            url,
+            payload,
+            timeout=timeout,
+            max_retries=max_retries,
+            **log_context,
+            **post_kwargs,
+        )
+    except EndpointError as exc:
+        fallback = _encoding_fallback(request, exc) or _dimensions_fallback(
+            request, exc
+        )
+        if fallback is None:
+            raise
+        return _endpoint_call(
+            fallback, timeout=timeout, max_retries=max_retries, **post_kwargs
+        )
+    return parse(response_body)
+
+
+def tei_embedding_call(
+    text,
+    tei_endpoint,
+    timeout=20,
+    max_retries=3,
+    dtype="float32",
+    dimensions=None,
+    **post_kwargs,
+):
+    """Calls the Text-Embedding-Inference endpoint and return the embeddings
+    array, of type `dtype`. If `dimensions` is given, the embeddings are
+    truncated to it and re-normalized. Additional keyword arguments are
+    forwarded to `_post_with_retry`.
+    """
+    return _endpoint_call(
+        _tei_embedding_request(text, tei_endpoint, dtype=dtype, dimensions=dimensions),
+        timeout=timeout,
+        max_retries=max_retries,
+        **post_kwargs,
+    )
+
+
+def vllm_embedding_call(
+    text,
+    vllm_endpoint,
+    vllm_model_name,
+    max_len=-1,
+    timeout=20,
+    max_retries=3,
+    encoding_format="float",
+    dtype="float32",
+    dimensions=None,
+    **post_kwargs,
+):
+    """Calls the vLLM endpoint and return the embeddings array, of type
+    `dtype`. Embeddings are requested as JSON floats, or as base64 (float32
+    bytes decoded with `np.frombuffer`) if `encoding_format` is "base64",
+    falling back to floats if the endpoint does not support base64. If
+    `dimensions` is given, reduced (Matryoshka) embeddings are requested, and
+    full embeddings are truncated and re-normalized if the endpoint does not
+    support them.
+    Additional keyword arguments are forwarded to `_post_with_retry`.
+    """
+    return _endpoint_call(
+        _vllm_embedding_request(
+            text,
+            vllm_endpoint,
+            vllm_model_name,
+            max_len,
+            encoding_format,
+            dtype,
+            dimensions,
+        ),
+        timeout=timeout,
+        max_retries=max_retries,
+        **post_kwargs,
+    )
+
+
+def estimate_tokens(text, chars_per_token=4.0, max_len=-1):
+    """Cheap estimate of the number of tokens of `text`, without a tokenizer.
+    Two tokens are added for the special tokens of the sequence, and the
+    estimate is clipped to `max_len` when truncation applies.
+    """
+    n_tokens = int(len(text) / chars_per_token) + 2
+    if max_len is not None and max_len > 0:
+        n_tokens = min(n_tokens, max_len)
+    return n_tokens
+
+
+def _empty_embeddings(dtype="float32", dimensions=None):
+    """Result of embedding an empty list. The embedding size is only known
+    from the endpoint, so it is `dimensions` if given, and 0 otherwise.
+    """
+    return np.empty((0, dimensions or 0), dtype=dtype)
+
+
+def _split_in_batches(
+    items,
+    max_batch_size,
+    max_batch_tokens=None,
+    query_tokens=0,
+    chars_per_token=4.0,
+    max_len=-1,
+):
+    """Split a list into consecutive chunks of at most `max_batch_size` items.
+    If `max_batch_tokens` is given, chunks are also packed so that their
+    estimated token count stays within that budget. Each item is charged
+    `query_tokens` extra tokens (the query is sent along every rerank pair).
+    An item larger than the budget is sent alone.
+    """
+    if not max_batch_tokens:
+        return [
+            items[start : start + max_batch_size]
+            for start in range(0, len(items), max_batch_size)
+        ]
+
+    batches = list()
+    current = list()
+    current_tokens = 0
+    for item in items:
+        item_tokens = query_tokens + estimate_tokens(
+            item, chars_per_token=chars_per_token
+        )
+        if max_len is not None and max_len > 0:
+            item_tokens = min(item_tokens, max_len)
+        if current and (
+            len(current) >= max_batch_size
+            or current_tokens + item_tokens > max_batch_tokens
+        ):
+            batches.append(current)
+            current = list()
+            current_tokens = 0
+        current.append(item)
+        current_tokens += item_tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _length_order(items, chars_per_token=4.0):
+    """Return the indexes that sort `items` by estimated token length."""
+    lengths = [estimate_tokens(item, chars_per_token=chars_per_token) for item in items]
+    return np.argsort(lengths, kind="stable")
+
+
+def _restore_order(sorted_results, order):
+    """Undo the permutation applied by `_length_order` on the results array."""
+    results = np.empty_like(sorted_results)
+    results[order] = sorted_results
+    return results
+
+
+def _prepare_batches(
+    items,
+    max_batch_size,
+    max_batch_tokens=None,
+    query_tokens=0,
+    chars_per_token=4.0,
+    max_len=-1,
+    sort_by_length=False,
+):
+    """Split `items` in batches (see `_split_in_batches`), sorting them by length
+    first if `sort_by_length` is set. Returns the batches and the sorting
+    order to undo with `_restore_order` (None if not sorted).
+    """
+    order = None
+    if sort_by_length:
+        order = _length_order(items, chars_per_token=chars_per_token)
+        items = [items[idx] for idx in order]
+    batches = _split_in_batches(
+        items,
+        max_batch_size,
+        max_batch_tokens=max_batch_tokens,
+        query_tokens=query_tokens,
+        chars_per_token=chars_per_token,
+        max_len=max_len,
+    )
+    return batches, order
+
+
+def _get_batch_size_limit(limit_key, max_batch_size):
+    """Clip `max_batch_size` to the largest batch size that worked on this
+    endpoint after a rejection, if any.
+    """
+    bounds = _BATCH_SIZE_LIMITS.get(limit_key)
+    if bounds is not None:
+        worked, rejected = bounds
+        return min(max_batch_size, worked or rejected - 1)
+    return max_batch_size
+
+
+def _split_rejected_batch(batch, limit_key=None):
+    """Return the size of the parts to split a batch rejected as too large in.
+
+    The parts are halfway between the largest batch size that worked on
+    `limit_key` and the smallest one rejected, so that the limit of the
+    endpoint is found by binary search. If a batch smaller than one that
+    worked is rejected, its texts are too long: it is split in half, and the
+    known sizes are kept.
+    """
+    size = len(batch)
+    with _BATCH_SIZE_LIMITS_LOCK:
+        bounds = _BATCH_SIZE_LIMITS.get(limit_key)
+        worked, rejected = bounds or (0, size)
+        if worked < size:
+            rejected = min(rejected, size)
+            if limit_key is not None:
+                _BATCH_SIZE_LIMITS[limit_key] = (worked, rejected)
+        else:
+            worked, rejected = 0, size
+    # Warn about the first rejection of an endpoint only
+    log = logger.warning if bounds is None else logger.debug
+    log(
+        "Endpoint rejected batch as too large, splitting it",
+        batch_size=size,
+        endpoint=limit_key,
+    )
+    _increment_stat("bisections")
+    return min((worked + rejected + 1) // 2, rejected - 1)
+
+
+def _remember_batch_size(limit_key, size):
+    """Record that a batch of `size` texts worked on `limit_key`, once the
+    endpoint rejected a larger one.
+    """
+    bounds = _BATCH_SIZE_LIMITS.get(limit_key)
+    if bounds is None or size <= bounds[0]:
+        return
+    with _BATCH_SIZE_LIMITS_LOCK:
+        worked, rejected = _BATCH_SIZE_LIMITS[limit_key]
+        if worked < size < rejected:
+            _BATCH_SIZE_LIMITS[limit_key] = (size, rejected)
+
+
+def _call_with_bisection(batch_call, batch, limit_key=None):
+    """Call `batch_call` on `batch`. If the endpoint rejects the batch as too
+    large, split it (see `_split_rejected_batch`) and retry each part
+    recursively, down to single texts. The largest size that worked after a
+    rejection is remembered for `limit_key` and used to split later requests.
+    """
+    try:
+        result = batch_call(batch)
+    except PayloadTooLargeError:
+        if len(batch) <= 1:
+            raise
+    else:
+        _remember_batch_size(limit_key, len(batch))
+        return result
+    part = _split_rejected_batch(batch, limit_key=limit_key)
+    return np.concatenate(
+        [
+            _call_with_bisection(
+                batch_call, batch[start : start + part], limit_key=limit_key
+            )
+            for start in range(0, len(batch), part)
+        ],
+        axis=0,
+    )
+
+
+class _ResultBuffer:
+    """Output array of a batched call, allocated once (with the shape and type
+    of the first batch result) and filled in place batch by batch, instead of
+    concatenating the batch results at the end.
+    """
+
+    def __init__(self, batches):
+        self.offsets = np.cumsum([0] + [len(batch) for batch in batches])
+        self.array = None
+
+    def write(self, idx, result):
+        if self.array is None:
+            self.array = np.empty(
+                (self.offsets[-1],) + result.shape[1:], dtype=result.dtype
+            )
+        self.array[self.offsets[idx] : self.offsets[idx + 1]] = result
+
+
+def _run_batches(batch_call, batches, max_concurrency=1, limit_key=None, limiter=None):
+    """Apply `batch_call` to every batch, keeping at most `max_concurrency`
+    requests in flight, and concatenate the results in the original order.
+    Batches rejected as too large are split (see `_call_with_bisection`).
+    If a `limiter` (see `_AdaptiveLimiter`) is given, it decides how many of
+    those requests are actually sent at the same time.
+    """
+    if limiter is not None:
+        unlimited_call = batch_call
+
+        def batch_call(batch):
+            return limiter.call(unlimited_call, batch)
+
+    def bisecting_call(batch):
+        return _call_with_bisection(batch_call, batch, limit_key=limit_key)
+
+    if len(batches) == 1:
+        return bisecting_call(batches[0])
+    results = _ResultBuffer(batches)
+    if max_concurrency <= 1:
+        for idx, batch in enumerate(batches):
+            results.write(idx, bisecting_call(batch))
+    else:
+        with ThreadPoolExecutor(
+            max_workers=min(max_concurrency, len(batches))
+        ) as executor:
+            for idx, result in enumerate(executor.map(bisecting_call, batches)):
+                results.write(idx, result)
+    return results.array
+
+
+def get_embedding(
+    text,
+    endpoint,
+    endpoint_type,
+    model_name=None,
+    max_batch_size=32,
+    timeout=20,
+    max_retries=3,
+    max_concurrency=1,
+    pool_size=10,
+    max_len=-1,
+    endpoint_limits=None,
+    max_batch_tokens=None,
+    chars_per_token=4.0,
+    sort_by_length=False,
+    health_check_interval=10.0,
+    hedge_percentile=None,
+    adaptive_concurrency=False,
+    encoding_format="float",
+    dtype="float32",
+    dimensions=None,
+    local_backend="torch",
+    **post_kwargs,
+):
+    """Call the Text-Embedding-Inference endpoint handling the endpoint batch
+    size. `endpoint` can be a list (or comma-separated string) of replicas
+    serving the same model, each batch is then routed to the least loaded one
+    (see `_ReplicaPool`). If `hedge_percentile` is given, batches slower than
+    that percentile of the recent latencies are sent again, and the first
+    response wins. If `adaptive_concurrency` is set, the number of batches in
+    flight is adjusted between 1 and `max_concurrency` from the observed
+    latencies and errors (see `_AdaptiveLimiter`).
+    If `max_batch_tokens` is given, batches are packed by estimated token
+    length (see `estimate_tokens`) so they do not exceed that budget.
+    If `sort_by_length` is set, texts are sorted by length before batching,
+    so that the server pads less, and the output is returned in input order.
+    An empty list returns an empty array without calling the endpoint (see
+    `_empty_embeddings`).
+    Additional keyword arguments (backoff and circuit breaker settings) are
+    forwarded to `_post_with_retry`.
+    If `endpoint_limits` (see `discover_endpoint_limits`) are given, the batch
+    size, truncation length and token budget are clipped to them.
+    vLLM/OpenAI embeddings are transferred as floats unless `encoding_format`
+    is "base64" (see `vllm_embedding_call`). Embeddings are returned as an
+    array of type `dtype`, reduced to `dimensions` if given (requested from
+    vLLM/OpenAI endpoints, truncated and re-normalized otherwise).
+    With the "local" `endpoint_type`, `endpoint` is the model run in-process
+    with the `local_backend` ("torch" or "onnx"), see `a_vert.local_backend`.
+    """
+    max_batch_size, max_len, max_batch_tokens = _apply_endpoint_limits(
+        max_batch_size, max_len, max_batch_tokens, endpoint_limits
+    )
+    _check_endpoint_type(endpoint_type, model_name)
+    if isinstance(text, list) and not text:
+        return _empty_embeddings(dtype, dimensions)
+    post_kwargs.update(timeout=timeout, max_retries=max_retries, pool_size=pool_size)
+    if endpoint_type == "local":
+        key = endpoint
+
+        def embedding_call(x):
+            return _local_embedding_call(
+                x, endpoint, local_backend, max_len, dtype, dimensions
+            )
+
+    else:
+        replicas = _get_replica_pool(endpoint, health_check_interval)
+        key = replicas.key
+
+        # Assign endpoint call
+        def embedding_call(x):
+            return replicas.call(
+                lambda replica: _endpoint_call(
+                    _embedding_request(
+                        x,
+                        replica,
+                        endpoint_type,
+                        model_name,
+                        max_len,
+                        encoding_format,
+                        dtype,
+                        dimensions,
+                    ),
+                    **post_kwargs,
+                ),
+                hedge_percentile=hedge_percentile,
+                limiter=limiter,
+            )
+
+    limiter = None
+    if isinstance(text, list) and adaptive_concurrency and max_concurrency > 1:
+        limiter = _get_concurrency_limiter(key, max_concurrency)
+    # Calculate embeddings for the text list
+    if isinstance(text, list):
+        limit_key = (key, "embedding")
+        batches, order = _prepare_batches(
+            text,
+            _get_batch_size_limit(limit_key, max_batch_size),
+            max_batch_tokens=max_batch_tokens,
+            chars_per_token=chars_per_token,
+            max_len=max_len,
+            sort_by_length=sort_by_length,
+        )
+        embeddings = _run_batches(
+            embedding_call,
+            batches,
+            max_concurrency=max_concurrency,
+            limit_key=limit_key,
+            limiter=limiter,
+        )
+        if order is not None:
+            embeddings = _restore_order(embeddings, order)
+        return embeddings
+    else:
+        return embedding_call(text)
+
+
+def check_and_apply_template(template, placeholder, text):
+    """
+    Apply a template to a text, replacing a placeholder.
+    If the template is None, returns the original text.
+    """
+    if template is not None:
+        # Check if the template contains the string to replace
+        if placeholder not in template:
+            err = f"Template must contain a {placeholder} placeholder. Template: '{template}'"
+            raise ValueError(err)
+        # Replace
+        prompt = template.replace(placeholder, text)
+    else:
+        prompt = text
+
+    return prompt
+
+
+def calculate_embedding_distances(
+    model_response,
+    batch,
+    endpoint,
+    endpoint_type,
+    model_name=None,
+    query_template=None,
+    document_template=None,
+    distance_fn=spatial.distance.cosine,
+    batch_size=32,
+    embedding_store=None,
+    groups=None,
+    rescore_top_k=4,
+    **request_kwargs,
+):
+    """Score the model response against every target by embedding similarity.
+    If an `embedding_store` (see `a_vert.embedding_store`) is given, targets
+    found in it are scored on their quantized embeddings, and only the
+    missing targets and the `rescore_top_k` best stored targets of each of
+    the `groups` (list of (start, end) ranges of `batch`, the whole batch by
+    default) are embedded to get their exact scores. The best target of a
+    group is rescored until it has an exact score, so the maximum of every
+    group is exact; the scores of the other stored targets are approximate.
+    Additional keyword arguments are forwarded to `get_embedding`.
+    """
+    batch_to_embedding = [
+        check_and_apply_template(document_template, "{document}", t) for t in batch
+    ]
+    if embedding_store is None:
+        # Calculate targets embeddings
+        targets_embeddings = get_embedding(
+            batch_to_embedding,
+            endpoint,
+            endpoint_type,
+            model_name=model_name,
+            max_batch_size=batch_size,
+            **request_kwargs,
+        )
+    # Get model response embedding
+    model_response_to_embedding = check_and_apply_template(
+        query_template, "{query}", model_response
+    )
+    model_response_embedding = np.squeeze(
+        get_embedding(
+            model_response_to_embedding,
+            endpoint,
+            endpoint_type,
+            model_name=model_name,
+            max_batch_size=batch_size,
+            **request_kwargs,
+        )
+    )
+    if embedding_store is None:
+        return _embedding_similarities(
+            model_response_embedding, targets_embeddings, distance_fn
+        )
+
+    similarities, fetch, missing = _stored_similarities(
+        model_response_embedding,
+        batch_to_embedding,
+        embedding_store,
+        groups,
+        rescore_top_k,
+        distance_fn,
+    )
+    exact = np.zeros(len(batch_to_embedding), dtype=bool)
+    while len(fetch):
+        fetched_embeddings = get_embedding(
+            [batch_to_embedding[idx] for idx in fetch],
+            endpoint,
+            endpoint_type,
+            model_name=model_name,
+            max_batch_size=batch_size,
+            **request_kwargs,
+        )
+        _rescore_similarities(
+            similarities,
+            model_response_embedding,
+            batch_to_embedding,
+            fetch,
+            missing,
+            fetched_embeddings,
+            embedding_store,
+            distance_fn,
+        )
+        exact[fetch] = True
+        fetch = _approximate_winners(similarities, exact, groups)
+    return similarities
+
+
+def calculate_embedding_distances_batch(
+    model_responses,
+    batches,
+    endpoint,
+    endpoint_type,
+    model_name=None,
+    query_templates=None,
+    document_templates=None,
+    distance_fn=spatial.distance.cosine,
+    batch_size=32,
+    embedding_cache=None,
+    **request_kwargs,
+):
+    """Batched `calculate_embedding_distances`: score every model response
+    against its own targets (`batches[i]`) with a single `get_embedding` call
+    for the unique texts of all of them, so candidates shared by several
+    responses are embedded once. `query_templates` and `document_templates`
+    hold the templates of every response (all None by default).
+    If an `embedding_cache` is given (any object with `get(text)`, returning
+    None for missing texts, and `put(text, embedding)`), only the texts
+    missing from it are embedded, and then added to it.
+    Returns the similarities of every response.
+    Additional keyword arguments are forwarded to `get_embedding`.
+    """
+    n_responses = len(model_responses)
+    query_templates = query_templates or [None] * n_responses
+    document_templates = document_templates or [None] * n_responses
+    queries = [
+        check_and_apply_template(template, "{query}", response)
+        for template, response in zip(query_templates, model_responses)
+    ]
+    documents = [
+        [check_and_apply_template(template, "{document}", t) for t in batch]
+        for template, batch in zip(document_templates, batches)
+    ]
+    unique_texts = dict.fromkeys(queries)
+    for texts in documents:
+        unique_texts.update(dict.fromkeys(texts))
+
+    embeddings = dict()
+    if embedding_cache is not None:
+        for text in unique_texts:
+            embedding = embedding_cache.get(text)
+            if embedding is not None:
+                embeddings[text] = embedding
+    missing = [text for text in unique_texts if text not in embeddings]
+    if missing:
+        fetched_embeddings = get_embedding(
+            missing,
+            endpoint,
+            endpoint_type,
+            model_name=model_name,
+            max_batch_size=batch_size,
+            **request_kwargs,
+        )
+        for text, embedding in zip(missing, fetched_embeddings):
+            embeddings[text] = embedding
+            if embedding_cache is not None:
+                embedding_cache.put(text, embedding)
+
+    return [
+        _embedding_similarities(
+            embeddings[query], np.stack([embeddings[t] for t in texts]), distance_fn
+        )
+        for query, texts in zip(queries, documents)
+    ]
+
+
+def _stored_similarities(
+    model_response_embedding, texts, store, groups, rescore_top_k, distance_fn
+):
+    """Approximate similarities of the `texts` found in the `store`. Returns
+    the similarities (undefined for missing texts), the indexes of the texts
+    to embed (the missing ones and the `rescore_top_k` best stored texts of
+    every group) and a mask of the missing texts.
+    """
+    rows = store.lookup(texts)
+    missing = rows < 0
+    stored = np.flatnonzero(~missing)
+    similarities = np.zeros(len(texts), dtype=model_response_embedding.dtype)
+    if len(stored):
+        similarities[stored] = _embedding_similarities(
+            model_response_embedding,
+            store.get(rows[stored]).astype(model_response_embedding.dtype),
+            distance_fn,
+        )
+    fetch = missing.copy()
+    for start, end in groups or [(0, len(texts))]:
+        group_stored = stored[(stored >= start) & (stored < end)]
+        # The best stored target is always rescored, see `_approximate_winners`
+        best = np.argsort(similarities[group_stored])[::-1][: max(rescore_top_k, 1)]
+        fetch[group_stored[best]] = True
+    _increment_stat("store_hits", len(stored))
+    _increment_stat("store_misses", int(missing.sum()))
+    _increment_stat("store_rescored", int(fetch.sum() - missing.sum()))
+    return similarities, np.flatnonzero(fetch), missing
+
+
+def _approximate_winners(similarities, exact, groups):
+    """Indexes of the best candidates of the `groups` whose similarity is
+    still approximate (not in the `exact` mask), to be rescored.
+    """
+    winners = [
+        start + int(np.argmax(similarities[start:end]))
+        for start, end in groups or [(0, len(similarities))]
+        if end > start
+    ]
+    return np.array([idx for idx in winners if not exact[idx]], dtype=np.intp)
+
+
+def _rescore_similarities(
+    similarities,
+    model_response_embedding,
+    texts,
+    fetch,
+    missing,
+    fetched_embeddings,
+    store,
+    distance_fn,
+):
+    """Write the exact similarities of the `fetch` texts, whose embeddings
+    were fetched, and add the missing ones to the `store`.
+    """
+    similarities[fetch] = _embedding_similarities(
+        model_response_embedding, fetched_embeddings, distance_fn
+    )
+    new = missing[fetch]
+    store.add([texts[idx] for idx in fetch[new]], fetched_embeddings[new])
+
+
+def _embedding_similarities(model_response_embedding, targets_embeddings, distance_fn):
+    """Similarity (one minus the distance) of the response to every target, as
+    an array of the type of the embeddings. The cosine distance is computed
+    for all the targets at once.
+    """
+    if distance_fn is spatial.distance.cosine:
+        similarities = targets_embeddings @ model_response_embedding
+        # Row norms without a temporary copy of the embeddings
+        similarities /= np.sqrt(
+            np.einsum("ij,ij->i", targets_embeddings, targets_embeddings)
+        )
+        similarities /= np.linalg.norm(model_response_embedding)
+        # Same range as `spatial.distance.cosine`
+        return np.clip(similarities, -1.0, 1.0, out=similarities)
+    similarities = np.empty(len(targets_embeddings), dtype=targets_embeddings.dtype)
+    for idx, this_emb in enumerate(targets_embeddings):
+        similarities[idx] = 1 - distance_fn(model_response_embedding, this_emb)
+    return similarities
+
+
+def tei_rerank_call(
+    query,
+    targets,
+    tei_rerank_endpoint,
+    timeout=20,
+    max_retries=3,
+    dtype="float32",
+    **post_kwargs,
+):
+    """Calls the TEI endpoint and return the ranking scores as an array of type
+    `dtype`, in the same order as they were provided. Additional keyword
+    arguments are forwarded to `_post_with_retry`.
+    """
+    return _endpoint_call(
+        _tei_rerank_request(query, targets, tei_rerank_endpoint, dtype=dtype),
+        timeout=timeout,
+        max_retries=max_retries,
+        **post_kwargs,
+    )
+
+
+def vllm_rerank_call(
+    query,
+    targets,
+    vllm_rerank_endpoint,
+    vllm_model_name,
+    max_len=-1,
+    timeout=20,
+    max_retries=3,
+    dtype="float32",
+    **post_kwargs,
+):
+    """Calls the vLLM endpoint and return the ranking scores as an array of
+    type `dtype`, in the same order as they were provided. Additional keyword
+    arguments are forwarded to `_post_with_retry`.
+    """
+    return _endpoint_call(
+        _vllm_rerank_request(
+            query, targets, vllm_rerank_endpoint, vllm_model_name, max_len, dtype
+        ),
         timeout=timeout,
         max_retries=max_retries,
-        model=vllm_model_name,
+        **post_kwargs,
     )
-    data = json.loads(response.text)
-    return np.array([a["embedding"] for a in data["data"]])
 
 
-def get_embedding(text, endpoint, endpoint_type, model_name=None, max_batch_size=32):
-    """Call the Text-Embedding-Inference endpoint handling the endpoint batch
-    size.
+def get_rerank(
+    query,
+    targets,
+    endpoint,
+    endpoint_type,
+    model_name=None,
+    max_batch_size=32,
+    timeout=20,
+    max_retries=3,
+    max_concurrency=1,
+    pool_size=10,
+    max_len=-1,
+    endpoint_limits=None,
+    max_batch_tokens=None,
+    chars_per_token=4.0,
+    sort_by_length=False,
+    health_check_interval=10.0,
+    hedge_percentile=None,
+    adaptive_concurrency=False,
+    dtype="float32",
+    local_backend="torch",
+    **post_kwargs,
+):
+    """Call the reranking endpoint handling the endpoint batch size.
+    `endpoint` can be a list (or comma-separated string) of replicas serving
+    the same model, each batch is then routed to the least loaded one (see
+    `_ReplicaPool`). If `hedge_percentile` is given, batches slower than that
+    percentile of the recent latencies are sent again, and the first response
+    wins. If `adaptive_concurrency` is set, the number of batches in flight is
+    adjusted between 1 and `max_concurrency` from the observed latencies and
+    errors (see `_AdaptiveLimiter`).
+    If `max_batch_tokens` is given, batches are packed by estimated token length
+    of each (query, target) pair so they do not exceed that budget.
+    If `sort_by_length` is set, targets are sorted by length before batching,
+    so that the server pads less, and the scores are returned in input order.
+    An empty list of targets returns an empty array without calling the
+    endpoint.
+    Additional keyword arguments (backoff and circuit breaker settings) are
+    forwarded to `_post_with_retry`.
+    If `endpoint_limits` (see `discover_endpoint_limits`) are given, the batch
+    size, truncation length and token budget are clipped to them.
+    Scores are returned as an array of type `dtype`.
+    With the "local" `endpoint_type`, `endpoint` is the model run in-process
+    with the `local_backend` ("torch" or "onnx"), see `a_vert.local_backend`.
     """
-    # Assign endpoint call
-    if endpoint_type == "tei":
-
-        def embedding_call(x):
-            return tei_embedding_call(x, endpoint)
-    elif endpoint_type == "vllm" or endpoint_type == "openai":
-        if model_name is None:
-            raise ValueError("Model name is required for vllm/openai endpoint.")
-
-        def embedding_call(x):
-            return vllm_embedding_call(x, endpoint, model_name)
-    else:
-        raise ValueError("Endpoint type not supported")
+    max_batch_size, max_len, max_batch_tokens = _apply_endpoint_limits(
+        max_batch_size, max_len, max_batch_tokens, endpoint_limits
+    )
+    _check_endpoint_type(endpoint_type, model_name)
+    if isinstance(targets, list) and not targets:
+        return np.empty(0, dtype=dtype)
+    post_kwargs.update(timeout=timeout, max_retries=max_retries, pool_size=pool_size)
+    if endpoint_type == "local":
+        key = endpoint
 
-    # Calculate embeddings for the text list
-    if isinstance(text, list):
-        if len(text) > max_batch_size:
-            partial = embedding_call(text[:max_batch_size])
-            last = max_batch_size
-            while last < len(text):
-                if last + max_batch_size > len(text):
-                    part = embedding_call(text[last:])
-                else:
-                    part = embedding_call(text[last : last + max_batch_size])
-                last += max_batch_size
-                partial = np.concatenate([partial, part], axis=0)
-            return partial
+        def reranking_call(x, y):
+            return _local_rerank_call(x, y, endpoint, local_backend, max_len, dtype)
 
-        else:
-            return embedding_call(text)
     else:
-        return embedding_call(text)
+        replicas = _get_replica_pool(endpoint, health_check_interval)
+        key = replicas.key
 
+        # Assign endpoint call
+        def reranking_call(x, y):
+            return replicas.call(
+                lambda replica: _endpoint_call(
+                    _rerank_request(
+                        x, y, replica, endpoint_type, model_name, max_len, dtype
+                    ),
+                    **post_kwargs,
+                ),
+                hedge_percentile=hedge_percentile,
+                limiter=limiter,
+            )
 
-def check_and_apply_template(template, placeholder, text):
-    """
-    Apply a template to a text, replacing a placeholder.
-    If the template is None, returns the original text.
-    """
-    if template is not None:
-        # Check if the template contains the string to replace
-        if placeholder not in template:
-            err = f"Template must contain a {placeholder} placeholder. Template: '{template}'"
-            raise ValueError(err)
-        # Replace
-        prompt = template.replace(placeholder, text)
+    limiter = None
+    if isinstance(targets, list) and adaptive_concurrency and max_concurrency > 1:
+        limiter = _get_concurrency_limiter(key, max_concurrency)
+    # Discount query place
+    max_batch_size -= 1
+    # Calculate embeddings for the text list
+    if isinstance(targets, list):
+        limit_key = (key, "rerank")
+        # Every pair carries the full query
+        batches, order = _prepare_batches(
+            targets,
+            _get_batch_size_limit(limit_key, max_batch_size),
+            max_batch_tokens=max_batch_tokens,
+            query_tokens=estimate_tokens(query, chars_per_token=chars_per_token),
+            chars_per_token=chars_per_token,
+            max_len=max_len,
+            sort_by_length=sort_by_length,
+        )
+        scores = _run_batches(
+            lambda batch: reranking_call(query, batch),
+            batches,
+            max_concurrency=max_concurrency,
+            limit_key=limit_key,
+            limiter=limiter,
+        )
+        if order is not None:
+            scores = _restore_order(scores, order)
+        return scores
     else:
-        prompt = text
-
-    return prompt
+        return reranking_call(query, targets)
 
 
-def calculate_embedding_distances(
+def calculate_reranking_distances(
     model_response,
     batch,
     endpoint,
@@ -155,175 +2423,536 @@ def calculate_embedding_distances(
     model_name=None,
     query_template=None,
     document_template=None,
-    distance_fn=spatial.distance.cosine,
     batch_size=32,
+    **request_kwargs,
 ):
+    """Score the model response against every target with the reranker.
+    Additional keyword arguments are forwarded to `get_rerank`.
+    """
     # Calculate targets embeddings
-    batch_to_embedding = [
+    batch_to_rank = [
         check_and_apply_template(document_template, "{document}", t) for t in batch
     ]
-    targets_embeddings = get_embedding(
-        batch_to_embedding,
+    model_response_to_rank = check_and_apply_template(
+        query_template, "{query}", model_response
+    )
+
+    # Get model response rerank
+    all_scores = get_rerank(
+        model_response_to_rank,
+        batch_to_rank,
         endpoint,
         endpoint_type,
         model_name=model_name,
         max_batch_size=batch_size,
+        **request_kwargs,
     )
-    # Get model response embedding
-    model_response_to_embedding = check_and_apply_template(
-        query_template, "{query}", model_response
-    )
-    model_response_embedding = np.squeeze(
-        get_embedding(
-            model_response_to_embedding,
-            endpoint,
-            endpoint_type,
-            model_name=model_name,
-            max_batch_size=batch_size,
+
+    return all_scores
+
+
+# --- Asyncio API ---
+# Same behavior and results as the blocking API, on an aiohttp client
+
+
+def _import_aiohttp():
+    try:
+        import aiohttp
+    except ImportError as exc:
+        raise ImportError(
+            "The asyncio API requires aiohttp, install it with "
+            "`pip install a-vert[async]`."
+        ) from exc
+    return aiohttp
+
+
+def _aget_session(pool_size=10):
+    """Return the aiohttp session of the running event loop, keeping up to
+    `pool_size` connections per host.
+    """
+    aiohttp = _import_aiohttp()
+    sessions = _ASYNC_SESSIONS.setdefault(asyncio.get_running_loop(), dict())
+    session = sessions.get(pool_size)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0, limit_per_host=pool_size)
         )
-    )
+        sessions[pool_size] = session
+    return session
 
-    # Calculate the distances
-    all_distances = [
-        1 - distance_fn(model_response_embedding, this_emb)
-        for this_emb in targets_embeddings
-    ]
 
-    return all_distances
+async def aclose_sessions():
+    """Close the HTTP sessions opened by the asyncio API on the running event
+    loop. Call it before the loop is closed.
+    """
+    sessions = _ASYNC_SESSIONS.pop(asyncio.get_running_loop(), dict())
+    for session in sessions.values():
+        await session.close()
 
 
-def tei_rerank_call(query, targets, tei_rerank_endpoint, timeout=20, max_retries=3):
-    """Calls the TEI endpoint and return the ranking scores as an array, in the
-    same order as they were provided.
+async def _apost_with_retry(
+    url,
+    payload,
+    timeout=20,
+    max_retries=3,
+    pool_size=10,
+    backoff_base=0.5,
+    backoff_max=30.0,
+    breaker_threshold=5,
+    breaker_cooldown=30.0,
+    max_requests_per_second=None,
+    max_texts_per_second=None,
+    rate_limit_dir=None,
+    record_mode=None,
+    record_path=None,
+    **log_context,
+):
+    """Asyncio version of `_post_with_retry`, with the same retries, circuit
+    breaker, rate limit and recording. Returns the response body (bytes).
     """
-    payload = {
-        "query": query,
-        "texts": targets,
-        "truncate": True,
-        "truncation_direction": "Left",
-    }
-    response = _post_with_retry(
-        tei_rerank_endpoint + "/rerank",
-        payload,
-        timeout=timeout,
-        max_retries=max_retries,
+    aiohttp = _import_aiohttp()
+    if max_retries < 1:
+        raise ValueError("max_retries must be >= 1")
+    if record_mode == "replay":
+        # Recordings are read and written under file locks, off the event loop
+        return await asyncio.to_thread(
+            _replay_response, url, payload, record_path, **log_context
+        )
+    headers = {"Content-Type": "application/json"}
+    session = _aget_session(pool_size)
+    breaker = _get_circuit_breaker(url, breaker_threshold, breaker_cooldown)
+    rate_limiter = _get_rate_limiter(
+        url, max_requests_per_second, max_texts_per_second, rate_limit_dir
     )
-    response = json.loads(response.text)
+    n_texts = _count_texts(payload)
+    data = _json_dumps(payload)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    failure = None
+    for attempt in range(1, max_retries + 1):
+        trial = breaker.before_request()
+        try:
+            if rate_limiter is not None:
+                # The shared state file is locked, keep it off the event loop
+                delay = await asyncio.to_thread(rate_limiter.reserve, n_texts)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            _count_attempt(attempt, len(data))
+            sent = time.monotonic()
+            async with session.post(
+                url, data=data, headers=headers, timeout=client_timeout
+            ) as response:
+                status_code = response.status
+                response_body = await response.read()
+                retry_after = _get_retry_after(response)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as exc:
+            failure = _network_failure(breaker, exc)
+        except BaseException:
+            # Includes the cancellation of the losing call of a hedged pair
+            breaker.trial_failed(trial)
+            raise
+        else:
+            failure = _status_failure(breaker, status_code, response_body, retry_after)
+            if failure is None:
+                _AROUND_TRIP.set(time.monotonic() - sent)
+                break
+        delay = _retry_delay(
+            breaker,
+            attempt,
+            failure,
+            url,
+            max_retries=max_retries,
+            backoff_base=backoff_base,
+            backoff_max=backoff_max,
+            **log_context,
+        )
+        if delay is not None:
+            await asyncio.sleep(delay)
+    else:
+        _give_up(failure, url, max_retries, **log_context)
 
-    total_ranks = len(response)
-    if total_ranks != len(targets):
-        logger.error(
-            "Mismatch between response and target count",
-            query=query,
-            num_targets=len(targets),
-            num_responses=total_ranks,
-            targets=targets,
-            response=response,
+    _increment_stat("bytes_received", len(response_body))
+    if record_mode == "record":
+        await asyncio.to_thread(
+            _record_response, url, payload, record_path, status_code, response_body
         )
-        raise ValueError(
-            "Received less scores than targets from endpoint, cannot continue."
+    _raise_for_status(status_code, response_body, url, payload=payload, **log_context)
+    return response_body
+
+
+async def _aendpoint_call(request, timeout=20, max_retries=3, **post_kwargs):
+    """Asyncio version of `_endpoint_call`."""
+    url, payload, parse, log_context = request
+    try:
+        response_body = await _apost_with_retry(
+            url,
+            payload,
+            timeout=timeout,
+            max_retries=max_retries,
+            **log_context,
+            **post_kwargs,
+        )
+    except EndpointError as exc:
+        fallback = _encoding_fallback(request, exc) or _dimensions_fallback(
+            request, exc
+        )
+        if fallback is None:
+            raise
+        return await _aendpoint_call(
+            fallback, timeout=timeout, max_retries=max_retries, **post_kwargs
         )
+    return parse(response_body)
 
-    # Process results and get scores in same order as targets
-    all_scores = np.zeros((total_ranks))
-    for ranked in response:
-        all_scores[ranked["index"]] = ranked["score"]
 
-    return all_scores
+async def _acall_with_bisection(batch_call, batch, limit_key=None):
+    """Asyncio version of `_call_with_bisection`."""
+    try:
+        result = await batch_call(batch)
+    except PayloadTooLargeError:
+        if len(batch) <= 1:
+            raise
+    else:
+        _remember_batch_size(limit_key, len(batch))
+        return result
+    part = _split_rejected_batch(batch, limit_key=limit_key)
+    return np.concatenate(
+        [
+            await _acall_with_bisection(
+                batch_call, batch[start : start + part], limit_key=limit_key
+            )
+            for start in range(0, len(batch), part)
+        ],
+        axis=0,
+    )
 
 
-def vllm_rerank_call(
-    query,
-    targets,
-    vllm_rerank_endpoint,
-    vllm_model_name,
-    max_len=-1,
+def _aget_semaphore(key, max_concurrency):
+    """Return the semaphore of the running event loop that keeps at most
+    `max_concurrency` batches in flight to the endpoint `key`.
+    """
+    semaphores = _ASYNC_SEMAPHORES.setdefault(asyncio.get_running_loop(), dict())
+    semaphore = semaphores.get((key, max_concurrency))
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+        semaphores[(key, max_concurrency)] = semaphore
+    return semaphore
+
+
+async def _arun_batches(
+    batch_call, batches, max_concurrency=1, limit_key=None, limiter=None
+):
+    """Asyncio version of `_run_batches`. A semaphore shared by all the calls
+    of the event loop to the same endpoint keeps at most `max_concurrency`
+    batches in flight to it; a `limiter` (see `_AdaptiveLimiter`) then decides
+    how many of them are actually sent at the same time.
+    """
+    if limiter is not None:
+        unlimited_call = batch_call
+
+        def batch_call(batch):
+            return limiter.acall(unlimited_call, batch)
+
+    semaphore = _aget_semaphore(limit_key and limit_key[0], max_concurrency)
+    if len(batches) == 1:
+        async with semaphore:
+            return await _acall_with_bisection(
+                batch_call, batches[0], limit_key=limit_key
+            )
+    results = _ResultBuffer(batches)
+
+    async def bounded_call(idx, batch):
+        async with semaphore:
+            result = await _acall_with_bisection(batch_call, batch, limit_key=limit_key)
+        results.write(idx, result)
+
+    await asyncio.gather(
+        *(bounded_call(idx, batch) for idx, batch in enumerate(batches))
+    )
+    return results.array
+
+
+async def aget_embedding(
+    text,
+    endpoint,
+    endpoint_type,
+    model_name=None,
+    max_batch_size=32,
     timeout=20,
     max_retries=3,
+    max_concurrency=1,
+    pool_size=10,
+    max_len=-1,
+    endpoint_limits=None,
+    max_batch_tokens=None,
+    chars_per_token=4.0,
+    sort_by_length=False,
+    health_check_interval=10.0,
+    hedge_percentile=None,
+    adaptive_concurrency=False,
+    encoding_format="float",
+    dtype="float32",
+    dimensions=None,
+    local_backend="torch",
+    **post_kwargs,
 ):
-    """Calls the vLLM endpoint and return the ranking scores as an array, in the
-    same order as they were provided.
+    """Asyncio version of `get_embedding`, with the same arguments and results.
+    Requests are sent with aiohttp (see `aclose_sessions`). The batches of a
+    call are bounded by `max_concurrency` and the connections to each host by
+    `pool_size`, so a single event loop can keep many calls in flight.
+    Local models run in the default thread pool of the event loop.
+    With `adaptive_concurrency`, the adaptive limit of the endpoint is shared
+    with the blocking API.
     """
-    payload = {
-        "query": query,
-        "documents": targets,
-        "model": vllm_model_name,
-        "truncate_prompt_tokens": max_len,
-    }
-    response = _post_with_retry(
-        vllm_rerank_endpoint + "/v1/rerank",
-        payload,
-        timeout=timeout,
-        max_retries=max_retries,
-        model=vllm_model_name,
+    max_batch_size, max_len, max_batch_tokens = _apply_endpoint_limits(
+        max_batch_size, max_len, max_batch_tokens, endpoint_limits
     )
-    response = json.loads(response.text)
+    _check_endpoint_type(endpoint_type, model_name)
+    if isinstance(text, list) and not text:
+        return _empty_embeddings(dtype, dimensions)
+    post_kwargs.update(timeout=timeout, max_retries=max_retries, pool_size=pool_size)
+    if endpoint_type == "local":
+        key = endpoint
 
-    total_ranks = len(response["results"])
-    if total_ranks != len(targets):
-        logger.error(
-            "Mismatch between response and target count",
-            query=query,
-            num_targets=len(targets),
-            num_responses=total_ranks,
-            targets=targets,
-            response=response,
-        )
-        raise ValueError(
-            "Received less scores than targets from endpoint, cannot continue."
-        )
+        async def embedding_call(x):
+            return await asyncio.to_thread(
+                _local_embedding_call,
+                x,
+                endpoint,
+                local_backend,
+                max_len,
+                dtype,
+                dimensions,
+            )
 
-    # Process results and get scores in same order as targets
-    all_scores = np.zeros((total_ranks))
-    for ranked in response["results"]:
-        all_scores[ranked["index"]] = ranked["relevance_score"]
+    else:
+        replicas = _get_replica_pool(endpoint, health_check_interval)
+        key = replicas.key
 
-    return all_scores
+        async def embedding_call(x):
+            return await replicas.acall(
+                lambda replica: _aendpoint_call(
+                    _embedding_request(
+                        x,
+                        replica,
+                        endpoint_type,
+                        model_name,
+                        max_len,
+                        encoding_format,
+                        dtype,
+                        dimensions,
+                    ),
+                    **post_kwargs,
+                ),
+                hedge_percentile=hedge_percentile,
+                semaphore=_aget_semaphore(key, max_concurrency),
+                limiter=limiter,
+            )
+
+    limiter = None
+    if isinstance(text, list) and adaptive_concurrency and max_concurrency > 1:
+        limiter = _get_concurrency_limiter(key, max_concurrency)
+    if not isinstance(text, list):
+        async with _aget_semaphore(key, max_concurrency):
+            return await embedding_call(text)
+    limit_key = (key, "embedding")
+    batches, order = _prepare_batches(
+        text,
+        _get_batch_size_limit(limit_key, max_batch_size),
+        max_batch_tokens=max_batch_tokens,
+        chars_per_token=chars_per_token,
+        max_len=max_len,
+        sort_by_length=sort_by_length,
+    )
+    embeddings = await _arun_batches(
+        embedding_call,
+        batches,
+        max_concurrency=max_concurrency,
+        limit_key=limit_key,
+        limiter=limiter,
+    )
+    if order is not None:
+        embeddings = _restore_order(embeddings, order)
+    return embeddings
 
 
-def get_rerank(
-    query, targets, endpoint, endpoint_type, model_name=None, max_batch_size=32
+async def aget_rerank(
+    query,
+    targets,
+    endpoint,
+    endpoint_type,
+    model_name=None,
+    max_batch_size=32,
+    timeout=20,
+    max_retries=3,
+    max_concurrency=1,
+    pool_size=10,
+    max_len=-1,
+    endpoint_limits=None,
+    max_batch_tokens=None,
+    chars_per_token=4.0,
+    sort_by_length=False,
+    health_check_interval=10.0,
+    hedge_percentile=None,
+    adaptive_concurrency=False,
+    dtype="float32",
+    local_backend="torch",
+    **post_kwargs,
 ):
-    """Call the .0.. batch
-    size.
+    """Asyncio version of `get_rerank`, with the same arguments and results
+    (see `aget_embedding`).
     """
-    # Assign endpoint call
-    if endpoint_type == "tei":
+    max_batch_size, max_len, max_batch_tokens = _apply_endpoint_limits(
+        max_batch_size, max_len, max_batch_tokens, endpoint_limits
+    )
+    _check_endpoint_type(endpoint_type, model_name)
+    if isinstance(targets, list) and not targets:
+        return np.empty(0, dtype=dtype)
+    post_kwargs.update(timeout=timeout, max_retries=max_retries, pool_size=pool_size)
+    if endpoint_type == "local":
+        key = endpoint
 
-        def reranking_call(x, y):
-            return tei_rerank_call(x, y, endpoint)
-    elif endpoint_type == "vllm" or endpoint_type == "openai":
-        if model_name is None:
-            raise ValueError("Model name is required for vllm/openai endpoint.")
+        async def reranking_call(x, y):
+            return await asyncio.to_thread(
+                _local_rerank_call, x, y, endpoint, local_backend, max_len, dtype
+            )
 
-        def reranking_call(x, y):
-            return vllm_rerank_call(x, y, endpoint, model_name)
     else:
-        raise ValueError("Endpoint type not supported")
+        replicas = _get_replica_pool(endpoint, health_check_interval)
+        key = replicas.key
+
+        async def reranking_call(x, y):
+            return await replicas.acall(
+                lambda replica: _aendpoint_call(
+                    _rerank_request(
+                        x, y, replica, endpoint_type, model_name, max_len, dtype
+                    ),
+                    **post_kwargs,
+                ),
+                hedge_percentile=hedge_percentile,
+                semaphore=_aget_semaphore(key, max_concurrency),
+                limiter=limiter,
+            )
 
+    limiter = None
+    if isinstance(targets, list) and adaptive_concurrency and max_concurrency > 1:
+        limiter = _get_concurrency_limiter(key, max_concurrency)
+    if not isinstance(targets, list):
+        async with _aget_semaphore(key, max_concurrency):
+            return await reranking_call(query, targets)
     # Discount query place
-    max_batch_size -= 1
-    # Calculate embeddings for the text list
-    if isinstance(targets, list):
-        if len(targets) > max_batch_size:
-            partial = reranking_call(query, targets[:max_batch_size])
-            last = max_batch_size
-            while last < len(targets):
-                if last + max_batch_size > len(targets):
-                    part = reranking_call(query, targets[last:])
-                else:
-                    part = reranking_call(query, targets[last : last + max_batch_size])
-                last += max_batch_size
-                partial = np.concatenate([partial, part], axis=0)
-            return partial
+    limit_key = (key, "rerank")
+    batches, order = _prepare_batches(
+        targets,
+        _get_batch_size_limit(limit_key, max_batch_size - 1),
+        max_batch_tokens=max_batch_tokens,
+        query_tokens=estimate_tokens(query, chars_per_token=chars_per_token),
+        chars_per_token=chars_per_token,
+        max_len=max_len,
+        sort_by_length=sort_by_length,
+    )
+    scores = await _arun_batches(
+        lambda batch: reranking_call(query, batch),
+        batches,
+        max_concurrency=max_concurrency,
+        limit_key=limit_key,
+        limiter=limiter,
+    )
+    if order is not None:
+        scores = _restore_order(scores, order)
+    return scores
 
-        else:
-            return reranking_call(query, targets)
-    else:
-        return reranking_call(query, targets)
+
+async def acalculate_embedding_distances(
+    model_response,
+    batch,
+    endpoint,
+    endpoint_type,
+    model_name=None,
+    query_template=None,
+    document_template=None,
+    distance_fn=spatial.distance.cosine,
+    batch_size=32,
+    embedding_store=None,
+    groups=None,
+    rescore_top_k=4,
+    **request_kwargs,
+):
+    """Asyncio version of `calculate_embedding_distances`. The targets and the
+    model response are embedded concurrently, unless an `embedding_store` is
+    given.
+    """
+    batch_to_embedding = [
+        check_and_apply_template(document_template, "{document}", t) for t in batch
+    ]
+    model_response_to_embedding = check_and_apply_template(
+        query_template, "{query}", model_response
+    )
+    if embedding_store is not None:
+        model_response_embedding = np.squeeze(
+            await aget_embedding(
+                model_response_to_embedding,
+                endpoint,
+                endpoint_type,
+                model_name=model_name,
+                max_batch_size=batch_size,
+                **request_kwargs,
+            )
+        )
+        similarities, fetch, missing = _stored_similarities(
+            model_response_embedding,
+            batch_to_embedding,
+            embedding_store,
+            groups,
+            rescore_top_k,
+            distance_fn,
+        )
+        exact = np.zeros(len(batch_to_embedding), dtype=bool)
+        while len(fetch):
+            fetched_embeddings = await aget_embedding(
+                [batch_to_embedding[idx] for idx in fetch],
+                endpoint,
+                endpoint_type,
+                model_name=model_name,
+                max_batch_size=batch_size,
+                **request_kwargs,
+            )
+            _rescore_similarities(
+                similarities,
+                model_response_embedding,
+                batch_to_embedding,
+                fetch,
+                missing,
+                fetched_embeddings,
+                embedding_store,
+                distance_fn,
+            )
+            exact[fetch] = True
+            fetch = _approximate_winners(similarities, exact, groups)
+        return similarities
+
+    targets_embeddings, model_response_embedding = await asyncio.gather(
+        aget_embedding(
+            batch_to_embedding,
+            endpoint,
+            endpoint_type,
+            model_name=model_name,
+            max_batch_size=batch_size,
+            **request_kwargs,
+        ),
+        aget_embedding(
+            model_response_to_embedding,
+            endpoint,
+            endpoint_type,
+            model_name=model_name,
+            max_batch_size=batch_size,
+            **request_kwargs,
+        ),
+    )
+    return _embedding_similarities(
+        np.squeeze(model_response_embedding), targets_embeddings, distance_fn
+    )
 
 
-def calculate_reranking_distances(
+async def acalculate_reranking_distances(
     model_response,
     batch,
     endpoint,
@@ -332,23 +2961,21 @@ def calculate_reranking_distances(
     query_template=None,
     document_template=None,
     batch_size=32,
+    **request_kwargs,
 ):
-    # Calculate targets embeddings
+    """Asyncio version of `calculate_reranking_distances`."""
     batch_to_rank = [
         check_and_apply_template(document_template, "{document}", t) for t in batch
     ]
     model_response_to_rank = check_and_apply_template(
         query_template, "{query}", model_response
     )
-
-    # Get model response rerank
-    all_scores = get_rerank(
+    return await aget_rerank(
         model_response_to_rank,
         batch_to_rank,
         endpoint,
         endpoint_type,
         model_name=model_name,
         max_batch_size=batch_size,
+        **request_kwargs,
     )
-
-    return all_scores
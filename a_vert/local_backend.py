@@ -0,0 +1,103 @@
+"""
+In-process embedding and reranking models (`AVERT_ENDPOINT_TYPE=local`).
+
+Small A-VERT models can run in the evaluation process itself, without a
+TEI/vLLM server: the "endpoint" is then the name (or local path) of a
+sentence-transformers model, loaded once per process. Models run on PyTorch
+or, with `backend="onnx"`, on ONNX Runtime (see the sentence-transformers
+documentation for the ONNX export). Batching, ordering and the thread pool
+running the batches are those of `a_vert.embedding_tools`.
+"""
+
+import threading
+
+import numpy as np
+
+from a_vert.logger import get_logger
+
+logger = get_logger(__name__)
+
+LOCAL_BACKENDS = ("torch", "onnx")
+
+# Loaded models, shared by all the calls of the process
+_LOCAL_MODELS: dict = {}
+_LOCAL_MODELS_LOCK = threading.Lock()
+
+
+def _import_sentence_transformers():
+    try:
+        import sentence_transformers
+    except ImportError as exc:
+        raise ImportError(
+            "The local endpoint type requires sentence-transformers, install "
+            "it with `pip install a-vert[local]` (`sentence-transformers[onnx]` "
+            "for the ONNX backend)."
+        ) from exc
+    return sentence_transformers
+
+
+def _load_model(model_name, kind, backend, max_len):
+    sentence_transformers = _import_sentence_transformers()
+    logger.info("Loading local model", model=model_name, kind=kind, backend=backend)
+    if kind == "embedding":
+        model = sentence_transformers.SentenceTransformer(model_name, backend=backend)
+        if max_len is not None and max_len > 0:
+            model.max_seq_length = max_len
+    else:
+        model = sentence_transformers.CrossEncoder(
+            model_name,
+            backend=backend,
+            max_length=max_len if max_len is not None and max_len > 0 else None,
+        )
+    # Same truncation as the TEI/vLLM requests, the end of the texts is kept
+    model.tokenizer.truncation_side = "left"
+    return model
+
+
+def get_local_model(model_name, kind, backend="torch", max_len=-1):
+    """Return the `kind` ('embedding' or 'rerank') model `model_name`, loaded
+    on first use and shared by all the calls of the process.
+    """
+    if backend not in LOCAL_BACKENDS:
+        raise ValueError(
+            f"Unknown local backend: '{backend}'. "
+            f"Must be one of: {', '.join(LOCAL_BACKENDS)}"
+        )
+    key = (model_name, kind, backend, max_len)
+    model = _LOCAL_MODELS.get(key)
+    if model is None:
+        with _LOCAL_MODELS_LOCK:
+            model = _LOCAL_MODELS.get(key)
+            if model is None:
+                model = _load_model(model_name, kind, backend, max_len)
+                _LOCAL_MODELS[key] = model
+    return model
+
+
+def local_embedding_call(texts, model_name, backend="torch", max_len=-1):
+    """Embed `texts` (a string or a list) with the local model, returns a
+    float32 array with one row per text.
+    """
+    if isinstance(texts, str):
+        texts = [texts]
+    model = get_local_model(model_name, "embedding", backend, max_len)
+    embeddings = model.encode(
+        texts, batch_size=len(texts), convert_to_numpy=True, show_progress_bar=False
+    )
+    return np.asarray(embeddings, dtype=np.float32)
+
+
+def local_rerank_call(query, targets, model_name, backend="torch", max_len=-1):
+    """Score the (`query`, target) pairs with the local cross-encoder, returns
+    a float32 array in the order of `targets`.
+    """
+    if isinstance(targets, str):
+        targets = [targets]
+    model = get_local_model(model_name, "rerank", backend, max_len)
+    scores = model.predict(
+        [(query, target) for target in targets],
+        batch_size=len(targets),
+        convert_to_numpy=True,
+        show_progress_bar=False,
+    )
+    return np.asarray(scores, dtype=np.float32)
@@ -0,0 +1,500 @@
+"""
+Local stand-in for TEI and vLLM endpoints, for tests and benchmarks.
+
+Serves the routes used by `a_vert.embedding_tools`:
+- TEI: `POST /embed`, `POST /rerank`, `GET /info`;
+- vLLM/OpenAI: `POST /v1/embeddings` (float or base64, reduced `dimensions`),
+  `POST /v1/rerank`, `POST /v1/score`, `GET /v1/models`;
+- `GET /health`, and `GET /metrics` with the request counters of the server.
+
+Embeddings are deterministic unit vectors seeded by the text, and scores are
+derived from them, so the same inputs always get the same results. Latency,
+errors (429/503 with `Retry-After`, hanging requests), batch limits (413) and
+overload (503 above a number of requests in flight) can be injected, with a
+seeded random generator.
+
+Run it with `python -m a_vert.mock_server --port 8080`, or in-process with
+`MockServer` (a context manager serving from a background thread).
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from a_vert.logger import get_logger
+
+logger = get_logger(__name__)
+
+LATENCY_DISTRIBUTIONS = ("constant", "exponential", "lognormal")
+
+
+def mock_embedding(text, dim=768):
+    """Deterministic unit vector (float32) of `text`."""
+    seed = int.from_bytes(
+        hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little"
+    )
+    embedding = np.random.default_rng(seed).standard_normal(dim, dtype=np.float32)
+    return embedding / np.linalg.norm(embedding)
+
+
+def mock_score(query, text, dim=768):
+    """Deterministic relevance score in [0, 1] of the (`query`, `text`) pair."""
+    similarity = float(mock_embedding(query, dim) @ mock_embedding(text, dim))
+    return (similarity + 1) / 2
+
+
+class MockServer:
+    """TEI/vLLM mock server, see the module documentation.
+
+    Args:
+        host: Address to listen on.
+        port: Port to listen on (0 for any free port, see `url`).
+        dim: Dimensions of the embeddings.
+        model_name: Model listed on `/v1/models` (requests are served
+            whatever their model).
+        latency: Base latency of every request, in seconds.
+        latency_per_text: Latency added per text of the request, in seconds.
+        latency_dist: Distribution of the latency ('constant', 'exponential'
+            or 'lognormal'), scaled so that its median is the base latency.
+        latency_sigma: Sigma of the lognormal latency distribution.
+        error_rate: Probability of answering with one of `error_status`.
+        error_status: Status codes of the injected errors.
+        retry_after: `Retry-After` header (seconds) of the injected 429/503.
+        timeout_rate: Probability of holding a request for `hang` seconds.
+        hang: Seconds a hanging request is held before it is answered.
+        max_batch_size: Texts accepted per request (413 above, None for no
+            limit), published on `/info`.
+        max_batch_tokens: Estimated tokens accepted per request (413 above,
+            None for no limit), published on `/info`.
+        max_input_length: Tokens of a single input, published on `/info` and
+            `/v1/models`.
+        max_in_flight: Requests served at the same time (503 above, None for
+            no limit).
+        support_base64: Whether base64 embeddings are supported (422
+            otherwise).
+        support_dimensions: Whether reduced `dimensions` are supported (400
+            otherwise).
+        chars_per_token: Characters per token of the token estimates.
+        seed: Seed of the latency and error injection.
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        dim=768,
+        model_name="avert-model",
+        latency=0.0,
+        latency_per_text=0.0,
+        latency_dist="constant",
+        latency_sigma=0.5,
+        error_rate=0.0,
+        error_status=(503,),
+        retry_after=None,
+        timeout_rate=0.0,
+        hang=30.0,
+        max_batch_size=None,
+        max_batch_tokens=None,
+        max_input_length=512,
+        max_in_flight=None,
+        support_base64=True,
+        support_dimensions=True,
+        chars_per_token=4.0,
+        seed=0,
+    ):
+        if latency_dist not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(
+                f"Unknown latency distribution: '{latency_dist}'. "
+                f"Must be one of: {', '.join(LATENCY_DISTRIBUTIONS)}"
+            )
+        self.dim = dim
+        self.model_name = model_name
+        self.latency = latency
+        self.latency_per_text = latency_per_text
+        self.latency_dist = latency_dist
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.error_status = tuple(error_status)
+        self.retry_after = retry_after
+        self.timeout_rate = timeout_rate
+        self.hang = hang
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_input_length = max_input_length
+        self.max_in_flight = max_in_flight
+        self.support_base64 = support_base64
+        self.support_dimensions = support_dimensions
+        self.chars_per_token = chars_per_token
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self.metrics = dict(requests=0, texts=0, status=dict())
+        self.httpd = ThreadingHTTPServer((host, port), _MockHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.request_queue_size = 128
+        self.httpd.mock = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def serve_forever(self):
+        logger.info("Mock server listening", url=self.url)
+        self.httpd.serve_forever()
+
+    def start(self):
+        """Serve from a background thread, returns the server."""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def estimate_tokens(self, text):
+        return int(len(text) / self.chars_per_token) + 2
+
+    def _draw_error(self):
+        """Return the status of an injected error (None for no error) and
+        whether the request hangs.
+        """
+        with self._lock:
+            status = None
+            if self._random.random() < self.error_rate:
+                status = self._random.choice(self.error_status)
+            return status, self._random.random() < self.timeout_rate
+
+    def _latency(self, n_texts):
+        latency = self.latency + self.latency_per_text * n_texts
+        with self._lock:
+            if self.latency_dist == "exponential":
+                # Median of the exponential distribution is its mean * ln(2)
+                latency *= self._random.expovariate(1.0) / np.log(2)
+            elif self.latency_dist == "lognormal":
+                latency *= self._random.lognormvariate(0.0, self.latency_sigma)
+        return latency
+
+    def _count(self, n_texts, status):
+        with self._lock:
+            self.metrics["requests"] += 1
+            self.metrics["texts"] += n_texts
+            self.metrics["status"][status] = self.metrics["status"].get(status, 0) + 1
+
+    def handle(self, path, payload):
+        """Return the (status, body, headers) of a POST to `path`."""
+        texts = _request_texts(path, payload)
+        with self._lock:
+            self._in_flight += 1
+            in_flight = self._in_flight
+        try:
+            status, body, headers = self._handle(path, payload, texts, in_flight)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+        self._count(len(texts), status)
+        return status, body, headers
+
+    def _handle(self, path, payload, texts, in_flight):
+        if self.max_in_flight is not None and in_flight > self.max_in_flight:
+            return 503, {"error": "Model is overloaded"}, dict()
+        status, hang = self._draw_error()
+        if status is not None:
+            headers = dict()
+            if self.retry_after is not None and status in (429, 503):
+                headers["Retry-After"] = str(self.retry_after)
+            return status, {"error": "Injected error"}, headers
+        if hang:
+            time.sleep(self.hang)
+        if self.max_batch_size is not None and len(texts) > self.max_batch_size:
+            return (
+                413,
+                {
+                    "error": f"batch size {len(texts)} exceeds maximum allowed "
+                    f"batch size {self.max_batch_size}"
+                },
+                dict(),
+            )
+        query_tokens = self.estimate_tokens(payload.get("query", ""))
+        tokens = sum(self.estimate_tokens(text) + query_tokens for text in texts)
+        if self.max_batch_tokens is not None and tokens > self.max_batch_tokens:
+            return (
+                413,
+                {
+                    "error": f"batch of {tokens} tokens exceeds maximum allowed "
+                    f"{self.max_batch_tokens} tokens"
+                },
+                dict(),
+            )
+        time.sleep(self._latency(len(texts)))
+
+        route = _ROUTES.get(path)
+        if route is None:
+            return 404, {"error": f"Unknown route {path}"}, dict()
+        return route(self, payload, texts)
+
+    # Routes
+
+    def _tei_embed(self, payload, texts):
+        return 200, [mock_embedding(t, self.dim).tolist() for t in texts], dict()
+
+    def _tei_rerank(self, payload, texts):
+        results = [
+            {"index": idx, "score": mock_score(payload["query"], text, self.dim)}
+            for idx, text in enumerate(texts)
+        ]
+        if payload.get("return_text"):
+            for result in results:
+                result["text"] = texts[result["index"]]
+        results.sort(key=lambda result: result["score"], reverse=True)
+        return 200, results, dict()
+
+    def _vllm_embeddings(self, payload, texts):
+        encoding_format = payload.get("encoding_format", "float")
+        if encoding_format == "base64" and not self.support_base64:
+            return (
+                422,
+                {"error": "encoding_format: Input should be 'float'"},
+                dict(),
+            )
+        dimensions = payload.get("dimensions")
+        if dimensions is not None and not self.support_dimensions:
+            return (
+                400,
+                {
+                    "error": f'Model "{payload.get("model")}" does not support '
+                    "matryoshka representation, changing output dimensions "
+                    "will lead to poor results."
+                },
+                dict(),
+            )
+        data = list()
+        for idx, text in enumerate(texts):
+            embedding = mock_embedding(text, self.dim)
+            if dimensions is not None:
+                embedding = embedding[:dimensions] / np.linalg.norm(
+                    embedding[:dimensions]
+                )
+            if encoding_format == "base64":
+                encoded = base64.b64encode(embedding.astype("<f4").tobytes())
+                embedding = encoded.decode("ascii")
+            else:
+                embedding = embedding.tolist()
+            data.append({"object": "embedding", "index": idx, "embedding": embedding})
+        body = {
+            "object": "list",
+            "model": payload.get("model"),
+            "data": data,
+            "usage": self._usage(texts),
+        }
+        return 200, body, dict()
+
+    def _vllm_rerank(self, payload, texts):
+        results = list()
+        for idx, text in enumerate(texts):
+            result = {
+                "index": idx,
+                "relevance_score": mock_score(payload["query"], text, self.dim),
+            }
+            if payload.get("return_documents", True):
+                result["document"] = {"text": text}
+            results.append(result)
+        results.sort(key=lambda result: result["relevance_score"], reverse=True)
+        if payload.get("top_n"):
+            results = results[: payload["top_n"]]
+        body = {
+            "id": "rerank-mock",
+            "model": payload.get("model"),
+            "usage": self._usage(texts, payload["query"]),
+            "results": results,
+        }
+        return 200, body, dict()
+
+    def _vllm_score(self, payload, texts):
+        queries = payload["text_1"]
+        if isinstance(queries, str):
+            queries = [queries] * len(texts)
+        data = [
+            {
+                "index": idx,
+                "object": "score",
+                "score": mock_score(query, text, self.dim),
+            }
+            for idx, (query, text) in enumerate(zip(queries, texts))
+        ]
+        body = {
+            "id": "score-mock",
+            "object": "list",
+            "model": payload.get("model"),
+            "data": data,
+            "usage": self._usage(texts),
+        }
+        return 200, body, dict()
+
+    def _usage(self, texts, query=""):
+        tokens = sum(self.estimate_tokens(query + text) for text in texts)
+        return {"prompt_tokens": tokens, "total_tokens": tokens}
+
+    def info(self, path):
+        """Return the (status, body) of a GET to `path`."""
+        if path == "/health":
+            return 200, {}
+        if path == "/metrics":
+            with self._lock:
+                return 200, json.loads(json.dumps(self.metrics))
+        if path == "/info":
+            return 200, {
+                "model_id": self.model_name,
+                "max_client_batch_size": self.max_batch_size or 1024,
+                "max_batch_tokens": self.max_batch_tokens or 1 << 20,
+                "max_input_length": self.max_input_length,
+            }
+        if path == "/v1/models":
+            return 200, {
+                "object": "list",
+                "data": [
+                    {
+                        "id": self.model_name,
+                        "object": "model",
+                        "max_model_len": self.max_input_length,
+                    }
+                ],
+            }
+        return 404, {"error": f"Unknown route {path}"}
+
+
+_ROUTES = {
+    "/embed": MockServer._tei_embed,
+    "/rerank": MockServer._tei_rerank,
+    "/v1/embeddings": MockServer._vllm_embeddings,
+    "/v1/rerank": MockServer._vllm_rerank,
+    "/v1/score": MockServer._vllm_score,
+}
+
+
+def _request_texts(path, payload):
+    """Texts carried by a request payload, as a list."""
+    if path == "/v1/score":
+        texts = payload.get("text_2", [])
+    else:
+        texts = None
+        for field in ("inputs", "input", "texts", "documents"):
+            if field in payload:
+                texts = payload[field]
+                break
+    if texts is None:
+        return list()
+    if isinstance(texts, str):
+        return [texts]
+    return list(texts)
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send the headers and the body in a single segment, without delay
+    wbufsize = 1 << 16
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logger.debug("Mock server request", request=format % args)
+
+    def _send(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        status, body = self.server.mock.info(self.path)
+        self._send(status, body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            payload = json.loads(self.rfile.read(length))
+        except ValueError:
+            return self._send(400, {"error": "Invalid JSON body"})
+        self._send(*self.server.mock.handle(self.path, payload))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Local stand-in TEI/vLLM server for tests and benchmarks."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--model-name", default="avert-model")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--latency-per-text", type=float, default=0.0)
+    parser.add_argument(
+        "--latency-dist", choices=LATENCY_DISTRIBUTIONS, default="constant"
+    )
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, nargs="+", default=[503])
+    parser.add_argument("--retry-after", type=float, default=None)
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    parser.add_argument("--hang", type=float, default=30.0)
+    parser.add_argument("--max-batch-size", type=int, default=None)
+    parser.add_argument("--max-batch-tokens", type=int, default=None)
+    parser.add_argument("--max-input-length", type=int, default=512)
+    parser.add_argument("--max-in-flight", type=int, default=None)
+    parser.add_argument("--no-base64", action="store_true")
+    parser.add_argument("--no-dimensions", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    server = MockServer(
+        host=args.host,
+        port=args.port,
+        dim=args.dim,
+        model_name=args.model_name,
+        latency=args.latency,
+        latency_per_text=args.latency_per_text,
+        latency_dist=args.latency_dist,
+        latency_sigma=args.latency_sigma,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        retry_after=args.retry_after,
+        timeout_rate=args.timeout_rate,
+        hang=args.hang,
+        max_batch_size=args.max_batch_size,
+        max_batch_tokens=args.max_batch_tokens,
+        max_input_length=args.max_input_length,
+        max_in_flight=args.max_in_flight,
+        support_base64=not args.no_base64,
+        support_dimensions=not args.no_dimensions,
+        seed=args.seed,
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,14 @@
+import contextlib
+import threading
+import time
+
 import numpy as np
 from copy import deepcopy
 from scipy import spatial
 
 from a_vert import embedding_tools as emb
+from a_vert.candidate_scores import get_candidate_score_writer
+from a_vert.embedding_store import get_embedding_store
 from a_vert import prompts_general as prompts
 from a_vert import grouping as grouping_module
 from a_vert.config import AvertConfig
@@ -11,14 +17,18 @@ from a_vert.logger import get_logger
 logger = get_logger(__name__)
 _logged_template_keys: set = set()
 
+# Batcher of the concurrent ranking calls, see `batch_concurrent_rankings`
+_RANKING_BATCHER = None
+
 
 def get_candidate_groups_embedings_ranking(
     model_response: str,
     candidate_groups_dict: dict,
     config: AvertConfig,
     distance_fn=spatial.distance.cosine,
-    batch_size: int = 32,
+    batch_size: int | None = None,
     task: str = "default",
+    candidate_labels: list[str] | None = None,
 ):
     """This function takes a dictionary of candidate groups. Each element of the
     dictionary is list of text entries to be evaluated.
@@ -29,22 +39,335 @@ def get_candidate_groups_embedings_ranking(
     method.
     The result of this function is a distribution over the groups that
     adds up to one.
+    The endpoint batch size is taken from `config.batch_size` unless
+    `batch_size` is given explicitly.
+    When `config.scores_path` is set, the score of every candidate is also
+    written to that file (see `a_vert.candidate_scores`), with its
+    enhancement label from `candidate_labels` (the `track_labels` of
+    `construct_candidate_groups(..., return_references=True)`) when given.
+    Within `batch_concurrent_rankings`, concurrent calls are scored together.
+
+    """
+    batcher = _RANKING_BATCHER
+    if (
+        batcher is not None
+        and distance_fn is spatial.distance.cosine
+        and batch_size is None
+        and _is_batchable(config)
+    ):
+        return batcher.rank(
+            model_response, candidate_groups_dict, config, task, candidate_labels
+        )
+    batch, indexes_dict, distance_kwargs = _prepare_ranking(
+        model_response, candidate_groups_dict, config, batch_size, task
+    )
+
+    # Calculate semantic distances
+    if config.avert_method == "embedding":
+        all_distances = emb.calculate_embedding_distances(
+            model_response, batch, distance_fn=distance_fn, **distance_kwargs
+        )
+    elif config.avert_method == "rerank":
+        all_distances = emb.calculate_reranking_distances(
+            model_response, batch, **distance_kwargs
+        )
+    else:
+        raise ValueError("Embedding distance calculation method not supported.")
+
+    if config.scores_path is not None:
+        _write_candidate_scores(
+            model_response, indexes_dict, all_distances, config, task, candidate_labels
+        )
+    return _rank_candidate_groups(
+        model_response, candidate_groups_dict, indexes_dict, all_distances, config
+    )
+
+
+async def aget_candidate_groups_embedings_ranking(
+    model_response: str,
+    candidate_groups_dict: dict,
+    config: AvertConfig,
+    distance_fn=spatial.distance.cosine,
+    batch_size: int | None = None,
+    task: str = "default",
+    candidate_labels: list[str] | None = None,
+):
+    """Asyncio version of `get_candidate_groups_embedings_ranking`, with the
+    same arguments and results. Requires aiohttp (see
+    `embedding_tools.aget_embedding`).
+    """
+    batch, indexes_dict, distance_kwargs = _prepare_ranking(
+        model_response, candidate_groups_dict, config, batch_size, task
+    )
+
+    # Calculate semantic distances
+    if config.avert_method == "embedding":
+        all_distances = await emb.acalculate_embedding_distances(
+            model_response, batch, distance_fn=distance_fn, **distance_kwargs
+        )
+    elif config.avert_method == "rerank":
+        all_distances = await emb.acalculate_reranking_distances(
+            model_response, batch, **distance_kwargs
+        )
+    else:
+        raise ValueError("Embedding distance calculation method not supported.")
+
+    if config.scores_path is not None:
+        _write_candidate_scores(
+            model_response, indexes_dict, all_distances, config, task, candidate_labels
+        )
+    return _rank_candidate_groups(
+        model_response, candidate_groups_dict, indexes_dict, all_distances, config
+    )
+
+
+def get_candidate_groups_embedings_ranking_batch(
+    model_responses: list[str],
+    candidate_groups_dicts: list[dict],
+    config: AvertConfig,
+    distance_fn=spatial.distance.cosine,
+    batch_size: int | None = None,
+    tasks: list[str] | None = None,
+    candidate_labels: list[list[str] | None] | None = None,
+    embedding_cache=None,
+):
+    """Batched version of `get_candidate_groups_embedings_ranking`: ranks the
+    candidate groups of several model responses at once (`tasks` and
+    `candidate_labels` hold the values of every response), embedding the
+    unique texts of all of them in a single call (see
+    `embedding_tools.calculate_embedding_distances_batch`, which also takes
+    the `embedding_cache`). Returns the (distribution, distances) result of
+    every response.
+    Only the embedding method without an embedding store can be batched.
+    """
+    if not _is_batchable(config):
+        raise ValueError(
+            "Batched ranking requires the embedding method without an embedding "
+            "store, use get_candidate_groups_embedings_ranking instead."
+        )
+    n_responses = len(model_responses)
+    if n_responses == 0:
+        return list()
+    tasks = tasks or ["default"] * n_responses
+    candidate_labels = candidate_labels or [None] * n_responses
+    prepared = [
+        _prepare_ranking(model_response, groups, config, batch_size, task)
+        for model_response, groups, task in zip(
+            model_responses, candidate_groups_dicts, tasks
+        )
+    ]
+    # Templates depend on the task, the other settings come from the config
+    distance_kwargs = dict(prepared[0][2])
+    del distance_kwargs["query_template"], distance_kwargs["document_template"]
+    all_distances = emb.calculate_embedding_distances_batch(
+        model_responses,
+        [batch for batch, _, _ in prepared],
+        query_templates=[kwargs["query_template"] for _, _, kwargs in prepared],
+        document_templates=[kwargs["document_template"] for _, _, kwargs in prepared],
+        distance_fn=distance_fn,
+        embedding_cache=embedding_cache,
+        **distance_kwargs,
+    )
+
+    results = list()
+    for model_response, groups, task, labels, (_, indexes_dict, _), distances in zip(
+        model_responses,
+        candidate_groups_dicts,
+        tasks,
+        candidate_labels,
+        prepared,
+        all_distances,
+    ):
+        if config.scores_path is not None:
+            _write_candidate_scores(
+                model_response, indexes_dict, distances, config, task, labels
+            )
+        results.append(
+            _rank_candidate_groups(
+                model_response, groups, indexes_dict, distances, config
+            )
+        )
+    return results
+
+
+def _is_batchable(config):
+    """Whether the rankings of `config` can be scored in batches."""
+    return config.avert_method == "embedding" and config.embedding_store is None
 
+
+class _RankingBatcher:
+    """Scores the ranking calls made at the same time by several threads
+    together, with `get_candidate_groups_embedings_ranking_batch`.
+
+    The first thread of a batch leads it: it waits `max_wait` seconds for
+    the calls of the other threads to arrive, then scores up to
+    `max_batch_size` of them and hands out their results, and goes on with
+    the calls that arrived meanwhile. If a batch fails, its calls are scored
+    one at a time, so only the failing ones raise.
     """
 
+    def __init__(self, max_batch_size=64, max_wait=0.005):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._pending = dict()
+        self._lock = threading.Lock()
+
+    def rank(self, model_response, candidate_groups_dict, config, task, labels):
+        call = dict(
+            args=(model_response, candidate_groups_dict, task, labels),
+            done=threading.Event(),
+        )
+        # Only calls of the same configuration can be batched together
+        key = id(config)
+        with self._lock:
+            leader = key not in self._pending
+            self._pending.setdefault(key, list()).append(call)
+        if leader:
+            self._lead(key, config)
+        call["done"].wait()
+        if "error" in call:
+            raise call["error"]
+        return call["result"]
+
+    def _lead(self, key, config):
+        time.sleep(self.max_wait)
+        calls = list()
+        try:
+            while True:
+                with self._lock:
+                    pending = self._pending[key]
+                    calls = pending[: self.max_batch_size]
+                    del pending[: self.max_batch_size]
+                    if not calls:
+                        # The next call of this configuration leads
+                        del self._pending[key]
+                        return
+                self._score(calls, config)
+                for call in calls:
+                    call["done"].set()
+        except BaseException:
+            with self._lock:
+                calls += self._pending.pop(key, list())
+            for call in calls:
+                if "result" not in call:
+                    call.setdefault(
+                        "error", RuntimeError("The ranking batch was interrupted.")
+                    )
+                call["done"].set()
+            raise
+
+    @staticmethod
+    def _score(calls, config):
+        responses, groups, tasks, labels = zip(*(call["args"] for call in calls))
+        try:
+            results = get_candidate_groups_embedings_ranking_batch(
+                list(responses),
+                list(groups),
+                config,
+                tasks=list(tasks),
+                candidate_labels=list(labels),
+            )
+        except Exception as exc:
+            logger.debug("Batch failed, scoring its calls", error=str(exc))
+        else:
+            for call, result in zip(calls, results):
+                call["result"] = result
+            return
+        for call in calls:
+            response, candidate_groups_dict, task, candidate_labels = call["args"]
+            try:
+                (call["result"],) = get_candidate_groups_embedings_ranking_batch(
+                    [response],
+                    [candidate_groups_dict],
+                    config,
+                    tasks=[task],
+                    candidate_labels=[candidate_labels],
+                )
+            except Exception as exc:
+                call["error"] = exc
+
+
+@contextlib.contextmanager
+def batch_concurrent_rankings(max_batch_size=64, max_wait=0.005):
+    """Within this context, the calls of
+    `get_candidate_groups_embedings_ranking` made at the same time by several
+    threads (e.g. the `process_results` of an lm-eval task run in a thread
+    pool) are scored together, with a single embedding call for the unique
+    texts of up to `max_batch_size` of them (see `_RankingBatcher`). Only the
+    embedding method without an embedding store is batched, with the default
+    distance and batch size; other calls are scored as usual.
+    """
+    global _RANKING_BATCHER
+    if _RANKING_BATCHER is not None:
+        raise ValueError("Concurrent rankings are already being batched.")
+    _RANKING_BATCHER = _RankingBatcher(max_batch_size, max_wait)
+    try:
+        yield _RANKING_BATCHER
+    finally:
+        _RANKING_BATCHER = None
+
+
+def _prepare_ranking(model_response, candidate_groups_dict, config, batch_size, task):
+    """Resolve the templates and request settings of a ranking call and flatten
+    the candidate groups. Returns the flat batch of candidates, the
+    `[start, end)` indexes of each group in it and the keyword arguments of
+    the distance calculation.
+    """
     if model_response.strip() == "":
         raise ValueError("model_response cannot be an empty string.")
 
     # Extract configuration values from AvertConfig
     endpoint = config.avert_model_endpoint
     endpoint_type = config.avert_endpoint_type
-    method = config.avert_method
     model_name = config.avert_model_name
     query_template = config.query_template
     document_template = config.document_template
-    grouping_method = config.grouping
     instruction_map = config.instruction_map
     instruction_flag = config.instruction_flag
+    if batch_size is None:
+        batch_size = config.batch_size
+    request_kwargs = dict(
+        timeout=config.timeout,
+        max_retries=config.max_retries,
+        max_concurrency=config.max_concurrency,
+        pool_size=config.pool_size,
+        endpoint_limits=config.endpoint_limits,
+        max_batch_tokens=config.max_batch_tokens,
+        chars_per_token=config.chars_per_token,
+        sort_by_length=config.sort_by_length,
+        backoff_base=config.backoff_base,
+        backoff_max=config.backoff_max,
+        breaker_threshold=config.breaker_threshold,
+        breaker_cooldown=config.breaker_cooldown,
+        health_check_interval=config.health_check_interval,
+        hedge_percentile=config.hedge_percentile,
+        adaptive_concurrency=config.adaptive_concurrency,
+        max_requests_per_second=config.max_requests_per_second,
+        max_texts_per_second=config.max_texts_per_second,
+        rate_limit_dir=config.rate_limit_dir,
+        dtype=config.dtype,
+        local_backend=config.local_backend,
+        record_mode=config.record_mode,
+        record_path=config.record_path,
+    )
+    if config.avert_method == "embedding":
+        request_kwargs["encoding_format"] = config.embedding_encoding
+        request_kwargs["dimensions"] = config.embedding_dimensions
+        if config.embedding_store is not None:
+            if config.grouping != "max":
+                raise ValueError(
+                    "The embedding store requires the 'max' grouping, "
+                    f"got '{config.grouping}'."
+                )
+            request_kwargs["embedding_store"] = get_embedding_store(
+                config.embedding_store,
+                endpoint,
+                model_name=model_name,
+                dimensions=config.embedding_dimensions,
+                arena_path=config.embedding_arena,
+                arena_capacity=config.embedding_arena_capacity,
+            )
+            request_kwargs["rescore_top_k"] = config.rescore_top_k
 
     # Resolve templates strictly from call-level arguments (no global config access)
     base_doc_template = document_template
@@ -116,34 +439,51 @@ def get_candidate_groups_embedings_ranking(
             ]
         last_group = group_name
 
-    # Calculate semantic distances
-    if method == "embedding":
-        all_distances = emb.calculate_embedding_distances(
-            model_response,
-            batch,
-            endpoint,
-            endpoint_type,
-            model_name=model_name,
-            query_template=final_query_template,
-            document_template=final_doc_template,
-            distance_fn=distance_fn,
-            batch_size=batch_size,
-        )
-    elif method == "rerank":
-        all_distances = emb.calculate_reranking_distances(
-            model_response,
-            batch,
-            endpoint,
-            endpoint_type,
-            model_name=model_name,
-            query_template=final_query_template,
-            document_template=final_doc_template,
-        )
-    else:
-        raise ValueError("Embedding distance calculation method not supported.")
+    distance_kwargs = dict(
+        endpoint=endpoint,
+        endpoint_type=endpoint_type,
+        model_name=model_name,
+        query_template=final_query_template,
+        document_template=final_doc_template,
+        batch_size=batch_size,
+        **request_kwargs,
+    )
+    if "embedding_store" in request_kwargs:
+        # Stored candidates are rescored per group
+        distance_kwargs["groups"] = list(indexes_dict.values())
+    return batch, indexes_dict, distance_kwargs
 
+
+def _scores_metadata(config):
+    """Settings stored in the scores file, read when its writer is created."""
+    return {
+        key: value
+        for key, value in config.to_dict().items()
+        if key not in ("INSTRUCTION_MAP", "SCORES_PATH")
+    }
+
+
+def _write_candidate_scores(
+    model_response, indexes_dict, all_distances, config, task, candidate_labels
+):
+    """Add the candidate scores of a ranking call to the scores file."""
+    writer = get_candidate_score_writer(
+        config.scores_path, metadata=lambda: _scores_metadata(config)
+    )
+    groups = list()
+    for group_name, (start, end) in indexes_dict.items():
+        groups += [group_name] * (end - start)
+    writer.add(task, model_response, groups, all_distances, labels=candidate_labels)
+
+
+def _rank_candidate_groups(
+    model_response, candidate_groups_dict, indexes_dict, all_distances, config
+):
+    """Aggregate the candidate distances per group and normalize them into a
+    distribution over the groups.
+    """
     # Select grouping method
-    grouping_method_fn = grouping_module.get_grouping_function(grouping_method)
+    grouping_method_fn = grouping_module.get_grouping_function(config.grouping)
 
     # Split the distances into the corresponding groups
     group_distances_dict = dict()
@@ -153,7 +493,9 @@ def get_candidate_groups_embedings_ranking(
         this_group_distances = all_distances[
             indexes_dict[group_name][0] : indexes_dict[group_name][1]
         ]
-        group_distances_dict[group_name] = grouping_method_fn(this_group_distances)
+        group_distances_dict[group_name] = float(
+            grouping_method_fn(this_group_distances)
+        )
         # Track total score for normalization
         norm_sum += group_distances_dict[group_name]
 
@@ -0,0 +1,163 @@
+"""
+Recorded endpoint responses (`AVERT_RECORD_MODE`).
+
+In `record` mode, the final response of every endpoint request (its status
+code and body) is appended to a recording file. In `replay` mode, requests
+are served from that file without any network call, so a full scoring run can
+be reproduced, deterministically and without a GPU, to re-score samples or to
+benchmark changes of the client.
+
+Requests are identified by a 128-bit digest of the URL path and the payload
+(with sorted keys, so the JSON library does not matter). The host is left out
+so that a recording can be replayed whatever the endpoint or its replicas.
+
+The file starts with `MAGIC` and then holds one record per response: a
+`_HEADER` (digest, status code, size of the data) followed by the body
+compressed with zlib. Records are only appended, each with a single write
+under an exclusive lock, so several processes can record to the same file. A
+record cut short by an interrupted run is dropped.
+"""
+
+import hashlib
+import json
+import os
+import struct
+import threading
+import urllib.parse
+import zlib
+
+from a_vert.logger import get_logger
+
+try:
+    import fcntl
+except ImportError:  # Windows, concurrent writers need one file per process
+    fcntl = None
+
+logger = get_logger(__name__)
+
+RECORD_MODES = ("record", "replay")
+
+MAGIC = b"AVERT-RECORDING-1\n"
+_HEADER = struct.Struct("<16sHI")
+
+# Recordings shared by all the calls of the process, one per file
+_RECORDINGS: dict = {}
+_RECORDINGS_LOCK = threading.Lock()
+
+
+def request_key(url, payload):
+    """Digest identifying the request of `payload` to the path of `url`."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(urllib.parse.urlsplit(url).path.encode("utf-8"))
+    digest.update(b"\n")
+    digest.update(
+        json.dumps(
+            payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+        ).encode("utf-8")
+    )
+    return digest.digest()
+
+
+class RequestRecording:
+    """Append-only file of endpoint responses, indexed by request digest.
+
+    The index (digest to offset of the data) is built when the file is opened
+    and bodies are read from the file when replayed, so memory does not grow
+    with the size of the recording.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._index = dict()
+        self._lock = threading.Lock()
+        self._file = open(path, "a+b")
+        self._load_index()
+
+    def __len__(self):
+        return len(self._index)
+
+    def _load_index(self):
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        try:
+            self._file.seek(0)
+            magic = self._file.read(len(MAGIC))
+            if magic and magic != MAGIC:
+                raise ValueError(f"'{self.path}' is not an A-VERT recording.")
+            offset = len(magic)
+            while True:
+                header = self._file.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+                key, status_code, size = _HEADER.unpack(header)
+                if len(self._file.read(size)) < size:
+                    break
+                self._index.setdefault(key, (offset + _HEADER.size, size, status_code))
+                offset += _HEADER.size + size
+            if offset < self._file.seek(0, os.SEEK_END):
+                # Left by an interrupted writer, new records go in its place
+                logger.warning(
+                    "Dropping an incomplete record at the end of the recording",
+                    path=self.path,
+                )
+                self._file.truncate(offset)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def replay(self, url, payload):
+        """Return the recorded (status code, body) of the request. Raises
+        `ValueError` if it was not recorded.
+        """
+        entry = self._index.get(request_key(url, payload))
+        if entry is None:
+            raise ValueError(
+                f"Request to '{url}' not found in the recording '{self.path}'. "
+                "Record it first (AVERT_RECORD_MODE=record) with the same "
+                "configuration."
+            )
+        offset, size, status_code = entry
+        with self._lock:
+            self._file.seek(offset)
+            data = self._file.read(size)
+        return status_code, zlib.decompress(data)
+
+    def record(self, url, payload, status_code, response_body):
+        """Append the response of the request, unless it is already
+        recorded.
+        """
+        key = request_key(url, payload)
+        if key in self._index:
+            return
+        data = zlib.compress(response_body)
+        record = _HEADER.pack(key, status_code, len(data)) + data
+        with self._lock:
+            if key in self._index:
+                return
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            try:
+                self._file.seek(0, os.SEEK_END)
+                offset = self._file.tell()
+                if offset == 0:
+                    record = MAGIC + record
+                    offset = len(MAGIC)
+                self._file.write(record)
+                self._file.flush()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._index[key] = (offset + _HEADER.size, len(data), status_code)
+
+
+def get_recording(path):
+    """Return the recording of the file at `path`, opened on first use."""
+    path = os.path.abspath(path)
+    recording = _RECORDINGS.get(path)
+    if recording is None:
+        with _RECORDINGS_LOCK:
+            recording = _RECORDINGS.get(path)
+            if recording is None:
+                recording = RequestRecording(path)
+                _RECORDINGS[path] = recording
+    return recording
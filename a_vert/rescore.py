@@ -0,0 +1,325 @@
+"""
+Offline re-scoring of lm-eval sample logs (`a-vert rescore`).
+
+Reads the `samples_<task>_<date>.jsonl` files written by lm-eval
+(`--log_samples`) and scores every logged response again with the
+`process_results` function of the task (its `utils.py` in `lm-eval_tasks`),
+so candidate groups are rebuilt by the option builders of the task and the
+A-VERT configuration comes from the `AVERT_*` environment variables, as in an
+lm-eval run.
+
+Files are streamed in chunks of samples. The samples of a chunk are scored
+concurrently, and the A-VERT rankings their `process_results` run at the same
+time are scored in batches, with one embedding call for the unique texts of
+the batch (see `processing.batch_concurrent_rankings`; rerank and embedding
+store configurations are scored one by one). Each chunk is written as one
+part file of the output directory (Parquet with pyarrow, JSON lines
+otherwise). A checkpoint, updated
+after every part, records the samples done, so an interrupted run resumes
+where it stopped.
+
+A sample whose scoring raises is written with its `error` (null for the
+samples scored) instead of its metrics, and the run goes on. The checkpoint
+lists those samples: resuming skips them, unless `retry_errors` is set.
+Retried samples are written to new parts, the rows of their failed attempt
+stay in the older parts (keep the last row of every `samples_file` and
+`line`).
+"""
+
+import concurrent.futures
+import importlib.util
+import itertools
+import json
+import os
+import re
+import sys
+
+from a_vert import processing
+from a_vert.logger import get_logger
+
+logger = get_logger(__name__)
+
+OUTPUT_FORMATS = ("parquet", "jsonl")
+
+CHECKPOINT_FILE = "_checkpoint.json"
+
+# lm-eval names its sample logs samples_<task>_<date>.jsonl
+_SAMPLES_FILE_PATTERN = re.compile(r"^samples_(.+)_\d{4}-\d{2}-\d{2}T[\d\-.]+$")
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as exc:
+        raise ImportError(
+            "Parquet output requires pyarrow, install it with "
+            "`pip install a-vert[parquet]` or use the jsonl output format."
+        ) from exc
+    return pyarrow
+
+
+def load_task_utils(path):
+    """Import the task module at `path` (the `utils.py` of an lm-eval task),
+    which must define `process_results(doc, results)`.
+    """
+    path = os.path.abspath(path)
+    # Task modules may import their neighbours
+    sys.path.insert(0, os.path.dirname(path))
+    spec = importlib.util.spec_from_file_location("avert_task_utils", path)
+    if spec is None:
+        raise ValueError(f"Cannot import the task module '{path}'.")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    if not callable(getattr(module, "process_results", None)):
+        raise ValueError(f"The task module '{path}' has no process_results function.")
+    return module
+
+
+def task_name(path):
+    """Task of an lm-eval sample log, from its file name."""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    match = _SAMPLES_FILE_PATTERN.match(stem)
+    return match.group(1) if match else stem
+
+
+def _sample_results(sample):
+    """Filtered model responses of a logged sample, as `process_results`
+    receives them.
+    """
+    results = sample.get("filtered_resps", sample.get("resps"))
+    if not isinstance(results, list):
+        return [results]
+    # Unfiltered responses are nested, one list per request
+    return [r[0] if isinstance(r, list) and len(r) == 1 else r for r in results]
+
+
+def _to_python(value):
+    """Plain Python value of a metric (numpy scalars are not serializable)."""
+    if hasattr(value, "item"):
+        return value.item()
+    return value
+
+
+def _score_sample(process_results, sample):
+    metrics = process_results(sample["doc"], _sample_results(sample))
+    return {name: _to_python(value) for name, value in metrics.items()}
+
+
+def _score_chunk(executor, process_results, task, path, chunk):
+    """Score a chunk of (line number, sample). Returns the rows of the chunk
+    and the line numbers of the samples that failed.
+    """
+
+    def score(item):
+        idx, sample = item
+        try:
+            return _score_sample(process_results, sample), None
+        except Exception as exc:
+            logger.warning(
+                "Failed to score sample", path=path, line=idx, error=repr(exc)
+            )
+            return dict(), f"{type(exc).__name__}: {exc}"
+
+    rows = list()
+    failed = list()
+    for (idx, sample), (metrics, error) in zip(chunk, executor.map(score, chunk)):
+        rows.append(
+            dict(
+                task=task,
+                samples_file=os.path.basename(path),
+                line=idx,
+                doc_id=sample.get("doc_id"),
+                filter=sample.get("filter"),
+                error=error,
+                **metrics,
+            )
+        )
+        if error is not None:
+            failed.append(idx)
+    return rows, failed
+
+
+class _Checkpoint:
+    """Samples done and failed per input file and part files written, saved
+    atomically in the output directory.
+    """
+
+    def __init__(self, output_dir, settings):
+        self.path = os.path.join(output_dir, CHECKPOINT_FILE)
+        self.state = dict(settings=settings, done=dict(), errors=dict(), parts=list())
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                state = json.load(f)
+            if state["settings"] != settings:
+                raise ValueError(
+                    f"The output directory '{output_dir}' holds a run with other "
+                    f"settings ({state['settings']}), use another directory."
+                )
+            self.state = state
+            self.state.setdefault("errors", dict())
+            self._remove_unlisted_parts(output_dir)
+
+    def _remove_unlisted_parts(self, output_dir):
+        # Written by an interrupted run before its checkpoint was updated
+        for name in os.listdir(output_dir):
+            if name.startswith("part-") and name not in self.state["parts"]:
+                os.remove(os.path.join(output_dir, name))
+
+    def done(self, path):
+        return self.state["done"].get(os.path.abspath(path), 0)
+
+    def errors(self, path):
+        """Line numbers of the samples of `path` that failed."""
+        return self.state["errors"].get(os.path.abspath(path), list())
+
+    def update(self, path, done, part, errors):
+        self.state["done"][os.path.abspath(path)] = done
+        self.state["errors"][os.path.abspath(path)] = sorted(errors)
+        self.state["parts"].append(part)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def _write_part(rows, path, output_format):
+    tmp_path = path + ".tmp"
+    if output_format == "parquet":
+        pyarrow = _import_pyarrow()
+        # Every row has all the columns of the part, so that none is dropped
+        columns = dict.fromkeys(name for row in rows for name in row)
+        table = pyarrow.Table.from_pylist(
+            [{name: row.get(name) for name in columns} for row in rows]
+        )
+        # Typed even when no sample of the part failed
+        error_idx = table.schema.get_field_index("error")
+        table = table.set_column(
+            error_idx, "error", table["error"].cast(pyarrow.string())
+        )
+        pyarrow.parquet.write_table(table, tmp_path)
+    else:
+        with open(tmp_path, "w") as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+    os.replace(tmp_path, path)
+
+
+def _read_chunks(path, skip, chunk_size):
+    """Yield (line number, sample) chunks of the file, after `skip` lines."""
+    with open(path) as f:
+        lines = itertools.islice(enumerate(f), skip, None)
+        while True:
+            chunk = [
+                (idx, json.loads(line))
+                for idx, line in itertools.islice(lines, chunk_size)
+            ]
+            if not chunk:
+                return
+            yield chunk
+
+
+def _read_lines(path, line_numbers, chunk_size):
+    """Yield (line number, sample) chunks of the lines `line_numbers`."""
+    line_numbers = set(line_numbers)
+    with open(path) as f:
+        lines = ((idx, line) for idx, line in enumerate(f) if idx in line_numbers)
+        while True:
+            chunk = [
+                (idx, json.loads(line))
+                for idx, line in itertools.islice(lines, chunk_size)
+            ]
+            if not chunk:
+                return
+            yield chunk
+
+
+def rescore(
+    samples_files,
+    utils_path,
+    output_dir,
+    output_format="parquet",
+    concurrency=16,
+    chunk_size=1000,
+    retry_errors=False,
+):
+    """Score the samples of `samples_files` again with the `process_results`
+    of the task module `utils_path`, writing the metrics of every sample,
+    with its task, file, line and `doc_id`, to part files in `output_dir`.
+    Samples already done in `output_dir` are skipped, including the ones that
+    failed unless `retry_errors` is set. Returns the number of samples
+    written.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(
+            f"Unknown output format: '{output_format}'. "
+            f"Must be one of: {', '.join(OUTPUT_FORMATS)}"
+        )
+    if output_format == "parquet":
+        _import_pyarrow()
+    os.makedirs(output_dir, exist_ok=True)
+    settings = dict(
+        utils=os.path.abspath(utils_path),
+        output_format=output_format,
+        avert_env={
+            k: v
+            for k, v in sorted(os.environ.items())
+            if k.startswith("AVERT_") and k != "AVERT_LOG_LEVEL"
+        },
+    )
+    checkpoint = _Checkpoint(output_dir, settings)
+    process_results = load_task_utils(utils_path).process_results
+
+    def write_chunk(path, rows, done, errors):
+        part = f"part-{len(checkpoint.state['parts']):05d}.{output_format}"
+        _write_part(rows, os.path.join(output_dir, part), output_format)
+        checkpoint.update(path, done, part, errors)
+        logger.info(
+            "Scored chunk",
+            path=path,
+            samples_done=done,
+            samples_failed=len(errors),
+            part=part,
+        )
+
+    scored = 0
+    with (
+        concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor,
+        processing.batch_concurrent_rankings(max_batch_size=concurrency),
+    ):
+        for path in samples_files:
+            task = task_name(path)
+            skip = checkpoint.done(path)
+            if skip:
+                logger.info(
+                    "Resuming",
+                    path=path,
+                    samples_done=skip,
+                    samples_failed=len(checkpoint.errors(path)),
+                )
+            if retry_errors:
+                for chunk in _read_lines(path, checkpoint.errors(path), chunk_size):
+                    rows, failed = _score_chunk(
+                        executor, process_results, task, path, chunk
+                    )
+                    retried = {idx for idx, _ in chunk}
+                    errors = [
+                        idx for idx in checkpoint.errors(path) if idx not in retried
+                    ]
+                    write_chunk(path, rows, skip, errors + failed)
+                    scored += len(rows)
+            for chunk in _read_chunks(path, skip, chunk_size):
+                rows, failed = _score_chunk(
+                    executor, process_results, task, path, chunk
+                )
+                write_chunk(
+                    path, rows, chunk[-1][0] + 1, checkpoint.errors(path) + failed
+                )
+                scored += len(rows)
+            if checkpoint.errors(path):
+                logger.warning(
+                    "Samples failed, run again with retry_errors to score them",
+                    path=path,
+                    samples_failed=len(checkpoint.errors(path)),
+                )
+    return scored
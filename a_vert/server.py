@@ -0,0 +1,453 @@
+"""
+Local A-VERT scoring service (`a-vert serve`).
+
+Evaluation workers that score through the service share one scorer: its
+endpoint connections, replica pools and caches stay warm across workers and
+runs, instead of being rebuilt by every worker process. Routes:
+- `POST /score`: score one record, in the format of `a_vert.stream`, and
+  return its `distribution` and `prediction` (400 with an `error` if it cannot
+  be scored);
+- `POST /score_batch`: score `{"records": [...]}` and return `{"results":
+  [...]}`, with an `error` field for the records that cannot be scored;
+- `GET /health`, and `GET /stats` with the counters of the service, its cache
+  and the endpoint (see `embedding_tools.get_endpoint_stats`).
+
+Records of all the clients are batched dynamically: records received while
+the workers are busy, or within `max_wait` seconds of each other, are scored
+together (up to `max_batch_size`), with a single embedding call for the unique
+texts of the batch (see
+`processing.get_candidate_groups_embedings_ranking_batch`). Embeddings are
+kept in a least recently used cache of `cache_size` texts, so candidates
+shared by many samples (options, refusal and formulation mistake groups) are
+only embedded once. Records that cannot be turned into candidate groups get
+their error right away; if scoring a batch fails (e.g. on an empty response,
+or an endpoint error), its records are scored again one at a time, so that
+only the failing ones get an error (counted in the `fallbacks` metric). With
+the rerank method, or an embedding store, records are scored one by one,
+`workers` at a time.
+
+Run it with `a-vert serve --port 8765` and call it with `ScoringClient`.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import json
+import threading
+from http import HTTPStatus
+
+import requests
+
+from a_vert import processing, stream
+from a_vert.embedding_tools import get_endpoint_stats
+from a_vert.logger import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_PORT = 8765
+
+# Largest request body accepted, in bytes
+_MAX_BODY_SIZE = 64 * 1024 * 1024
+
+
+class _EmbeddingCache:
+    """Embeddings of the last `max_size` texts used."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._embeddings = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._embeddings)
+
+    def get(self, text):
+        with self._lock:
+            embedding = self._embeddings.get(text)
+            if embedding is None:
+                self.misses += 1
+                return None
+            self._embeddings.move_to_end(text)
+            self.hits += 1
+            return embedding
+
+    def put(self, text, embedding):
+        with self._lock:
+            self._embeddings[text] = embedding
+            self._embeddings.move_to_end(text)
+            while len(self._embeddings) > self.max_size:
+                self._embeddings.popitem(last=False)
+
+    def stats(self):
+        return dict(size=len(self), hits=self.hits, misses=self.misses)
+
+
+def _result(record, distribution=None, error=None):
+    result = dict()
+    if isinstance(record, dict) and "id" in record:
+        result["id"] = record["id"]
+    if error is not None:
+        result["error"] = f"{type(error).__name__}: {error}"
+    else:
+        result.update(stream.distribution_fields(distribution))
+    return result
+
+
+class _Batcher:
+    """Queue of the records to score, scored in batches by `score_batch` on
+    the `executor`, at most `workers` batches at a time.
+    """
+
+    def __init__(self, score_batch, executor, workers, max_batch_size, max_wait):
+        self.score_batch = score_batch
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(workers)
+
+    async def score(self, record):
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((record, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Records queue up while every worker is busy
+            await self._slots.acquire()
+            items = [await self._queue.get()]
+            if self.max_wait > 0 and self._queue.qsize() < self.max_batch_size - 1:
+                await asyncio.sleep(self.max_wait)
+            while len(items) < self.max_batch_size and not self._queue.empty():
+                items.append(self._queue.get_nowait())
+            future = loop.run_in_executor(
+                self.executor, self.score_batch, [record for record, _ in items]
+            )
+            future.add_done_callback(functools.partial(self._done, items))
+
+    def _done(self, items, future):
+        self._slots.release()
+        try:
+            results = future.result()
+        except Exception as exc:
+            results = [_result(record, error=exc) for record, _ in items]
+        for (_, waiter), result in zip(items, results):
+            if not waiter.done():
+                waiter.set_result(result)
+
+
+class ScoringServer:
+    """A-VERT scoring service, see the module documentation.
+
+    Args:
+        config: A-VERT configuration of the scoring (see `a_vert.setup`).
+        host: Address to listen on.
+        port: Port to listen on (0 for any free port, see `url`).
+        max_batch_size: Records scored together at most.
+        max_wait: Seconds a record waits for others to batch with.
+        workers: Batches scored at the same time.
+        cache_size: Embeddings kept in the cache (0 for no cache).
+    """
+
+    def __init__(
+        self,
+        config,
+        host="127.0.0.1",
+        port=DEFAULT_PORT,
+        max_batch_size=64,
+        max_wait=0.005,
+        workers=4,
+        cache_size=100000,
+    ):
+        if max_batch_size < 1 or workers < 1:
+            raise ValueError("max_batch_size and workers must be at least 1.")
+        self.config = config
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.max_wait = max_wait
+        self.batched = (
+            config.avert_method == "embedding" and config.embedding_store is None
+        )
+        self.max_batch_size = max_batch_size if self.batched else 1
+        self.cache = None
+        if self.batched and cache_size > 0:
+            self.cache = _EmbeddingCache(cache_size)
+        self.metrics = dict(requests=0, records=0, batches=0, errors=0, fallbacks=0)
+        self._metrics_lock = threading.Lock()
+        self._executor = None
+        self._batcher = None
+        self._loop = None
+        self._stopping = None
+        self._connections = dict()
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def _count(self, **values):
+        with self._metrics_lock:
+            for name, value in values.items():
+                self.metrics[name] += value
+
+    def score_records(self, records):
+        """Score a list of records (in the format of `a_vert.stream`) and
+        return their results, batched when the configuration allows it. If
+        the batch fails, its records are scored one at a time.
+        """
+        results = [None] * len(records)
+        valid = list()
+        for idx, record in enumerate(records):
+            try:
+                valid.append((idx, record, stream.record_groups(record, self.config)))
+            except Exception as exc:
+                results[idx] = _result(record, error=exc)
+        if self.batched and len(valid) > 1:
+            try:
+                ranked = processing.get_candidate_groups_embedings_ranking_batch(
+                    [record["response"] for _, record, _ in valid],
+                    [groups for _, _, groups in valid],
+                    self.config,
+                    tasks=[record.get("task") or "default" for _, record, _ in valid],
+                    embedding_cache=self.cache,
+                )
+            except Exception as exc:
+                # Score the records one by one, so only the failing ones fail
+                logger.debug("Batch failed, scoring its records", error=str(exc))
+                self._count(fallbacks=1)
+            else:
+                for (idx, record, _), (distribution, _) in zip(valid, ranked):
+                    results[idx] = _result(record, distribution)
+                valid = list()
+        for idx, record, groups in valid:
+            try:
+                distribution, _ = self._score_one(record, groups)
+            except Exception as exc:
+                results[idx] = _result(record, error=exc)
+            else:
+                results[idx] = _result(record, distribution)
+        self._count(
+            batches=1,
+            records=len(records),
+            errors=sum("error" in result for result in results),
+        )
+        return results
+
+    def _score_one(self, record, groups):
+        task = record.get("task") or "default"
+        if self.batched:
+            (result,) = processing.get_candidate_groups_embedings_ranking_batch(
+                [record["response"]],
+                [groups],
+                self.config,
+                tasks=[task],
+                embedding_cache=self.cache,
+            )
+            return result
+        return processing.get_candidate_groups_embedings_ranking(
+            record["response"], groups, self.config, task=task
+        )
+
+    def stats(self):
+        with self._metrics_lock:
+            metrics = dict(self.metrics)
+        metrics["mean_batch_size"] = metrics["records"] / max(metrics["batches"], 1)
+        return dict(
+            service=metrics,
+            cache=self.cache.stats() if self.cache is not None else None,
+            endpoint=get_endpoint_stats(),
+        )
+
+    async def _route(self, method, path, body):
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok"}
+        if method == "GET" and path == "/stats":
+            return 200, self.stats()
+        if method != "POST" or path not in ("/score", "/score_batch"):
+            return 404, {"error": f"Unknown route {method} {path}"}
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return 400, {"error": "Invalid JSON body"}
+        if path == "/score":
+            result = await self._batcher.score(payload)
+            return (400 if "error" in result else 200), result
+        records = payload.get("records") if isinstance(payload, dict) else None
+        if not isinstance(records, list):
+            return 400, {"error": "The body must be an object with a records list"}
+        results = await asyncio.gather(*(self._batcher.score(r) for r in records))
+        return 200, {"results": list(results)}
+
+    async def _handle(self, reader, writer):
+        self._connections[asyncio.current_task()] = writer
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, version = request_line.decode("latin-1").split()
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                if length > _MAX_BODY_SIZE:
+                    status, payload = 413, {"error": "Request body too large"}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length)
+                    self._count(requests=1)
+                    status, payload = await self._route(method, path, body)
+                    keep_alive = (
+                        version == "HTTP/1.1"
+                        and headers.get("connection", "").lower() != "close"
+                    )
+                data = json.dumps(payload).encode("utf-8")
+                writer.write(
+                    (
+                        f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                        "Content-Type: application/json\r\n"
+                        f"Content-Length: {len(data)}\r\n"
+                        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+                        "\r\n"
+                    ).encode("latin-1")
+                    + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            # Client gone or malformed request, drop the connection
+            pass
+        finally:
+            del self._connections[asyncio.current_task()]
+            writer.close()
+
+    async def serve(self, ready=None):
+        """Serve until `stop` is called. `ready` (a `threading.Event`) is set
+        once the service listens.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="avert-scoring"
+        )
+        self._batcher = _Batcher(
+            self.score_records,
+            self._executor,
+            self.workers,
+            self.max_batch_size,
+            self.max_wait,
+        )
+        batcher_task = asyncio.create_task(self._batcher.run())
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = server.sockets[0].getsockname()[1]
+        logger.info(
+            "Scoring service listening",
+            url=self.url,
+            batched=self.batched,
+            max_batch_size=self.max_batch_size,
+            workers=self.workers,
+        )
+        if ready is not None:
+            ready.set()
+        try:
+            await self._stopping.wait()
+        finally:
+            server.close()
+            # Idle keep-alive connections end on the closed transport
+            for writer in self._connections.values():
+                writer.close()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            batcher_task.cancel()
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+    def start(self):
+        """Serve from a background thread, returns the server."""
+        ready = threading.Event()
+        self._thread = threading.Thread(
+            target=lambda: asyncio.run(self.serve(ready)), daemon=True
+        )
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stopping.set)
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class ScoringClient:
+    """Client of a scoring service, keeping its connections open between
+    calls. Safe to share between threads.
+    """
+
+    def __init__(
+        self, url=f"http://127.0.0.1:{DEFAULT_PORT}", timeout=60, pool_size=10
+    ):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _request(self, method, route, payload=None):
+        response = self.session.request(
+            method,
+            self.url + route,
+            data=json.dumps(payload) if payload is not None else None,
+            headers={"Content-Type": "application/json"},
+            timeout=self.timeout,
+        )
+        try:
+            body = response.json()
+        except ValueError:
+            body = dict(error=response.text)
+        if response.status_code != 200:
+            raise ValueError(
+                f"Scoring service error {response.status_code}: {body.get('error')}"
+            )
+        return body
+
+    def score(self, response, correct, wrong, **fields):
+        """Score a model response against its `correct` and `wrong` answers.
+        Other record fields (`options`, `groups`, `task`, see `a_vert.stream`)
+        are given as keyword arguments. Returns the `distribution` and the
+        `prediction`.
+        """
+        record = dict(response=response, correct=correct, wrong=wrong, **fields)
+        return self._request("POST", "/score", record)
+
+    def score_batch(self, records):
+        """Score a list of records, returns their results (with an `error`
+        field for the records that could not be scored).
+        """
+        return self._request("POST", "/score_batch", {"records": records})["results"]
+
+    def stats(self):
+        return self._request("GET", "/stats")
+
+    def close(self):
+        self.session.close()
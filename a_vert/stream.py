@@ -0,0 +1,196 @@
+"""
+Streaming scoring of JSON lines (`a-vert score`).
+
+Every input line is a JSON object with:
+- `response`: the model response to grade;
+- `correct`, `wrong`: the correct and wrong answers (a string or a list);
+- `options` (optional): for multiple choice questions, an object with the
+  `correct_idxs` and `wrong_idxs` of the answers among the options and their
+  `option_symbol` (`letters` by default), to build the options enhancements;
+- `groups` (optional): the candidate groups to score, `["correct", "wrong"]`
+  by default (`refusal` and `formulation_mistake` can be added);
+- `task` (optional): the task, to select the instruction of the templates;
+- `id` (optional): copied to the output.
+
+Every output line is a JSON object with the `line` number of the input (and
+its `id`), the `distribution` over the groups and the `prediction` (the group
+with the highest score), or an `error` message if the line could not be
+scored. Lines are scored concurrently and written as they complete, or in the
+input order with `ordered=True`. At most `max_pending` lines are held at once,
+read but not written yet, so memory stays bounded whatever the input size.
+
+An interrupted run can be resumed: `resume_output` reopens its output file
+and returns the input lines already written, which `score_stream` skips.
+"""
+
+import concurrent.futures
+import json
+import os
+import threading
+
+from a_vert import processing
+from a_vert.logger import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_GROUPS = ("correct", "wrong")
+
+
+def _as_list(texts):
+    return [texts] if isinstance(texts, str) else list(texts)
+
+
+def record_groups(record, config):
+    """Candidate groups of an input record (see the module documentation)."""
+    options = record.get("options")
+    option_kwargs = dict()
+    if options:
+        option_kwargs = dict(
+            with_options=config.enhance,
+            option_symbol=options.get("option_symbol", "letters"),
+            correct_group_idxs=options["correct_idxs"],
+            wrong_group_idxs=options["wrong_idxs"],
+        )
+    return processing.construct_candidate_groups(
+        _as_list(record["correct"]),
+        _as_list(record["wrong"]),
+        list(record.get("groups", DEFAULT_GROUPS)),
+        enhance=config.enhance,
+        **option_kwargs,
+    )
+
+
+def score_record(record, config):
+    """Score one input record (see the module documentation), returns the
+    group distribution.
+    """
+    distribution, _ = processing.get_candidate_groups_embedings_ranking(
+        record["response"],
+        record_groups(record, config),
+        config,
+        task=record.get("task") or "default",
+    )
+    return distribution
+
+
+def distribution_fields(distribution):
+    """Output fields of a scored record: the `distribution` and the
+    `prediction`.
+    """
+    return dict(
+        distribution={k: float(v) for k, v in distribution.items()},
+        prediction=max(distribution, key=distribution.get),
+    )
+
+
+def _score_line(line_number, line, config):
+    """Output line of the input `line`."""
+    result = dict(line=line_number)
+    try:
+        record = json.loads(line)
+        if "id" in record:
+            result["id"] = record["id"]
+        distribution = score_record(record, config)
+    except Exception as exc:
+        logger.warning("Failed to score line", line=line_number, error=str(exc))
+        result["error"] = f"{type(exc).__name__}: {exc}"
+    else:
+        result.update(distribution_fields(distribution))
+    return json.dumps(result)
+
+
+class _Writer:
+    """Writes the output lines, as they complete or in input order, and frees
+    a pending slot for every line written.
+    """
+
+    def __init__(self, output, slots, ordered):
+        self.output = output
+        self.slots = slots
+        self.ordered = ordered
+        self.next_idx = 0
+        self.completed = dict()
+        self.written = 0
+        self.error = None
+        self._lock = threading.Lock()
+
+    def _write(self, text):
+        try:
+            if self.error is None:
+                self.output.write(text + "\n")
+                self.output.flush()
+                self.written += 1
+        except OSError as exc:
+            # e.g. the reading end of the pipe was closed
+            self.error = exc
+        finally:
+            self.slots.release()
+
+    def add(self, idx, future):
+        text = future.result()
+        with self._lock:
+            if not self.ordered:
+                self._write(text)
+                return
+            self.completed[idx] = text
+            while self.next_idx in self.completed:
+                self._write(self.completed.pop(self.next_idx))
+                self.next_idx += 1
+
+
+def resume_output(path, retry_errors=False):
+    """Reopen the output file `path` of an interrupted run for appending.
+    Returns the file and the set of the input line numbers already written,
+    except the ones that failed if `retry_errors` is set. A last line cut
+    short by the interruption is removed.
+    """
+    done = set()
+    if not os.path.exists(path):
+        return open(path, "w"), done
+    with open(path, "rb+") as f:
+        complete = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            complete += len(line)
+            result = json.loads(line)
+            if not (retry_errors and "error" in result):
+                done.add(result["line"])
+        f.truncate(complete)
+    return open(path, "a"), done
+
+
+def score_stream(
+    input,
+    output,
+    config,
+    concurrency=16,
+    ordered=False,
+    max_pending=None,
+    skip=None,
+):
+    """Score the JSON lines of the `input` file object and write the results
+    to `output` (see the module documentation). `concurrency` lines are
+    scored at the same time, and at most `max_pending` (4 x `concurrency` by
+    default) are held in memory. Input line numbers in `skip` (see
+    `resume_output`) are not scored. Returns the number of lines written.
+    """
+    skip = skip or set()
+    if max_pending is None:
+        max_pending = 4 * concurrency
+    slots = threading.BoundedSemaphore(max_pending)
+    writer = _Writer(output, slots, ordered)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        idx = 0
+        for line_number, line in enumerate(input):
+            if not line.strip() or line_number in skip:
+                continue
+            slots.acquire()
+            if writer.error is not None:
+                break
+            future = executor.submit(_score_line, line_number, line, config)
+            future.add_done_callback(lambda f, idx=idx: writer.add(idx, f))
+            idx += 1
+    if writer.error is not None:
+        raise writer.error
+    return writer.written
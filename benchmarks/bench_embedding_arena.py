@@ -0,0 +1,115 @@
+"""Node memory of the candidate-embedding store with several worker processes.
+
+Starts `--workers` processes that each look up and score all the
+`--candidates` synthetic candidate embeddings, held either in a store per
+process (`AVERT_EMBEDDING_STORE` alone) or in one `SharedEmbeddingArena`
+(`AVERT_EMBEDDING_ARENA`), filled by the first worker and mapped by the
+others. The memory of the store in every worker is measured as the growth of
+its proportional set size (PSS, pages shared by several processes are split
+between them), so the sum over the workers is the memory of the node. Linux
+only (reads `/proc/self/smaps_rollup`). No server is needed.
+
+Usage:
+    python benchmarks/bench_embedding_arena.py [--workers 1 2 4 8]
+        [--candidates 200000] [--dim 1024] [--quantization int8]
+"""
+
+import argparse
+import multiprocessing
+import os
+import tempfile
+
+import numpy as np
+
+from a_vert import embedding_store
+
+
+def pss_bytes():
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            if line.startswith("Pss:"):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("No Pss in /proc/self/smaps_rollup")
+
+
+def candidate_embeddings(start, end, dim):
+    """Synthetic embeddings of the candidates [start, end), in chunks."""
+    rng = np.random.default_rng(start)
+    return rng.standard_normal((end - start, dim), dtype=np.float32)
+
+
+def worker(args, arena_path, filled, barrier, queue):
+    texts = [f"candidate {idx}" for idx in range(args.candidates)]
+    before = pss_bytes()
+    if arena_path is None:
+        store = embedding_store.QuantizedEmbeddingStore(args.quantization)
+    else:
+        store = embedding_store.SharedEmbeddingArena(
+            arena_path, args.quantization, capacity=args.candidates
+        )
+    if arena_path is None or not filled.is_set():
+        for start in range(0, args.candidates, args.chunk):
+            end = min(start + args.chunk, args.candidates)
+            store.add(texts[start:end], candidate_embeddings(start, end, args.dim))
+        filled.set()
+    # Score every candidate once, as the workers of a run would
+    response = np.ones(args.dim, dtype=np.float32)
+    found = 0
+    for start in range(0, args.candidates, args.chunk):
+        rows = store.lookup(texts[start : start + args.chunk])
+        found += int((rows >= 0).sum())
+        store.get(rows[rows >= 0]) @ response
+    # Measured while all the workers map the arena
+    barrier.wait()
+    queue.put((pss_bytes() - before, found))
+    barrier.wait()
+
+
+def run(args, n_workers, shared):
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    filled = context.Event()
+    barrier = context.Barrier(n_workers)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        arena_path = os.path.join(tmp_dir, "arena.bin") if shared else None
+        # The first worker fills the store, the others start once it is full
+        first = context.Process(
+            target=worker, args=(args, arena_path, filled, barrier, queue)
+        )
+        first.start()
+        filled.wait()
+        others = [
+            context.Process(
+                target=worker, args=(args, arena_path, filled, barrier, queue)
+            )
+            for _ in range(n_workers - 1)
+        ]
+        for process in others:
+            process.start()
+        results = [queue.get() for _ in range(n_workers)]
+        for process in [first] + others:
+            process.join()
+    assert all(found == args.candidates for _, found in results)
+    return sum(memory for memory, _ in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--candidates", type=int, default=200000)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument(
+        "--quantization", choices=embedding_store.QUANTIZATIONS, default="int8"
+    )
+    parser.add_argument("--chunk", type=int, default=10000)
+    args = parser.parse_args()
+
+    print(f"{'workers':>8} {'per process (MiB)':>18} {'arena (MiB)':>12}")
+    for n_workers in args.workers:
+        per_process = run(args, n_workers, shared=False)
+        shared = run(args, n_workers, shared=True)
+        print(f"{n_workers:>8} {per_process / 2**20:>18.1f} {shared / 2**20:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Accuracy vs. embedding dimensions.
+
+Grades a synthetic set of MMLU-style responses (correct answers, wrong
+answers and refusals, with options-enhanced candidate groups) with the full
+embeddings and with reduced (Matryoshka) embeddings of every requested size
+(`AVERT_EMBEDDING_DIMENSIONS`), and reports for each size:
+- the accuracy of the predicted group (the group with the highest score);
+- the agreement with the predictions of the full embeddings;
+- the mean absolute change of the group scores;
+- the embedding size and the time spent grading.
+
+It needs an embedding endpoint, configured as usual with the `AVERT_*`
+environment variables (`AVERT_METHOD` must be `embedding`). Accuracy only
+means something with a real embedding model.
+
+Usage:
+    python benchmarks/bench_embedding_dimensions.py [--dims 64 128 256 512]
+        [--samples 200] [--options 4]
+"""
+
+import argparse
+import random
+import time
+
+import a_vert
+from a_vert import processing
+from bench_length_sorting import LONG_ANSWERS, MEDIUM_ANSWERS, QUERY, SHORT_ANSWERS
+
+GROUPS = ["correct", "wrong", "refusal", "formulation_mistake"]
+REFUSAL = "I'm sorry, but I don't know the answer to this question."
+
+
+def make_labeled_sample(rng, n_options=4):
+    """Return the candidate groups, a model response and its expected group."""
+    pools = [SHORT_ANSWERS, MEDIUM_ANSWERS, LONG_ANSWERS]
+    choices = rng.sample(sum(pools, []), n_options)
+    target_idx = rng.randrange(n_options)
+    wrong_idxs = [i for i in range(n_options) if i != target_idx]
+    groups = processing.construct_candidate_groups(
+        [choices[target_idx]],
+        [choices[i] for i in wrong_idxs],
+        GROUPS,
+        enhance=True,
+        with_options=True,
+        option_symbol="letters",
+        correct_group_idxs=[target_idx],
+        wrong_group_idxs=wrong_idxs,
+    )
+    draw = rng.random()
+    if draw < 0.6:
+        return groups, QUERY.format(answer=choices[target_idx]), "correct"
+    if draw < 0.9:
+        answer = choices[rng.choice(wrong_idxs)]
+        return groups, QUERY.format(answer=answer), "wrong"
+    return groups, REFUSAL, "refusal"
+
+
+def grade(samples, config):
+    """Return the group scores of every sample and the elapsed seconds."""
+    start = time.perf_counter()
+    scores = [
+        processing.get_candidate_groups_embedings_ranking(response, groups, config)[0]
+        for groups, response, _ in samples
+    ]
+    return scores, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--dims", type=int, nargs="+", default=[64, 128, 256, 512])
+    parser.add_argument("--samples", type=int, default=200)
+    parser.add_argument("--options", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    config = a_vert.setup()
+    if config.avert_method != "embedding":
+        raise ValueError("AVERT_METHOD must be 'embedding' for this benchmark.")
+    rng = random.Random(args.seed)
+    samples = [make_labeled_sample(rng, args.options) for _ in range(args.samples)]
+    print(f"samples={args.samples} options={args.options}")
+
+    config.embedding_dimensions = None
+    full_scores, full_seconds = grade(samples, config)
+    full_predictions = [max(s, key=s.get) for s in full_scores]
+    full_dim = len(
+        a_vert.embedding_tools.get_embedding(
+            "dimensions probe",
+            config.avert_model_endpoint,
+            config.avert_endpoint_type,
+            model_name=config.avert_model_name,
+        )[0]
+    )
+
+    for dimensions in sorted(d for d in args.dims if d < full_dim) + [None]:
+        if dimensions is None:
+            scores, seconds = full_scores, full_seconds
+        else:
+            config.embedding_dimensions = dimensions
+            scores, seconds = grade(samples, config)
+        predictions = [max(s, key=s.get) for s in scores]
+        accuracy = sum(
+            prediction == label
+            for prediction, (_, _, label) in zip(predictions, samples)
+        ) / len(samples)
+        agreement = sum(
+            prediction == full
+            for prediction, full in zip(predictions, full_predictions)
+        ) / len(samples)
+        score_change = sum(
+            abs(s[group] - f[group])
+            for s, f in zip(scores, full_scores)
+            for group in GROUPS
+        ) / (len(samples) * len(GROUPS))
+        size = full_dim if dimensions is None else dimensions
+        print(
+            f"dimensions={size:<5} accuracy={accuracy:.1%} "
+            f"agreement={agreement:.1%} score_change={score_change:.4f} "
+            f"bytes/embedding={size * 4} seconds={seconds:.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
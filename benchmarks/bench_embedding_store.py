@@ -0,0 +1,121 @@
+"""Memory and decision agreement of the quantized candidate-embedding store.
+
+Builds synthetic candidate groups whose embeddings share a common component
+(real embeddings are far from isotropic, cosine similarities between
+unrelated texts of 0.3-0.6 are usual) and model responses close to one
+candidate of the expected group. Every sample is scored with the exact
+embeddings and with the `int8` and `binary` stores of
+`a_vert.embedding_store`, rescoring the `k` best stored candidates of every
+group with their exact embeddings as `calculate_embedding_distances` does,
+and the `max` group decisions are compared. No server is needed: the exact
+embeddings of the rescored candidates are taken from the synthetic table.
+
+Usage:
+    python benchmarks/bench_embedding_store.py [--samples 2000] [--dim 1024]
+        [--candidates 4000] [--top-k 0 1 2 4 8]
+"""
+
+import argparse
+
+import numpy as np
+from scipy import spatial
+
+from a_vert import embedding_store
+from a_vert import embedding_tools as emb
+
+GROUP_SIZES = (12, 24, 4, 4)
+
+
+def normalize(x):
+    return x / np.linalg.norm(x, axis=-1, keepdims=True)
+
+
+def make_samples(rng, n_samples, n_candidates, dim):
+    """Return the candidate texts and embeddings and, for every sample, its
+    candidate indexes, groups (start, end) and response embedding.
+    """
+    common = rng.standard_normal(dim)
+    embeddings = normalize(
+        0.8 * normalize(common) + normalize(rng.standard_normal((n_candidates, dim)))
+    ).astype(np.float32)
+    texts = [f"candidate {idx}" for idx in range(n_candidates)]
+    samples = list()
+    for _ in range(n_samples):
+        candidates = rng.choice(n_candidates, sum(GROUP_SIZES), replace=False)
+        bounds = np.cumsum((0,) + GROUP_SIZES)
+        groups = list(zip(bounds[:-1], bounds[1:]))
+        target = rng.choice(candidates)
+        # Responses paraphrase one candidate more or less closely
+        noise = rng.uniform(1.0, 8.0)
+        response = normalize(
+            embeddings[target] + noise * normalize(rng.standard_normal(dim))
+        ).astype(np.float32)
+        samples.append((candidates, groups, response))
+    return texts, embeddings, samples
+
+
+def decide(similarities, groups):
+    return int(np.argmax([similarities[start:end].max() for start, end in groups]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--samples", type=int, default=2000)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--candidates", type=int, default=4000)
+    parser.add_argument("--top-k", type=int, nargs="+", default=[0, 1, 2, 4, 8])
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    texts, embeddings, samples = make_samples(
+        rng, args.samples, args.candidates, args.dim
+    )
+    exact = [
+        decide(
+            emb._embedding_similarities(
+                response, embeddings[candidates], spatial.distance.cosine
+            ),
+            groups,
+        )
+        for candidates, groups, response in samples
+    ]
+    print(
+        f"samples={args.samples} dim={args.dim} candidates={args.candidates} "
+        f"float32={args.dim * 4} B/vector float64={args.dim * 8} B/vector"
+    )
+
+    for quantization in embedding_store.QUANTIZATIONS:
+        store = embedding_store.QuantizedEmbeddingStore(quantization)
+        store.add(texts, embeddings)
+        per_vector = store.nbytes / len(store)
+        for top_k in args.top_k:
+            agree = 0
+            rescored = 0
+            for (candidates, groups, response), decision in zip(samples, exact):
+                batch = [texts[idx] for idx in candidates]
+                similarities, fetch, missing = emb._stored_similarities(
+                    response, batch, store, groups, top_k, spatial.distance.cosine
+                )
+                emb._rescore_similarities(
+                    similarities,
+                    response,
+                    batch,
+                    fetch,
+                    missing,
+                    embeddings[candidates[fetch]],
+                    store,
+                    spatial.distance.cosine,
+                )
+                agree += decide(similarities, groups) == decision
+                rescored += len(fetch)
+            print(
+                f"store={quantization:<6} bytes/vector={per_vector:.0f} "
+                f"(float32/{args.dim * 4 / per_vector:.1f}) rescore_top_k={top_k} "
+                f"rescored/sample={rescored / len(samples):.1f} "
+                f"same_decision={agree / len(samples):.2%}"
+            )
+
+
+if __name__ == "__main__":
+    main()
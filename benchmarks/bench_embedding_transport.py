@@ -0,0 +1,95 @@
+"""Parse time of float vs. base64 embedding responses.
+
+vLLM (and any OpenAI-compatible server) can return embeddings either as JSON
+lists of numbers (`encoding_format: "float"`) or as the base64 string of
+their float32 bytes (`encoding_format: "base64"`). This script builds the
+response body of a batch in both formats, with the dimensions of common
+embedding models, and times the parser used by `a_vert.embedding_tools` on
+each of them. It does not need an endpoint.
+
+Usage:
+    python benchmarks/bench_embedding_transport.py [--batch-size 32]
+        [--dims 1024 4096] [--repeats 20]
+"""
+
+import argparse
+import base64
+import json
+import time
+
+import numpy as np
+
+from a_vert import embedding_tools as emb
+
+
+def make_body(embeddings, encoding_format):
+    """Return the `/v1/embeddings` response body of `embeddings`."""
+    if encoding_format == "base64":
+        data = [
+            base64.b64encode(embedding.astype("<f4").tobytes()).decode("ascii")
+            for embedding in embeddings
+        ]
+    else:
+        data = [embedding.tolist() for embedding in embeddings]
+    return json.dumps(
+        {
+            "object": "list",
+            "data": [
+                {"object": "embedding", "index": idx, "embedding": embedding}
+                for idx, embedding in enumerate(data)
+            ],
+            "model": "avert-model",
+        }
+    )
+
+
+def time_parse(parse, body, repeats):
+    """Return the median parse time (in seconds) and the parsed array."""
+    times = list()
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = parse(body)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times)), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--dims", type=int, nargs="+", default=[1024, 4096])
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print(f"batch_size={args.batch_size} repeats={args.repeats}")
+    for dim in args.dims:
+        embeddings = rng.standard_normal((args.batch_size, dim), dtype=np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        results = dict()
+        for encoding_format in ("float", "base64"):
+            body = make_body(embeddings, encoding_format)
+            _, _, parse, _ = emb._vllm_embedding_request(
+                ["text"],
+                "http://localhost",
+                "avert-model",
+                encoding_format=encoding_format,
+            )
+            seconds, parsed = time_parse(parse, body, args.repeats)
+            results[encoding_format] = (seconds, parsed)
+            print(
+                f"dim={dim:<5} encoding={encoding_format:<6} "
+                f"body={len(body) / 1e6:.2f} MB parse={seconds * 1e3:.2f} ms"
+            )
+        same = np.array_equal(
+            results["float"][1].astype(np.float32), results["base64"][1]
+        )
+        print(
+            f"dim={dim:<5} base64 speedup: "
+            f"{results['float'][0] / results['base64'][0]:.1f}x "
+            f"(identical values: {same})"
+        )
+
+
+if __name__ == "__main__":
+    main()
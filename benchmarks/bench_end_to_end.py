@@ -0,0 +1,326 @@
+"""End-to-end throughput and latency of A-VERT scoring.
+
+Runs `construct_candidate_groups` and `get_candidate_groups_embedings_ranking`
+the way the lm-eval tasks of this repository do, for synthetic samples with
+realistic shapes:
+- `mmlu`: 4 options, options enhancement, chain-of-thought responses;
+- `mmlu_pro`: 10 options, options enhancement, chain-of-thought responses;
+- `babi`: open-ended single-word answers from a small world, short responses;
+- `gsm8k`: numeric answers with the GSM8K wrong-number heuristic, step by
+  step responses.
+
+Every (workload, method) pair runs in its own process against the bundled mock
+server (`a_vert.mock_server`, started in another process) or against the
+endpoint given with `--endpoint`, and reports:
+- samples/s and the p50/p99 latency of a sample;
+- the client CPU time per sample (all the threads of the process);
+- the peak resident memory of the process.
+
+Other `AVERT_*` variables of the environment (batch size, concurrency, ...)
+apply as usual. Results are saved as JSON, together with the settings and
+versions, and `--compare` prints the change against a previous results file,
+flagging the regressions.
+
+Usage:
+    python benchmarks/bench_end_to_end.py [--samples 300] [--concurrency 8]
+        [--workloads mmlu mmlu_pro babi gsm8k] [--methods embedding rerank]
+        [--output results.json] [--compare previous.json]
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+WORKLOADS = ("mmlu", "mmlu_pro", "babi", "gsm8k")
+METHODS = ("embedding", "rerank")
+
+# Metrics where a higher value is better, the rest are better lower
+HIGHER_IS_BETTER = ("samples_per_s",)
+
+ANSWERS = [
+    "The mitochondria",
+    "Increase in aggregate demand",
+    "Only statements I and III",
+    "A decrease in entropy",
+    "The Treaty of Versailles",
+    "True",
+    "42",
+    "Paris",
+    "Because the marginal cost of production exceeds the marginal revenue.",
+    "The court ruled that the statute violated the due process clause.",
+    "An increase in the reserve requirement reduces the money supply.",
+    "The enzyme lowers the activation energy of the reaction.",
+]
+REASONING = (
+    "Let's analyze each option carefully. The question describes a situation "
+    "where several factors interact, so we need to recall the relevant "
+    "definitions and discard the options that contradict them. "
+)
+BABI_WORLD = ["kitchen", "garden", "office", "hallway", "bathroom", "bedroom"]
+BABI_NAMES = ["Mary", "John", "Sandra", "Daniel"]
+
+
+def _options_sample(rng, n_options):
+    choices = rng.sample(ANSWERS, n_options)
+    target_idx = rng.randrange(n_options)
+    answer_idx = target_idx if rng.random() < 0.7 else rng.randrange(n_options)
+    letter = chr(ord("A") + answer_idx)
+    response = (
+        REASONING * rng.randint(2, 8)
+        + f"Therefore, the answer is ({letter}) {choices[answer_idx]}."
+    )
+    correct = [choices[target_idx]]
+    wrong_idxs = [idx for idx in range(n_options) if idx != target_idx]
+    wrong = [choices[idx] for idx in wrong_idxs]
+    options = dict(
+        with_options=True,
+        option_symbol="letters",
+        correct_group_idxs=[target_idx],
+        wrong_group_idxs=wrong_idxs,
+    )
+    return correct, wrong, options, response
+
+
+def make_sample(workload, rng):
+    """Return the (correct, wrong, construction options, response) of a
+    synthetic sample of `workload`.
+    """
+    if workload == "mmlu":
+        return _options_sample(rng, 4)
+    if workload == "mmlu_pro":
+        return _options_sample(rng, 10)
+    if workload == "babi":
+        target = rng.choice(BABI_WORLD)
+        wrong = [place for place in BABI_WORLD if place != target]
+        answer = target if rng.random() < 0.7 else rng.choice(wrong)
+        response = f"{rng.choice(BABI_NAMES)} is in the {answer}."
+        return [target], wrong, dict(), response
+    if workload == "gsm8k":
+        target = rng.randint(2, 2000)
+        wrong = sorted(
+            {
+                int(np.floor(target * 0.1)),
+                int(np.floor(target * 0.5)),
+                int(np.ceil(target * 1.25)),
+                int(np.ceil(target * 1.8)),
+            }
+            - {target}
+        )
+        answer = target if rng.random() < 0.7 else rng.choice(wrong)
+        steps = "".join(
+            f"Step {idx}: we compute {rng.randint(1, 99)} * {rng.randint(1, 99)} "
+            f"and add it to the previous total. "
+            for idx in range(rng.randint(3, 10))
+        )
+        return [str(target)], [str(a) for a in wrong], dict(), steps + f"#### {answer}"
+    raise ValueError(f"Unknown workload: '{workload}'")
+
+
+def run_one(workload, samples, concurrency, seed):
+    """Score `samples` samples of `workload` with the configuration of the
+    environment, returns the metrics. Runs in its own process.
+    """
+    import a_vert
+
+    config = a_vert.setup()
+    rng = random.Random(seed)
+    inputs = [make_sample(workload, rng) for _ in range(samples)]
+
+    def score(sample):
+        correct, wrong, options, response = sample
+        start = time.perf_counter()
+        groups = a_vert.processing.construct_candidate_groups(
+            correct, wrong, ["correct", "wrong"], enhance=config.enhance, **options
+        )
+        a_vert.processing.get_candidate_groups_embedings_ranking(
+            response, groups, config
+        )
+        return time.perf_counter() - start, sum(len(g) for g in groups.values())
+
+    # Warm up the connections and the code paths
+    for sample in inputs[: min(5, samples)]:
+        score(sample)
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(score, inputs))
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    latencies = np.array([latency for latency, _ in results])
+    return dict(
+        candidates_per_sample=float(np.mean([n for _, n in results])),
+        samples_per_s=samples / elapsed,
+        latency_p50_ms=float(np.percentile(latencies, 50) * 1e3),
+        latency_p99_ms=float(np.percentile(latencies, 99) * 1e3),
+        cpu_per_sample_ms=cpu / samples * 1e3,
+        # ru_maxrss is in KiB on Linux (bytes on macOS)
+        peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        / (1 << 20 if sys.platform == "darwin" else 1 << 10),
+    )
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_mock_server(args):
+    """Start the mock server in another process, returns (process, url)."""
+    port = _free_port()
+    command = [
+        sys.executable,
+        "-m",
+        "a_vert.mock_server",
+        "--port",
+        str(port),
+        "--dim",
+        str(args.dim),
+        "--latency",
+        str(args.latency),
+        "--latency-dist",
+        args.latency_dist,
+    ]
+    process = subprocess.Popen(command)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return process, url
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("The mock server did not start")
+
+
+def compare(results, previous_path, tolerance):
+    """Print the change of every metric against a previous results file."""
+    with open(previous_path) as f:
+        previous = {
+            (r["workload"], r["method"]): r["metrics"] for r in json.load(f)["results"]
+        }
+    print(f"\nChange against {previous_path} (! marks regressions > {tolerance:.0%}):")
+    for result in results:
+        before = previous.get((result["workload"], result["method"]))
+        if before is None:
+            continue
+        changes = list()
+        for name, value in result["metrics"].items():
+            if name not in before or not before[name]:
+                continue
+            change = value / before[name] - 1
+            worse = -change if name in HIGHER_IS_BETTER else change
+            flag = "!" if worse > tolerance else " "
+            changes.append(f"{flag}{name}={change:+.1%}")
+        print(f"{result['workload']:>9} {result['method']:<9} " + " ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--workloads", nargs="+", choices=WORKLOADS, default=WORKLOADS)
+    parser.add_argument("--methods", nargs="+", choices=METHODS, default=METHODS)
+    parser.add_argument("--samples", type=int, default=300)
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="Samples scored at the same time"
+    )
+    parser.add_argument("--endpoint", help="Endpoint to use instead of the mock")
+    parser.add_argument("--endpoint-type", default="tei")
+    parser.add_argument("--model-name", default="avert-model")
+    parser.add_argument("--dim", type=int, default=1024, help="Mock server only")
+    parser.add_argument("--latency", type=float, default=0.0, help="Mock server only")
+    parser.add_argument("--latency-dist", default="constant", help="Mock server only")
+    parser.add_argument("--output", default="bench_end_to_end.json")
+    parser.add_argument("--compare", help="Previous results file")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--run-one", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        metrics = run_one(args.run_one, args.samples, args.concurrency, args.seed)
+        print(json.dumps(metrics))
+        return
+
+    server = None
+    endpoint = args.endpoint
+    if endpoint is None:
+        server, endpoint = start_mock_server(args)
+    results = list()
+    try:
+        for method in args.methods:
+            for workload in args.workloads:
+                env = dict(
+                    os.environ,
+                    AVERT_MODEL_ENDPOINT=endpoint,
+                    AVERT_ENDPOINT_TYPE=args.endpoint_type,
+                    AVERT_MODEL_NAME=args.model_name,
+                    AVERT_METHOD=method,
+                )
+                env.setdefault("AVERT_PROMPT_TEMPLATE", "empty")
+                command = [
+                    sys.executable,
+                    __file__,
+                    "--run-one",
+                    workload,
+                    "--samples",
+                    str(args.samples),
+                    "--concurrency",
+                    str(args.concurrency),
+                    "--seed",
+                    str(args.seed),
+                ]
+                output = subprocess.run(
+                    command, env=env, check=True, capture_output=True, text=True
+                ).stdout
+                metrics = json.loads(output.strip().splitlines()[-1])
+                results.append(dict(workload=workload, method=method, metrics=metrics))
+                print(
+                    f"{workload:>9} {method:<9} "
+                    f"candidates={metrics['candidates_per_sample']:.0f} "
+                    f"samples/s={metrics['samples_per_s']:.1f} "
+                    f"p50={metrics['latency_p50_ms']:.1f} ms "
+                    f"p99={metrics['latency_p99_ms']:.1f} ms "
+                    f"cpu/sample={metrics['cpu_per_sample_ms']:.2f} ms "
+                    f"peak_rss={metrics['peak_rss_mb']:.0f} MB"
+                )
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    settings = {k: v for k, v in vars(args).items() if k not in ("run_one",)}
+    settings["endpoint"] = args.endpoint or "mock"
+    report = dict(
+        date=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        git_commit=subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip(),
+        python=platform.python_version(),
+        numpy=np.__version__,
+        machine=f"{platform.machine()} {os.cpu_count()} CPUs",
+        settings=settings,
+        avert_env={k: v for k, v in os.environ.items() if k.startswith("AVERT_")},
+        results=results,
+    )
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {args.output}")
+    if args.compare:
+        compare(results, args.compare, args.tolerance)
+
+
+if __name__ == "__main__":
+    main()
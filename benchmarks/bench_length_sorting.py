@@ -0,0 +1,146 @@
+"""Padding waste of length-sorted vs. unsorted batching.
+
+The embedding/reranker server pads every batch to its longest sequence, so
+the number of tokens it actually computes is `batch_len * longest_in_batch`
+for each batch. This script builds options-enhanced MMLU-style candidate
+groups (the workload where 1-word answers are mixed with multi-line option
+recaps), splits them exactly as `a_vert.embedding_tools` does, and compares
+the padded token count with and without `sort_by_length`.
+
+Server throughput is bound by the padded tokens it computes, so the ratio of
+padded tokens (unsorted / sorted) is the expected throughput gain.
+
+Usage:
+    python benchmarks/bench_length_sorting.py [--samples 500] [--batch-size 32]
+        [--max-batch-tokens 512] [--options 4]
+"""
+
+import argparse
+import random
+
+import numpy as np
+
+from a_vert import embedding_tools as emb
+from a_vert import processing
+
+# Answer pool with realistic MMLU length spread, from single tokens to
+# sentence-long answers.
+SHORT_ANSWERS = ["True", "False", "42", "1/2", "None", "Paris", "H2O", "III"]
+MEDIUM_ANSWERS = [
+    "The mitochondria",
+    "Increase in aggregate demand",
+    "Only statements I and III",
+    "A decrease in entropy",
+    "The Treaty of Versailles",
+]
+LONG_ANSWERS = [
+    "Because the marginal cost of production exceeds the marginal revenue at every level of output.",
+    "The court ruled that the statute was unconstitutional because it violated the due process clause.",
+    "An increase in the reserve requirement reduces the money multiplier and therefore the money supply.",
+    "The enzyme lowers the activation energy of the reaction without being consumed in the process.",
+]
+QUERY = (
+    "Let me think step by step. The question asks which of the options is "
+    "correct. After discarding the ones that contradict the statement, the "
+    "answer is (B) {answer}."
+)
+
+
+def make_sample(rng, n_options=4):
+    """Return the candidate groups and a model response for one sample."""
+    pools = [SHORT_ANSWERS, MEDIUM_ANSWERS, LONG_ANSWERS]
+    choices = [rng.choice(rng.choice(pools)) for _ in range(n_options)]
+    target_idx = rng.randrange(n_options)
+    correct = [choices[target_idx]]
+    wrong = [c for i, c in enumerate(choices) if i != target_idx]
+    wrong_idxs = [i for i in range(n_options) if i != target_idx]
+    groups = processing.construct_candidate_groups(
+        correct,
+        wrong,
+        ["correct", "wrong"],
+        enhance=True,
+        with_options=True,
+        option_symbol="letters",
+        correct_group_idxs=[target_idx],
+        wrong_group_idxs=wrong_idxs,
+    )
+    candidates = groups["correct"] + groups["wrong"]
+    return candidates, QUERY.format(answer=choices[target_idx])
+
+
+def padded_tokens(
+    candidates, batch_size, sort_by_length, query_tokens=0, max_batch_tokens=None
+):
+    """Return (real, padded) estimated tokens computed by the server."""
+    if sort_by_length:
+        order = emb._length_order(candidates)
+        candidates = [candidates[idx] for idx in order]
+    real = 0
+    padded = 0
+    batches = emb._split_in_batches(
+        candidates,
+        batch_size,
+        max_batch_tokens=max_batch_tokens,
+        query_tokens=query_tokens,
+    )
+    for batch in batches:
+        lengths = [query_tokens + emb.estimate_tokens(text) for text in batch]
+        real += sum(lengths)
+        padded += len(lengths) * max(lengths)
+    return real, padded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--samples", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument(
+        "--max-batch-tokens",
+        type=int,
+        default=None,
+        help="Token budget per request (AVERT_MAX_BATCH_TOKENS), unset by default",
+    )
+    parser.add_argument("--options", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    samples = [make_sample(rng, args.options) for _ in range(args.samples)]
+    print(
+        f"samples={args.samples} options={args.options} "
+        f"batch_size={args.batch_size} max_batch_tokens={args.max_batch_tokens} "
+        f"candidates/sample={np.mean([len(c) for c, _ in samples]):.1f}"
+    )
+
+    for method in ("embedding", "rerank"):
+        # In rerank mode every pair carries the query
+        batch_size = args.batch_size - 1 if method == "rerank" else args.batch_size
+        totals = dict()
+        for sort_by_length in (False, True):
+            real = 0
+            padded = 0
+            for candidates, query in samples:
+                query_tokens = emb.estimate_tokens(query) if method == "rerank" else 0
+                r, p = padded_tokens(
+                    candidates,
+                    batch_size,
+                    sort_by_length,
+                    query_tokens=query_tokens,
+                    max_batch_tokens=args.max_batch_tokens,
+                )
+                real += r
+                padded += p
+            totals[sort_by_length] = padded
+            print(
+                f"{method:>9} sort_by_length={str(sort_by_length):<5} "
+                f"real_tokens={real} padded_tokens={padded} "
+                f"padding_waste={1 - real / padded:.1%}"
+            )
+        print(
+            f"{method:>9} expected server throughput gain: "
+            f"{totals[False] / totals[True]:.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Peak client memory of embedding large batches.
+
+Decodes the `/v1/embeddings` responses of a large list of texts, assembles
+them into a single array and scores them against a response, the same way
+`a_vert.embedding_tools.get_embedding` and `calculate_embedding_distances`
+do, and reports the peak memory traced by `tracemalloc` (numpy reports its
+buffers to it). The endpoint is replaced by a pre-built response body per
+batch, so no server is needed.
+
+The batch results are written into a preallocated array (see
+`_ResultBuffer`); the previous approach, collecting them and calling
+`np.concatenate`, is measured too for reference.
+
+Usage:
+    python benchmarks/bench_memory.py [--texts 4096] [--dim 4096]
+        [--batch-size 32]
+"""
+
+import argparse
+import base64
+import json
+import tracemalloc
+
+import numpy as np
+from scipy import spatial
+
+from a_vert import embedding_tools as emb
+
+
+def make_body(batch_size, dim, rng):
+    """Return a base64 `/v1/embeddings` response body for one batch."""
+    embeddings = rng.standard_normal((batch_size, dim), dtype=np.float32)
+    return json.dumps(
+        {
+            "data": [
+                {
+                    "index": idx,
+                    "embedding": base64.b64encode(embedding.tobytes()).decode("ascii"),
+                }
+                for idx, embedding in enumerate(embeddings)
+            ]
+        }
+    )
+
+
+def run(texts, batch_size, body, dtype, concatenate=False):
+    """Embed and score `texts`, returns the traced peak memory in bytes."""
+    _, _, parse, _ = emb._vllm_embedding_request(
+        ["text"], "http://localhost", "avert-model", dtype=dtype
+    )
+    batches = emb._split_in_batches(texts, batch_size)
+
+    tracemalloc.start()
+    if concatenate:
+        embeddings = np.concatenate([parse(body) for _ in batches], axis=0)
+    else:
+        embeddings = emb._run_batches(lambda batch: parse(body), batches)
+    response_embedding = parse(body)[0]
+    emb._embedding_similarities(response_embedding, embeddings, spatial.distance.cosine)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--texts", type=int, default=4096)
+    parser.add_argument("--dim", type=int, default=4096)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    body = make_body(args.batch_size, args.dim, rng)
+    texts = ["text"] * args.texts
+    embeddings_mb = args.texts * args.dim * 4 / 1e6
+    print(
+        f"texts={args.texts} dim={args.dim} batch_size={args.batch_size} "
+        f"(float32 embeddings: {embeddings_mb:.0f} MB)"
+    )
+    for dtype in ("float64", "float32"):
+        for concatenate in (True, False):
+            peak = run(texts, args.batch_size, body, dtype, concatenate)
+            assembly = "concatenate" if concatenate else "preallocated"
+            print(f"dtype={dtype:<8} {assembly:<12} peak={peak / 1e6:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Bytes and CPU time of the rerank request/response encoding.
+
+Builds the `/v1/rerank` request of options-enhanced MMLU-style samples (see
+`bench_length_sorting.py`) and the vLLM response to it, with and without the
+documents echoed back in the results, and measures:
+- the request body size and encoding time with `json` and with `orjson`;
+- the response body size and decoding time, comparing the previous path
+  (decode the bytes to text, then `json.loads`) with decoding the bytes
+  directly with `orjson`.
+
+It does not need an endpoint.
+
+Usage:
+    python benchmarks/bench_wire_encoding.py [--samples 200] [--options 10]
+"""
+
+import argparse
+import json
+import random
+import time
+
+from bench_length_sorting import make_sample
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def make_response(documents, with_documents, rng):
+    """Return a vLLM `/v1/rerank` response body (bytes) for `documents`."""
+    results = list()
+    for idx, document in enumerate(documents):
+        result = {"index": idx, "relevance_score": rng.random()}
+        if with_documents:
+            result["document"] = {"text": document}
+        results.append(result)
+    results.sort(key=lambda result: result["relevance_score"], reverse=True)
+    body = {
+        "id": "rerank-0123456789abcdef",
+        "model": "avert-model",
+        "usage": {"total_tokens": sum(len(document) // 4 for document in documents)},
+        "results": results,
+    }
+    return json.dumps(body).encode("utf-8")
+
+
+def cpu_time(fn, items, repeats):
+    """Return the CPU time (in seconds) of applying `fn` to all the items."""
+    start = time.process_time()
+    for _ in range(repeats):
+        for item in items:
+            fn(item)
+    return (time.process_time() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--samples", type=int, default=200)
+    parser.add_argument("--options", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    samples = [make_sample(rng, args.options) for _ in range(args.samples)]
+    requests = [
+        {
+            "query": query,
+            "documents": candidates,
+            "model": "avert-model",
+            "truncate_prompt_tokens": -1,
+            "return_documents": False,
+        }
+        for candidates, query in samples
+    ]
+    print(
+        f"samples={args.samples} options={args.options} "
+        f"candidates/sample={sum(len(c) for c, _ in samples) / len(samples):.1f}"
+    )
+
+    # Requests
+    encoders = {"json": lambda payload: json.dumps(payload).encode("utf-8")}
+    if orjson is not None:
+        encoders["orjson"] = orjson.dumps
+    for name, encode in encoders.items():
+        size = sum(len(encode(payload)) for payload in requests)
+        seconds = cpu_time(encode, requests, args.repeats)
+        print(
+            f"request  encoder={name:<6} "
+            f"bytes/sample={size / len(requests):.0f} "
+            f"cpu/sample={seconds / len(requests) * 1e6:.1f} us"
+        )
+
+    # Responses
+    decoders = {"text+json": lambda body: json.loads(body.decode("utf-8"))}
+    if orjson is not None:
+        decoders["orjson"] = orjson.loads
+    for with_documents in (True, False):
+        responses = [
+            make_response(candidates, with_documents, rng) for candidates, _ in samples
+        ]
+        size = sum(len(body) for body in responses)
+        for name, decode in decoders.items():
+            seconds = cpu_time(decode, responses, args.repeats)
+            print(
+                f"response documents={str(with_documents):<5} "
+                f"decoder={name:<9} bytes/sample={size / len(responses):.0f} "
+                f"cpu/sample={seconds / len(responses) * 1e6:.1f} us"
+            )
+
+
+if __name__ == "__main__":
+    main()
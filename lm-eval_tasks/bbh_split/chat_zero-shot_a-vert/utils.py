@@ -12,6 +12,8 @@ default_instruction = {
 
 # Setup A-VERT configuration from environment variables
 AVERT_CONFIG = a_vert.setup(instruction_map=default_instruction)
+# Candidate labels are only needed by the scores file (AVERT_SCORES_PATH)
+SCORE_CANDIDATES = AVERT_CONFIG.scores_path is not None
 
 # For backward compatibility, extract individual values
 ENHANCE = AVERT_CONFIG.enhance
@@ -64,11 +66,16 @@ def doc_eval(pred, options, target_idx, question, task):
         # Get other elements from the bAbI world
         correct_group_text, wrong_group_text = get_bbh_options(refs, question, options, task)
         # Construct the wrong candidates group
-        group_texts_dict = a_vert.processing.construct_candidate_groups(correct_group_text,
+        candidate_groups = a_vert.processing.construct_candidate_groups(correct_group_text,
                                 wrong_group_text,
                                 ["correct", "wrong"],
                                 enhance=ENHANCE,
+                                return_references=SCORE_CANDIDATES,
                                 )
+        if SCORE_CANDIDATES:
+            group_texts_dict, candidate_labels, _ = candidate_groups
+        else:
+            group_texts_dict, candidate_labels = candidate_groups, None
 
         # Process all candidate groups
         response_group_distribution, _ = a_vert.processing.get_candidate_groups_embedings_ranking(
@@ -76,6 +83,7 @@ def doc_eval(pred, options, target_idx, question, task):
             group_texts_dict,
             AVERT_CONFIG,
             task=task if task else "default",
+            candidate_labels=candidate_labels,
         )
         # Check if this is a match
         a_vert_match = True
@@ -19,6 +19,8 @@ default_instruction = {
 logger = get_logger(__name__)
 # Setup A-VERT configuration from environment variables
 AVERT_CONFIG = a_vert.setup(instruction_map=default_instruction)
+# Candidate labels are only needed by the scores file (AVERT_SCORES_PATH)
+SCORE_CANDIDATES = AVERT_CONFIG.scores_path is not None
 
 # For backward compatibility, extract individual values
 ENHANCE = AVERT_CONFIG.enhance
@@ -55,17 +57,23 @@ def doc_eval(pred, doc, task):
         correct_group_text =  doc["expected_answers"]
         wrong_group_text = doc["wrong_answers"]
         # Construct the wrong candidates group
-        group_texts_dict = a_vert.processing.construct_candidate_groups(correct_group_text, 
+        candidate_groups = a_vert.processing.construct_candidate_groups(correct_group_text, 
                                 wrong_group_text, 
                                 ["correct", "wrong"], 
                                 enhance=False,
+                                return_references=SCORE_CANDIDATES,
                                 )
+        if SCORE_CANDIDATES:
+            group_texts_dict, candidate_labels, _ = candidate_groups
+        else:
+            group_texts_dict, candidate_labels = candidate_groups, None
         # Process all candidate groups
         response_group_distribution, _ = a_vert.processing.get_candidate_groups_embedings_ranking(
             pred,
             group_texts_dict,
             AVERT_CONFIG,
             task=task if task else "default",
+            candidate_labels=candidate_labels,
         )
         # Check if this is a match
         a_vert_match = True
@@ -12,6 +12,8 @@ default_instruction = {
 
 # Setup A-VERT configuration from environment variables
 AVERT_CONFIG = a_vert.setup(instruction_map=default_instruction)
+# Candidate labels are only needed by the scores file (AVERT_SCORES_PATH)
+SCORE_CANDIDATES = AVERT_CONFIG.scores_path is not None
 
 # For backward compatibility, extract individual values
 ENHANCE = AVERT_CONFIG.enhance
@@ -65,11 +67,16 @@ def doc_eval(pred, refs, question, task):
         # Generate other numbers
         correct_group_text, wrong_group_text = get_gsm8k_options(refs, question)
         # Construct the wrong candidates group
-        group_texts_dict = a_vert.processing.construct_candidate_groups(correct_group_text, 
+        candidate_groups = a_vert.processing.construct_candidate_groups(correct_group_text, 
                                 wrong_group_text, 
                                 ["correct", "wrong"], 
                                 enhance=ENHANCE,
+                                return_references=SCORE_CANDIDATES,
                                 )
+        if SCORE_CANDIDATES:
+            group_texts_dict, candidate_labels, _ = candidate_groups
+        else:
+            group_texts_dict, candidate_labels = candidate_groups, None
 
         # Process all candidate groups
         response_group_distribution, _ = a_vert.processing.get_candidate_groups_embedings_ranking(
@@ -77,6 +84,7 @@ def doc_eval(pred, refs, question, task):
             group_texts_dict,
             AVERT_CONFIG,
             task=task if task else "default",
+            candidate_labels=candidate_labels,
         )
         # Check if this is a match
         a_vert_match = True
@@ -0,0 +1,52 @@
+import os
+
+import pytest
+
+from a_vert import embedding_tools, setup
+from a_vert.mock_server import MockServer
+
+
+@pytest.fixture(autouse=True)
+def reset_endpoint_state():
+    """Start every test with fresh circuit breakers, replica pools, limiters
+    and learned batch sizes.
+    """
+    yield
+    embedding_tools._CIRCUIT_BREAKERS.clear()
+    embedding_tools._REPLICA_POOLS.clear()
+    embedding_tools._CONCURRENCY_LIMITERS.clear()
+    embedding_tools._RATE_LIMITERS.clear()
+    embedding_tools._BATCH_SIZE_LIMITS.clear()
+    embedding_tools._FLOAT_ENCODING_URLS.clear()
+    embedding_tools._FULL_DIMENSIONS_URLS.clear()
+    embedding_tools.reset_endpoint_stats()
+
+
+@pytest.fixture
+def mock_server():
+    with MockServer(dim=8) as server:
+        yield server
+
+
+@pytest.fixture
+def avert_setup(monkeypatch, mock_server):
+    """Return a function running `a_vert.setup()` against the mock server,
+    with the given `AVERT_*` variables (without the prefix) on top.
+    """
+    for name in list(os.environ):
+        if name.startswith("AVERT_"):
+            monkeypatch.delenv(name)
+
+    def avert_setup(**env):
+        env = {
+            "MODEL_ENDPOINT": mock_server.url,
+            "ENDPOINT_TYPE": "tei",
+            "METHOD": "embedding",
+            "PROMPT_TEMPLATE": "empty",
+            **env,
+        }
+        for name, value in env.items():
+            monkeypatch.setenv(f"AVERT_{name}", str(value))
+        return setup()
+
+    return avert_setup
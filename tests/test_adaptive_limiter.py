@@ -0,0 +1,66 @@
+import pytest
+
+from a_vert import embedding_tools
+
+TEXTS = [f"text {idx}" for idx in range(8)]
+
+
+def embed(url, **kwargs):
+    return embedding_tools.get_embedding(
+        TEXTS,
+        url,
+        "tei",
+        max_batch_size=2,
+        max_concurrency=4,
+        adaptive_concurrency=True,
+        max_retries=1,
+        breaker_threshold=0,
+        **kwargs,
+    )
+
+
+def limiter_at(url, limit):
+    key = embedding_tools._get_replica_pool(url).key
+    limiter = embedding_tools._get_concurrency_limiter(key, 4)
+    limiter.limit = limit
+    return limiter
+
+
+def test_limit_grows_on_fast_calls(mock_server):
+    limiter = limiter_at(mock_server.url, 1.0)
+    for _ in range(5):
+        embed(mock_server.url)
+    assert limiter.limit > 1.0
+    assert limiter.in_flight == 0
+
+
+def test_server_errors_lower_the_limit(mock_server):
+    mock_server.error_rate = 1.0
+    mock_server.error_status = (503,)
+    limiter = limiter_at(mock_server.url, 4.0)
+    with pytest.raises(embedding_tools.RetriesExhaustedError) as exc_info:
+        embed(mock_server.url)
+    assert exc_info.value.status_code == 503
+    assert limiter.limit < 4.0
+    assert limiter.in_flight == 0
+
+
+def test_client_errors_keep_the_limit(mock_server):
+    mock_server.error_rate = 1.0
+    mock_server.error_status = (400,)
+    limiter = limiter_at(mock_server.url, 4.0)
+    with pytest.raises(embedding_tools.EndpointError) as exc_info:
+        embed(mock_server.url)
+    assert exc_info.value.status_code == 400
+    assert limiter.limit == 4.0
+    assert limiter.in_flight == 0
+
+
+def test_latency_is_per_text():
+    def batch_call(batch):
+        # Round trip of the request, as timed by `_post_with_retry`
+        embedding_tools._ROUND_TRIP.seconds = 0.8
+
+    limiter = embedding_tools._AdaptiveLimiter("key", 4)
+    limiter.call(batch_call, [0] * 8)
+    assert limiter.min_latency == pytest.approx(0.1)
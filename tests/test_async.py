@@ -0,0 +1,132 @@
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+
+from a_vert import embedding_tools
+
+pytest.importorskip("aiohttp")
+
+TEXTS = [f"text {idx}" for idx in range(16)]
+
+
+def test_concurrency_is_shared_by_the_calls_of_the_loop(mock_server):
+    mock_server.latency = 0.05
+    peak = 0
+
+    async def watch_in_flight():
+        nonlocal peak
+        while True:
+            peak = max(peak, mock_server._in_flight)
+            await asyncio.sleep(0.005)
+
+    async def main():
+        watcher = asyncio.ensure_future(watch_in_flight())
+        results = await asyncio.gather(
+            *(
+                embedding_tools.aget_embedding(
+                    TEXTS, mock_server.url, "tei", max_batch_size=2, max_concurrency=3
+                )
+                for _ in range(4)
+            )
+        )
+        watcher.cancel()
+        await embedding_tools.aclose_sessions()
+        return results
+
+    results = asyncio.run(main())
+    expected = embedding_tools.get_embedding(TEXTS, mock_server.url, "tei")
+    for embeddings in results:
+        np.testing.assert_allclose(embeddings, expected)
+    assert 1 < peak <= 3
+
+
+def test_rate_limit_runs_off_the_loop(mock_server, tmp_path, monkeypatch):
+    threads = list()
+    reserve = embedding_tools._RateLimiter.reserve
+
+    def recording_reserve(self, n_texts):
+        threads.append(threading.current_thread())
+        return reserve(self, n_texts)
+
+    monkeypatch.setattr(embedding_tools._RateLimiter, "reserve", recording_reserve)
+
+    async def main():
+        await embedding_tools.aget_embedding(
+            TEXTS,
+            mock_server.url,
+            "tei",
+            max_batch_size=4,
+            max_concurrency=2,
+            max_requests_per_second=100,
+            rate_limit_dir=str(tmp_path),
+        )
+        await embedding_tools.aclose_sessions()
+
+    asyncio.run(main())
+    assert len(threads) == 4
+    assert threading.main_thread() not in threads
+
+
+def test_adaptive_concurrency_bounds_the_batches(mock_server):
+    mock_server.latency = 0.02
+    key = embedding_tools._get_replica_pool(mock_server.url).key
+    limiter = embedding_tools._get_concurrency_limiter(key, 4)
+    peak = 0
+
+    async def watch_in_flight():
+        nonlocal peak
+        while True:
+            peak = max(peak, mock_server._in_flight)
+            await asyncio.sleep(0.002)
+
+    async def main():
+        watcher = asyncio.ensure_future(watch_in_flight())
+        embeddings = await embedding_tools.aget_embedding(
+            TEXTS,
+            mock_server.url,
+            "tei",
+            max_batch_size=1,
+            max_concurrency=4,
+            adaptive_concurrency=True,
+        )
+        watcher.cancel()
+        await embedding_tools.aclose_sessions()
+        return embeddings
+
+    limiter.limit = 1.0
+    embeddings = asyncio.run(main())
+    np.testing.assert_allclose(
+        embeddings, embedding_tools.get_embedding(TEXTS, mock_server.url, "tei")
+    )
+    # The limit starts at one and grows with the fast calls
+    assert limiter.limit > 1.0
+    assert limiter.min_latency is not None
+    assert limiter.in_flight == 0
+    assert peak <= 4
+
+
+def test_health_checks_run_only_when_due(monkeypatch):
+    pool = embedding_tools._ReplicaPool(["http://a", "http://b"], 60.0)
+    dispatched = list()
+
+    async def to_thread(fn, *args):
+        dispatched.append(fn)
+        return fn(*args)
+
+    monkeypatch.setattr(embedding_tools.asyncio, "to_thread", to_thread)
+    monkeypatch.setattr(pool, "check_health", lambda: None)
+
+    async def replica_call(replica):
+        return replica
+
+    async def main():
+        for _ in range(5):
+            await pool.acall(replica_call)
+
+    asyncio.run(main())
+    assert dispatched == []
+    pool._last_health_check -= 60.0
+    asyncio.run(main())
+    assert len(dispatched) == 1
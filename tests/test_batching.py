@@ -0,0 +1,138 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from a_vert import embedding_tools
+from a_vert.mock_server import mock_embedding, mock_score
+
+
+@pytest.mark.parametrize("sort_by_length", [False, True])
+def test_empty_input_returns_empty_arrays(mock_server, sort_by_length):
+    embeddings = embedding_tools.get_embedding(
+        [], mock_server.url, "tei", sort_by_length=sort_by_length
+    )
+    assert embeddings.shape == (0, 0)
+    assert embeddings.dtype == np.float32
+    embeddings = embedding_tools.get_embedding(
+        [], mock_server.url, "vllm", model_name="m", dimensions=4
+    )
+    assert embeddings.shape == (0, 4)
+    scores = embedding_tools.get_rerank(
+        "question", [], mock_server.url, "tei", sort_by_length=sort_by_length
+    )
+    assert scores.shape == (0,)
+    assert scores.dtype == np.float32
+    assert mock_server.metrics["requests"] == 0
+
+
+def test_empty_input_returns_empty_arrays_async(mock_server):
+    pytest.importorskip("aiohttp")
+
+    async def main():
+        return (
+            await embedding_tools.aget_embedding(
+                [], mock_server.url, "tei", sort_by_length=True
+            ),
+            await embedding_tools.aget_rerank(
+                "question", [], mock_server.url, "tei", sort_by_length=True
+            ),
+        )
+
+    embeddings, scores = asyncio.run(main())
+    assert embeddings.shape == (0, 0)
+    assert scores.shape == (0,)
+    assert mock_server.metrics["requests"] == 0
+
+
+def test_batches_are_packed_within_the_token_budget():
+    # 12 estimated tokens per text, 30 for the long one
+    texts = ["a" * 40] * 5
+    texts.insert(2, "b" * 112)
+    batches = embedding_tools._split_in_batches(texts, 32, max_batch_tokens=30)
+    assert [len(batch) for batch in batches] == [2, 1, 2, 1]
+    # The long text counts for at most `max_len` tokens
+    batches = embedding_tools._split_in_batches(
+        texts, 32, max_batch_tokens=30, max_len=6
+    )
+    assert [len(batch) for batch in batches] == [5, 1]
+    # The rerank query is charged to every text
+    batches = embedding_tools._split_in_batches(
+        ["a" * 40] * 4, 32, max_batch_tokens=30, query_tokens=4
+    )
+    assert [len(batch) for batch in batches] == [1, 1, 1, 1]
+    batches = embedding_tools._split_in_batches(
+        ["a" * 40] * 4, 3, max_batch_tokens=1000
+    )
+    assert [len(batch) for batch in batches] == [3, 1]
+
+
+def test_token_budget_splits_requests(mock_server):
+    texts = [f"text {idx} " + "a" * 40 for idx in range(6)]
+    embeddings = embedding_tools.get_embedding(
+        texts, mock_server.url, "tei", max_batch_tokens=40
+    )
+    np.testing.assert_allclose(
+        embeddings, np.stack([mock_embedding(text, 8) for text in texts]), rtol=1e-6
+    )
+    # 13 estimated tokens per text, 3 per request
+    assert mock_server.metrics["requests"] == 2
+
+    scores = embedding_tools.get_rerank(
+        "question", texts, mock_server.url, "tei", max_batch_tokens=40
+    )
+    np.testing.assert_allclose(
+        scores, [mock_score("question", text, 8) for text in texts], rtol=1e-6
+    )
+    # With the 4 tokens of the query, 2 texts per request
+    assert mock_server.metrics["requests"] == 2 + 3
+
+
+TEXTS = ["a" * 200, "short", "b" * 80, "tiny", "c" * 200, "d" * 20, "mid " * 10]
+
+
+def test_texts_are_batched_by_length():
+    batches, order = embedding_tools._prepare_batches(TEXTS, 3, sort_by_length=True)
+    assert batches == [
+        ["short", "tiny", "d" * 20],
+        ["mid " * 10, "b" * 80, "a" * 200],
+        ["c" * 200],
+    ]
+    # Equal lengths keep their order
+    assert list(order) == [1, 3, 5, 6, 2, 0, 4]
+    sorted_texts = np.array(sum(batches, []), dtype=object)
+    assert list(embedding_tools._restore_order(sorted_texts, order)) == TEXTS
+    batches, order = embedding_tools._prepare_batches(TEXTS, 3)
+    assert order is None
+    assert batches[0] == TEXTS[:3]
+
+
+def test_sorted_results_keep_the_input_order(mock_server):
+    pytest.importorskip("aiohttp")
+    expected_embeddings = np.stack([mock_embedding(text, 8) for text in TEXTS])
+    expected_scores = [mock_score("question", text, 8) for text in TEXTS]
+    kwargs = dict(max_batch_size=3, sort_by_length=True, max_concurrency=2)
+
+    async def main():
+        results = (
+            await embedding_tools.aget_embedding(
+                TEXTS, mock_server.url, "tei", **kwargs
+            ),
+            await embedding_tools.aget_rerank(
+                "question", TEXTS, mock_server.url, "tei", **kwargs
+            ),
+        )
+        await embedding_tools.aclose_sessions()
+        return results
+
+    for embeddings, scores in [
+        (
+            embedding_tools.get_embedding(TEXTS, mock_server.url, "tei", **kwargs),
+            embedding_tools.get_rerank(
+                "question", TEXTS, mock_server.url, "tei", **kwargs
+            ),
+        ),
+        asyncio.run(main()),
+    ]:
+        np.testing.assert_allclose(embeddings, expected_embeddings, rtol=1e-6)
+        np.testing.assert_allclose(scores, expected_scores, rtol=1e-6)
@@ -0,0 +1,89 @@
+import importlib.util
+import json
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+
+from a_vert import processing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, "benchmarks", "bench_end_to_end.py")
+
+
+@pytest.fixture(scope="module")
+def bench():
+    spec = importlib.util.spec_from_file_location("bench_end_to_end", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.mark.parametrize("workload", ["mmlu", "mmlu_pro", "babi", "gsm8k"])
+def test_samples_build_candidate_groups(bench, workload):
+    rng = random.Random(0)
+    for _ in range(20):
+        correct, wrong, options, response = bench.make_sample(workload, rng)
+        assert response and correct and wrong
+        assert correct[0] not in wrong
+        groups = processing.construct_candidate_groups(
+            correct, wrong, ["correct", "wrong"], **options
+        )
+        assert groups["correct"] and groups["wrong"]
+    with pytest.raises(ValueError, match="Unknown workload"):
+        bench.make_sample("squad", rng)
+
+
+def test_end_to_end_benchmark_runs(bench, tmp_path, capsys):
+    output = tmp_path / "results.json"
+    env = {
+        name: value
+        for name, value in os.environ.items()
+        if not name.startswith("AVERT_")
+    }
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")]))
+    subprocess.run(
+        [
+            sys.executable,
+            SCRIPT,
+            "--samples",
+            "6",
+            "--concurrency",
+            "2",
+            "--workloads",
+            "mmlu",
+            "babi",
+            "--dim",
+            "8",
+            "--output",
+            str(output),
+        ],
+        env=env,
+        cwd=tmp_path,
+        check=True,
+        capture_output=True,
+        timeout=300,
+    )
+    report = json.loads(output.read_text())
+    assert report["settings"]["endpoint"] == "mock"
+    assert [(r["workload"], r["method"]) for r in report["results"]] == [
+        ("mmlu", "embedding"),
+        ("babi", "embedding"),
+        ("mmlu", "rerank"),
+        ("babi", "rerank"),
+    ]
+    for result in report["results"]:
+        metrics = result["metrics"]
+        assert metrics["samples_per_s"] > 0
+        assert metrics["latency_p50_ms"] <= metrics["latency_p99_ms"]
+
+    # Half the throughput of the previous run is flagged as a regression
+    results = json.loads(output.read_text())["results"]
+    for result in results:
+        result["metrics"]["samples_per_s"] /= 2
+    bench.compare(results, str(output), 0.1)
+    lines = capsys.readouterr().out.strip().splitlines()[1:]
+    assert len(lines) == 4
+    assert all("!samples_per_s=-50.0%" in line for line in lines)
@@ -0,0 +1,61 @@
+import asyncio
+import logging
+
+import numpy as np
+import pytest
+
+from a_vert import embedding_tools
+from a_vert.mock_server import MockServer, mock_embedding
+
+TEXTS = [f"text {idx}" for idx in range(10)]
+EXPECTED = np.stack([mock_embedding(text, 8) for text in TEXTS])
+
+
+@pytest.fixture
+def limited_server():
+    with MockServer(dim=8, max_batch_size=3) as server:
+        yield server
+
+
+def test_rejected_batches_are_split(limited_server, caplog):
+    with caplog.at_level(logging.WARNING):
+        embeddings = embedding_tools.get_embedding(
+            TEXTS, limited_server.url, "tei", max_batch_size=8
+        )
+    np.testing.assert_allclose(embeddings, EXPECTED, rtol=1e-6)
+    # The batch of 8 and both of its halves of 4, the second one split in 3 + 1
+    assert limited_server.metrics["status"][413] == 3
+    limit_key = (embedding_tools._get_replica_pool(limited_server.url).key, "embedding")
+    assert embedding_tools._BATCH_SIZE_LIMITS[limit_key] == (3, 4)
+    assert embedding_tools._get_batch_size_limit(limit_key, 8) == 3
+    # A single warning, the other rejections are logged at DEBUG level
+    assert len(caplog.records) == 1
+    assert "rejected batch as too large" in caplog.records[0].getMessage()
+
+    # Later calls use the batch size that worked
+    embedding_tools.get_embedding(TEXTS, limited_server.url, "tei", max_batch_size=8)
+    assert limited_server.metrics["status"][413] == 3
+
+
+def test_rejected_batches_are_split_async(limited_server):
+    pytest.importorskip("aiohttp")
+
+    async def main():
+        embeddings = await embedding_tools.aget_embedding(
+            TEXTS, limited_server.url, "tei", max_batch_size=8, max_concurrency=2
+        )
+        await embedding_tools.aclose_sessions()
+        return embeddings
+
+    np.testing.assert_allclose(asyncio.run(main()), EXPECTED, rtol=1e-6)
+    assert embedding_tools.get_endpoint_stats()["bisections"] >= 2
+
+
+def test_long_texts_keep_the_batch_size_limit(limited_server):
+    limit_key = (embedding_tools._get_replica_pool(limited_server.url).key, "embedding")
+    embedding_tools._BATCH_SIZE_LIMITS[limit_key] = (3, 4)
+    limited_server.max_batch_size = 1
+    embedding_tools.get_embedding(TEXTS[:3], limited_server.url, "tei")
+    # Split in halves, without learning a smaller batch size
+    assert limited_server.metrics["status"][413] == 2
+    assert embedding_tools._BATCH_SIZE_LIMITS[limit_key] == (3, 4)
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from a_vert import candidate_scores, processing
+
+pytest.importorskip("pyarrow")
+
+
+def test_rows_are_written_in_row_groups(tmp_path):
+    import pyarrow.parquet
+
+    path = str(tmp_path / "scores.parquet")
+    writer = candidate_scores.CandidateScoreWriter(
+        path, metadata={"GROUPING": "max"}, row_group_rows=10
+    )
+    for sample in range(7):
+        for task in ("task_a", "task_b"):
+            writer.add(
+                task,
+                f"response {sample}",
+                ["correct", "correct", "wrong", "wrong"],
+                np.arange(4, dtype=np.float32) + sample,
+                labels=["a", "b", "c", None],
+            )
+        # Never more than one row group of a task in memory
+        assert max(writer._rows.values(), default=0) < 10
+    writer.close()
+
+    # Per task, 2 row groups of 12 rows and one of the remaining 4
+    assert pyarrow.parquet.ParquetFile(path).num_row_groups == 6
+    samples = list(candidate_scores.iter_candidate_scores(path))
+    assert len(samples) == 14
+    for task in ("task_a", "task_b"):
+        task_samples = [s for s in samples if s["task"] == task]
+        assert [s["sample"] for s in task_samples] == list(range(7))
+        for sample in task_samples:
+            np.testing.assert_array_equal(
+                sample["scores"]["wrong"], [2 + sample["sample"], 3 + sample["sample"]]
+            )
+            assert sample["labels"]["wrong"] == ["c", None]
+    assert candidate_scores.read_candidate_scores_metadata(path) == {"GROUPING": "max"}
+
+
+def test_closed_writer_rejects_scores(tmp_path):
+    writer = candidate_scores.CandidateScoreWriter(str(tmp_path / "scores.parquet"))
+    writer.close()
+    with pytest.raises(ValueError, match="closed"):
+        writer.add("task", "response", ["correct"], [0.5])
+
+
+def test_ranking_writes_scores_with_settings_read_once(
+    tmp_path, avert_setup, monkeypatch
+):
+    path = str(tmp_path / "scores.parquet")
+    config = avert_setup(SCORES_PATH=path)
+    calls = []
+    to_dict = config.to_dict
+    monkeypatch.setattr(config, "to_dict", lambda: calls.append(1) or to_dict())
+    groups, labels, _ = processing.construct_candidate_groups(
+        ["Paris"], ["London"], ["correct", "wrong"], return_references=True
+    )
+    try:
+        for response in ("Paris", "London", "Rome"):
+            processing.get_candidate_groups_embedings_ranking(
+                response, groups, config, task="capitals", candidate_labels=labels
+            )
+    finally:
+        candidate_scores.close_candidate_score_writers()
+        candidate_scores._WRITERS.clear()
+    assert len(calls) == 1
+
+    samples = list(candidate_scores.iter_candidate_scores(path))
+    assert [s["sample"] for s in samples] == [0, 1, 2]
+    assert samples[0]["labels"]["correct"] == labels[: len(groups["correct"])]
+    metadata = candidate_scores.read_candidate_scores_metadata(path)
+    assert metadata["AVERT_METHOD"] == "embedding"
+    assert "SCORES_PATH" not in metadata
@@ -0,0 +1,104 @@
+import asyncio
+import time
+
+import pytest
+
+from a_vert import embedding_tools
+
+
+def embed(url, **kwargs):
+    kwargs.setdefault("max_retries", 1)
+    return embedding_tools.get_embedding(
+        "text", url, "tei", breaker_threshold=2, breaker_cooldown=0.2, **kwargs
+    )
+
+
+def test_half_open_recovery(mock_server):
+    mock_server.error_rate = 1.0
+    with pytest.raises(embedding_tools.RetriesExhaustedError):
+        embed(mock_server.url)
+    # The second failure opens the circuit
+    with pytest.raises(embedding_tools.CircuitOpenError):
+        embed(mock_server.url)
+    breaker = embedding_tools._get_circuit_breaker(mock_server.url)
+    assert breaker.state == "open"
+    with pytest.raises(embedding_tools.CircuitOpenError):
+        embed(mock_server.url)
+    assert mock_server.metrics["requests"] == 2
+
+    # Failed trial, the circuit opens again
+    time.sleep(0.25)
+    with pytest.raises(embedding_tools.CircuitOpenError):
+        embed(mock_server.url)
+    assert breaker.state == "open"
+
+    # Successful trial, the circuit closes
+    mock_server.error_rate = 0.0
+    time.sleep(0.25)
+    assert embed(mock_server.url).shape == (1, 8)
+    assert breaker.state == "closed"
+
+
+def test_every_5xx_counts_as_failure(mock_server):
+    mock_server.error_rate = 1.0
+    mock_server.error_status = (500,)
+    for _ in range(2):
+        with pytest.raises(embedding_tools.EndpointError) as exc_info:
+            embed(mock_server.url, max_retries=3)
+        assert exc_info.value.status_code == 500
+    # Not retried
+    assert mock_server.metrics["requests"] == 2
+    assert embedding_tools._get_circuit_breaker(mock_server.url).state == "open"
+
+
+def test_interrupted_trial_reopens_the_circuit():
+    breaker = embedding_tools._CircuitBreaker("host", threshold=1, cooldown=0.1)
+    breaker.record_failure()
+    time.sleep(0.15)
+    trial = breaker.before_request()
+    assert trial and breaker.state == "half_open"
+    # Only one trial at a time
+    with pytest.raises(embedding_tools.CircuitOpenError):
+        breaker.before_request()
+    breaker.trial_failed(trial)
+    assert breaker.state == "open"
+
+
+def test_expired_trial_is_replaced():
+    breaker = embedding_tools._CircuitBreaker("host", threshold=1, cooldown=0.1)
+    breaker.record_failure()
+    time.sleep(0.15)
+    assert breaker.before_request()
+    # The trial never reported back
+    time.sleep(0.15)
+    assert breaker.before_request()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+def test_cancelled_trial_reopens_the_circuit(mock_server):
+    pytest.importorskip("aiohttp")
+    mock_server.latency = 5.0
+    breaker = embedding_tools._get_circuit_breaker(mock_server.url, 1, 0.1)
+    breaker.record_failure()
+    time.sleep(0.15)
+
+    async def cancelled_trial():
+        call = asyncio.ensure_future(
+            embedding_tools.aget_embedding(
+                "text",
+                mock_server.url,
+                "tei",
+                breaker_threshold=1,
+                breaker_cooldown=0.1,
+            )
+        )
+        await asyncio.sleep(0.2)
+        assert breaker.state == "half_open"
+        call.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await call
+        await embedding_tools.aclose_sessions()
+
+    asyncio.run(cancelled_trial())
+    assert breaker.state == "open"
@@ -0,0 +1,61 @@
+import pytest
+
+from a_vert import processing
+from a_vert.config import AvertConfig
+
+GROUPS = {"correct": ["Paris"], "wrong": ["London", "Rome", "Madrid", "Berlin"]}
+
+
+def test_performance_defaults(avert_setup):
+    config = avert_setup()
+    assert config.batch_size == 32
+    assert config.timeout == 20.0
+    assert config.max_retries == 3
+    assert config.max_concurrency == 1
+    assert config.pool_size == 10
+
+
+def test_performance_settings_are_read(avert_setup):
+    config = avert_setup(
+        BATCH_SIZE="8",
+        TIMEOUT="2.5",
+        MAX_RETRIES="5",
+        MAX_CONCURRENCY="4",
+        POOL_SIZE="3",
+    )
+    assert (
+        config.batch_size,
+        config.timeout,
+        config.max_retries,
+        config.max_concurrency,
+        config.pool_size,
+    ) == (8, 2.5, 5, 4, 3)
+    # The settings survive a round trip through a dict
+    other = AvertConfig.from_dict(config.to_dict())
+    assert other.to_dict() == config.to_dict()
+
+
+@pytest.mark.parametrize(
+    "env, message",
+    [
+        (dict(BATCH_SIZE="0"), "AVERT_BATCH_SIZE"),
+        (dict(BATCH_SIZE="many"), "Must be a int"),
+        (dict(TIMEOUT="0"), "AVERT_TIMEOUT"),
+        (dict(MAX_RETRIES="0"), "AVERT_MAX_RETRIES"),
+        (dict(MAX_CONCURRENCY="-1"), "AVERT_MAX_CONCURRENCY"),
+        (dict(POOL_SIZE="1.5"), "AVERT_POOL_SIZE"),
+        (dict(METHOD="rerank", BATCH_SIZE="1"), "one slot is reserved"),
+    ],
+)
+def test_invalid_settings_are_rejected(avert_setup, env, message):
+    with pytest.raises(ValueError, match=message):
+        avert_setup(**env)
+
+
+@pytest.mark.parametrize("method, requests", [("embedding", 4), ("rerank", 5)])
+def test_batch_size_is_forwarded(mock_server, avert_setup, method, requests):
+    config = avert_setup(METHOD=method, BATCH_SIZE="2", MAX_CONCURRENCY="2")
+    processing.get_candidate_groups_embedings_ranking("Paris", GROUPS, config)
+    # The response and 3 batches of 2 candidates, or one candidate per rerank
+    # request (the query takes a slot)
+    assert mock_server.metrics["requests"] == requests
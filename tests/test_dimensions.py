@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from a_vert import embedding_tools, processing
+from a_vert.mock_server import MockServer, mock_embedding
+
+TEXTS = [f"text {idx}" for idx in range(4)]
+
+
+def truncated(texts, dimensions):
+    embeddings = np.stack([mock_embedding(text, 8)[:dimensions] for text in texts])
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize("encoding_format", ["float", "base64"])
+def test_reduced_dimensions_are_requested(mock_server, encoding_format):
+    embeddings = embedding_tools.get_embedding(
+        TEXTS,
+        mock_server.url,
+        "vllm",
+        model_name="m",
+        dimensions=4,
+        encoding_format=encoding_format,
+    )
+    assert embeddings.shape == (4, 4)
+    np.testing.assert_allclose(embeddings, truncated(TEXTS, 4), rtol=1e-6)
+    assert mock_server.metrics["status"] == {200: 1}
+
+
+def test_full_embeddings_are_truncated_on_the_client():
+    with MockServer(dim=8, support_dimensions=False) as server:
+        for _ in range(2):
+            embeddings = embedding_tools.get_embedding(
+                TEXTS, server.url, "vllm", model_name="m", dimensions=4
+            )
+            np.testing.assert_allclose(embeddings, truncated(TEXTS, 4), rtol=1e-6)
+            np.testing.assert_allclose(np.linalg.norm(embeddings, axis=1), 1.0)
+        # Only the first request is rejected
+        assert server.metrics["status"] == {400: 1, 200: 2}
+        assert server.url + "/v1/embeddings" in embedding_tools._FULL_DIMENSIONS_URLS
+
+
+def test_tei_embeddings_are_truncated(mock_server):
+    embeddings = embedding_tools.get_embedding(
+        TEXTS, mock_server.url, "tei", dimensions=2, dtype="float16"
+    )
+    assert embeddings.dtype == np.float16
+    np.testing.assert_allclose(embeddings, truncated(TEXTS, 2), rtol=1e-3)
+    # The dimensions of the model are kept as they are
+    embeddings = embedding_tools.get_embedding(
+        TEXTS, mock_server.url, "tei", dimensions=8
+    )
+    np.testing.assert_allclose(embeddings, truncated(TEXTS, 8), rtol=1e-6)
+    with pytest.raises(ValueError, match="Requested 16 embedding dimensions"):
+        embedding_tools.get_embedding(TEXTS, mock_server.url, "tei", dimensions=16)
+
+
+def test_configured_dimensions_are_used_for_ranking(avert_setup):
+    config = avert_setup(EMBEDDING_DIMENSIONS="4")
+    assert config.embedding_dimensions == 4
+    groups = {"correct": ["Paris"], "wrong": ["London", "Rome"]}
+    _, distances = processing.get_candidate_groups_embedings_ranking(
+        "Paris", groups, config
+    )
+    embeddings = truncated(["Paris", "Paris", "London", "Rome"], 4)
+    np.testing.assert_allclose(
+        distances, embeddings[1:] @ embeddings[0], rtol=1e-5, atol=1e-6
+    )
@@ -0,0 +1,135 @@
+import logging
+import multiprocessing
+
+import numpy as np
+import pytest
+
+from a_vert import embedding_tools
+from a_vert.embedding_store import SharedEmbeddingArena
+from a_vert.mock_server import mock_embedding
+
+pytest.importorskip("fcntl")
+
+TEXTS = [f"candidate {idx}" for idx in range(8)]
+EMBEDDINGS = np.stack([mock_embedding(text, 8) for text in TEXTS])
+
+
+def open_arena(path, capacity=64):
+    return SharedEmbeddingArena(str(path), "int8", identity="model", capacity=capacity)
+
+
+def fill_and_wait(path, filled, release):
+    """Fill the arena with the first half of the texts, and keep the filler
+    lock until `release` is set.
+    """
+    open_arena(path).add(TEXTS[:4], EMBEDDINGS[:4])
+    filled.set()
+    release.wait(30)
+
+
+def read_arena(path, queue, arena=None):
+    """Send the rows and embeddings of the texts seen by a new process, and
+    whether adding the other texts stored them.
+    """
+    arena = arena or open_arena(path)
+    rows = arena.lookup(TEXTS)
+    found = rows >= 0
+    embeddings = arena.get(rows[found])
+    arena.add(TEXTS[4:], EMBEDDINGS[4:])
+    queue.put((rows, embeddings, arena.lookup(TEXTS[4:])))
+
+
+def test_filler_lock_is_handed_over(tmp_path):
+    path = tmp_path / "arena"
+    context = multiprocessing.get_context("spawn")
+    filled, release = context.Event(), context.Event()
+    filler = context.Process(target=fill_and_wait, args=(path, filled, release))
+    filler.start()
+    try:
+        assert filled.wait(30)
+        arena = open_arena(path)
+        np.testing.assert_array_equal(arena.lookup(TEXTS[:4]), range(4))
+        # The other process fills the arena, these embeddings are not stored
+        arena.add(TEXTS[4:], EMBEDDINGS[4:])
+        assert (arena.lookup(TEXTS[4:]) == -1).all()
+    finally:
+        release.set()
+        filler.join(30)
+    assert filler.exitcode == 0
+    # The filler exited, the next process adding embeddings takes over
+    arena.add(TEXTS[4:], EMBEDDINGS[4:])
+    np.testing.assert_array_equal(arena.lookup(TEXTS), range(8))
+    assert len(arena) == 8
+
+
+@pytest.mark.parametrize("method", ["fork", "spawn"])
+def test_children_read_the_rows_of_the_filler(tmp_path, method):
+    if method not in multiprocessing.get_all_start_methods():
+        pytest.skip(f"{method} is not available")
+    path = tmp_path / "arena"
+    arena = open_arena(path)
+    arena.add(TEXTS[:4], EMBEDDINGS[:4])
+    context = multiprocessing.get_context(method)
+    queue = context.Queue()
+    # A forked child inherits the mapping and the filler state of the parent
+    args = (path, queue, arena) if method == "fork" else (path, queue)
+    child = context.Process(target=read_arena, args=args)
+    child.start()
+    rows, embeddings, added = queue.get(timeout=30)
+    child.join(30)
+    assert child.exitcode == 0
+    np.testing.assert_array_equal(rows, [0, 1, 2, 3, -1, -1, -1, -1])
+    np.testing.assert_array_equal(embeddings, arena.get(np.arange(4)))
+    # The parent still holds the filler lock, the child only reads
+    assert (added == -1).all()
+    assert len(arena) == 4
+
+
+def test_reopen_checks_identity_and_dimensions(tmp_path):
+    path = tmp_path / "arena"
+    open_arena(path).add(TEXTS, EMBEDDINGS)
+    for arena in (
+        SharedEmbeddingArena(str(path), "int8", identity="other model"),
+        SharedEmbeddingArena(str(path), "binary", identity="model"),
+    ):
+        with pytest.raises(ValueError, match="another model"):
+            arena.lookup(TEXTS)
+    with open(path, "r+b") as f:
+        f.write(b"not an arena")
+    with pytest.raises(ValueError, match="not an A-VERT embedding arena"):
+        open_arena(path).lookup(TEXTS)
+
+    path = tmp_path / "arena-8"
+    arena = open_arena(path)
+    arena.add(TEXTS[:4], EMBEDDINGS[:4])
+    with pytest.raises(ValueError, match="dimensions"):
+        arena.add(TEXTS[4:], EMBEDDINGS[4:, :4])
+
+
+def test_full_arena_stops_growing(tmp_path, mock_server, caplog):
+    path = tmp_path / "arena"
+    arena = open_arena(path, capacity=4)
+    with caplog.at_level(logging.WARNING):
+        arena.add(TEXTS[:6], EMBEDDINGS[:6])
+        arena.add(TEXTS[6:], EMBEDDINGS[6:])
+    assert len(arena) == 4
+    np.testing.assert_array_equal(arena.lookup(TEXTS), [0, 1, 2, 3] + [-1] * 4)
+    assert sum("Embedding arena full" in r.getMessage() for r in caplog.records) == 1
+
+    # The texts that do not fit are embedded on every call
+    exact = embedding_tools.calculate_embedding_distances(
+        "response", TEXTS, mock_server.url, "tei"
+    )
+    requests = mock_server.metrics["texts"]
+    stored = embedding_tools.calculate_embedding_distances(
+        "response",
+        TEXTS,
+        mock_server.url,
+        "tei",
+        embedding_store=arena,
+        rescore_top_k=1,
+    )
+    # The response, the texts missing from the arena and the best stored one
+    assert mock_server.metrics["texts"] - requests == 1 + 4 + 1
+    assert np.argmax(stored) == np.argmax(exact)
+    assert len(arena) == 4
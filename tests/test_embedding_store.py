@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+from a_vert import embedding_store, embedding_tools, processing
+
+CANDIDATES = dict(
+    correct=["Paris", "The answer is Paris", "It is Paris"],
+    wrong=["London", "Rome", "Berlin", "Madrid", "Lisbon", "Vienna"],
+    refusal=["I cannot answer", "I do not know"],
+)
+RESPONSES = ["The capital is Paris", "Maybe Rome", "No idea", "London, I think"]
+
+
+@pytest.fixture(autouse=True)
+def reset_stores():
+    yield
+    embedding_store._EMBEDDING_STORES.clear()
+
+
+def test_store_decisions_match_exact_scores(avert_setup):
+    exact_config = avert_setup()
+    store_config = avert_setup(EMBEDDING_STORE="int8", RESCORE_TOP_K=2)
+    for response in RESPONSES:
+        exact, _ = processing.get_candidate_groups_embedings_ranking(
+            response, CANDIDATES, exact_config
+        )
+        # The second call scores the stored candidates
+        for _ in range(2):
+            stored, _ = processing.get_candidate_groups_embedings_ranking(
+                response, CANDIDATES, store_config
+            )
+        assert max(stored, key=stored.get) == max(exact, key=exact.get)
+        np.testing.assert_allclose(
+            [stored[group] for group in CANDIDATES],
+            [exact[group] for group in CANDIDATES],
+            atol=1e-5,
+        )
+
+
+def test_store_group_scores_are_exact(avert_setup, mock_server):
+    exact_config = avert_setup()
+    store_config = avert_setup(EMBEDDING_STORE="int8", RESCORE_TOP_K=1)
+    for response in RESPONSES:
+        exact, _ = processing.get_candidate_groups_embedings_ranking(
+            response, CANDIDATES, exact_config
+        )
+        for _ in range(2):
+            stored, _ = processing.get_candidate_groups_embedings_ranking(
+                response, CANDIDATES, store_config
+            )
+        assert max(stored, key=stored.get) == max(exact, key=exact.get)
+        np.testing.assert_allclose(
+            [stored[group] for group in CANDIDATES],
+            [exact[group] for group in CANDIDATES],
+            atol=1e-6,
+        )
+
+    # Binary scores are too coarse for the best approximate candidate to be
+    # the best one, but the best score of every group is still exact
+    candidates = [text for texts in CANDIDATES.values() for text in texts]
+    groups = [(0, 3), (3, 9), (9, 11)]
+    store = embedding_store.QuantizedEmbeddingStore("binary")
+    for response in RESPONSES + ["a", "bb", "ccc ddd"]:
+        exact = embedding_tools.calculate_embedding_distances(
+            response, candidates, mock_server.url, "tei"
+        )
+        for _ in range(2):
+            stored = embedding_tools.calculate_embedding_distances(
+                response,
+                candidates,
+                mock_server.url,
+                "tei",
+                embedding_store=store,
+                groups=groups,
+                rescore_top_k=0,
+            )
+        for start, end in groups:
+            best = start + np.argmax(stored[start:end])
+            np.testing.assert_allclose(stored[best], exact[best], atol=1e-6)
+
+
+@pytest.mark.parametrize("grouping", ["mean", "mean_top_k_2"])
+def test_store_rejects_averaging_groupings(avert_setup, grouping):
+    with pytest.raises(ValueError, match="AVERT_GROUPING"):
+        avert_setup(EMBEDDING_STORE="int8", GROUPING=grouping)
+
+    config = avert_setup(EMBEDDING_STORE="int8", GROUPING="max")
+    config.grouping = grouping
+    with pytest.raises(ValueError, match="grouping"):
+        processing.get_candidate_groups_embedings_ranking(
+            RESPONSES[0], CANDIDATES, config
+        )
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from a_vert import embedding_tools
+from a_vert.mock_server import MockServer, mock_embedding
+
+TEXTS = [f"text {idx}" for idx in range(6)]
+
+
+def test_tei_limits_are_discovered(mock_server):
+    mock_server.max_batch_size = 3
+    mock_server.max_batch_tokens = 100
+    limits = embedding_tools.discover_endpoint_limits(mock_server.url, "tei")
+    assert limits == dict(max_batch_size=3, max_batch_tokens=100, max_input_length=512)
+
+    embeddings = embedding_tools.get_embedding(
+        TEXTS, mock_server.url, "tei", max_batch_size=32, endpoint_limits=limits
+    )
+    np.testing.assert_allclose(
+        embeddings, np.stack([mock_embedding(text, 8) for text in TEXTS]), rtol=1e-6
+    )
+    # Sized to the limits, nothing rejected
+    assert mock_server.metrics["status"] == {200: 2}
+
+
+def test_vllm_limits_are_discovered_for_the_model(mock_server):
+    mock_server.max_input_length = 128
+    limits = embedding_tools.discover_endpoint_limits(
+        mock_server.url, "vllm", model_name="avert-model"
+    )
+    assert limits == dict(max_input_length=128)
+    assert (
+        embedding_tools.discover_endpoint_limits(
+            mock_server.url, "vllm", model_name="other-model"
+        )
+        == {}
+    )
+
+
+def test_smallest_replica_limits_are_used():
+    with (
+        MockServer(dim=8, max_batch_size=8, max_input_length=256) as first,
+        MockServer(dim=8, max_batch_size=4, max_input_length=512) as second,
+    ):
+        limits = embedding_tools.discover_endpoint_limits(
+            f"{first.url},{second.url}", "tei"
+        )
+    assert limits["max_batch_size"] == 4
+    assert limits["max_input_length"] == 256
+
+
+def test_unreachable_endpoint_has_no_limits():
+    assert embedding_tools.discover_endpoint_limits("http://127.0.0.1:1", "tei") == {}
+    assert embedding_tools.discover_endpoint_limits("model", "local") == {}
+
+
+@pytest.mark.parametrize("batch_size, expected", [(None, 3), ("16", 16)])
+def test_discovered_batch_size_overrides_the_default(
+    mock_server, avert_setup, batch_size, expected
+):
+    mock_server.max_batch_size = 3
+    env = dict(DISCOVER_LIMITS="true")
+    if batch_size is not None:
+        env["BATCH_SIZE"] = batch_size
+    config = avert_setup(**env)
+    assert config.endpoint_limits["max_batch_size"] == 3
+    # A batch size set by the user is kept, requests are still clipped
+    assert config.batch_size == expected
+    max_batch_size, _, _ = embedding_tools._apply_endpoint_limits(
+        config.batch_size, -1, None, config.endpoint_limits
+    )
+    assert max_batch_size == 3
+
+
+def test_limits_are_not_discovered_by_default(avert_setup):
+    config = avert_setup()
+    assert config.endpoint_limits == {}
+    assert config.batch_size == 32
@@ -0,0 +1,41 @@
+import logging
+
+import numpy as np
+
+from a_vert import embedding_tools
+from a_vert.mock_server import MockServer
+
+TEXTS = [f"text {idx}" for idx in range(6)]
+
+
+def embed(url, **kwargs):
+    return embedding_tools.get_embedding(
+        TEXTS, url, "vllm", model_name="m", max_batch_size=2, dimensions=4, **kwargs
+    )
+
+
+def test_unsupported_options_fall_back_quietly(caplog):
+    with MockServer(dim=8) as server:
+        expected = embed(server.url)
+    caplog.set_level(logging.DEBUG)
+    with MockServer(dim=8, support_base64=False, support_dimensions=False) as server:
+        for _ in range(2):
+            np.testing.assert_allclose(
+                embed(server.url, encoding_format="base64"), expected, rtol=1e-6
+            )
+    assert not [r for r in caplog.records if r.levelno >= logging.ERROR]
+    warnings = [r.getMessage() for r in caplog.records if r.levelno == logging.WARNING]
+    assert sum("base64" in message for message in warnings) == 1
+    assert sum("reduced dimensions" in message for message in warnings) == 1
+    assert "failures" not in embedding_tools.get_endpoint_stats()
+
+
+def test_floats_are_the_default_encoding(avert_setup):
+    assert avert_setup().embedding_encoding == "float"
+    with MockServer(dim=8) as server:
+        expected = embed(server.url, encoding_format="base64")
+    with MockServer(dim=8, support_base64=False) as server:
+        embeddings = embed(server.url)
+        # No rejected base64 request to fall back from
+        assert server.metrics["status"] == {200: 3}
+    np.testing.assert_allclose(embeddings, expected, rtol=1e-6)
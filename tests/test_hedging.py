@@ -0,0 +1,73 @@
+import asyncio
+import time
+
+import pytest
+
+from a_vert import embedding_tools
+
+TEXTS = ["text 0", "text 1"]
+
+
+def slow_endpoint(mock_server):
+    """Make every call slower than the recent latencies, so that it is hedged."""
+    mock_server.latency = 0.1
+    pool = embedding_tools._get_replica_pool(mock_server.url)
+    pool.latencies.extend([0.001] * embedding_tools._HEDGE_MIN_OBSERVATIONS)
+    return pool
+
+
+def embed(mock_server, limit):
+    limiter = embedding_tools._get_concurrency_limiter(
+        embedding_tools._get_replica_pool(mock_server.url).key, 4
+    )
+    limiter.limit = limit
+    embedding_tools.get_embedding(
+        TEXTS,
+        mock_server.url,
+        "tei",
+        max_concurrency=4,
+        adaptive_concurrency=True,
+        hedge_percentile=50,
+    )
+    # Let the losing call complete
+    time.sleep(0.2)
+    return limiter
+
+
+def test_hedge_takes_a_limiter_slot(mock_server):
+    slow_endpoint(mock_server)
+    limiter = embed(mock_server, 4.0)
+    stats = embedding_tools.get_endpoint_stats()
+    assert stats["hedged_requests"] == 1
+    assert mock_server.metrics["requests"] == 2
+    assert limiter.in_flight == 0
+
+
+def test_hedge_skipped_without_free_slot(mock_server):
+    slow_endpoint(mock_server)
+    limiter = embed(mock_server, 1.0)
+    stats = embedding_tools.get_endpoint_stats()
+    assert stats["hedges_skipped"] == 1
+    assert "hedged_requests" not in stats
+    assert mock_server.metrics["requests"] == 1
+    assert limiter.in_flight == 0
+
+
+@pytest.mark.parametrize("max_concurrency, requests", [(1, 1), (2, 2)])
+def test_async_hedge_within_the_semaphore(mock_server, max_concurrency, requests):
+    pytest.importorskip("aiohttp")
+    slow_endpoint(mock_server)
+
+    async def main():
+        await embedding_tools.aget_embedding(
+            "text",
+            mock_server.url,
+            "tei",
+            max_concurrency=max_concurrency,
+            hedge_percentile=50,
+        )
+        await asyncio.sleep(0.2)
+        await embedding_tools.aclose_sessions()
+
+    asyncio.run(main())
+    assert mock_server.metrics["requests"] == requests
@@ -0,0 +1,99 @@
+import asyncio
+import importlib.util
+
+import numpy as np
+import pytest
+
+from a_vert import embedding_tools, local_backend
+from a_vert.mock_server import mock_embedding, mock_score
+
+TEXTS = [f"text {idx}" for idx in range(5)]
+
+
+class FakeEmbeddingModel:
+    """Stands for a SentenceTransformer, records the batches it encodes."""
+
+    def __init__(self):
+        self.batches = list()
+
+    def encode(self, texts, batch_size, convert_to_numpy, show_progress_bar):
+        self.batches.append(list(texts))
+        return np.stack([mock_embedding(text, 8) for text in texts]).astype(np.float64)
+
+
+class FakeCrossEncoder:
+    def predict(self, pairs, batch_size, convert_to_numpy, show_progress_bar):
+        return np.array([mock_score(query, text, 8) for query, text in pairs])
+
+
+@pytest.fixture
+def local_models(monkeypatch):
+    embedding_model = FakeEmbeddingModel()
+    monkeypatch.setitem(
+        local_backend._LOCAL_MODELS,
+        ("model", "embedding", "torch", -1),
+        embedding_model,
+    )
+    monkeypatch.setitem(
+        local_backend._LOCAL_MODELS,
+        ("model", "rerank", "torch", -1),
+        FakeCrossEncoder(),
+    )
+    return embedding_model
+
+
+def test_local_calls_are_batched(local_models):
+    embeddings = embedding_tools.get_embedding(
+        TEXTS, "model", "local", max_batch_size=2, max_concurrency=2, dimensions=4
+    )
+    assert embeddings.dtype == np.float32
+    expected = np.stack([mock_embedding(text, 8)[:4] for text in TEXTS])
+    expected /= np.linalg.norm(expected, axis=1, keepdims=True)
+    np.testing.assert_allclose(embeddings, expected, rtol=1e-6)
+    assert sorted(map(len, local_models.batches)) == [1, 2, 2]
+
+    scores = embedding_tools.get_rerank(
+        "question", TEXTS, "model", "local", max_batch_size=3
+    )
+    np.testing.assert_allclose(
+        scores, [mock_score("question", text, 8) for text in TEXTS], rtol=1e-6
+    )
+
+
+def test_local_calls_run_off_the_event_loop(local_models):
+    async def main():
+        return await embedding_tools.aget_embedding(
+            TEXTS, "model", "local", max_batch_size=2
+        ), await embedding_tools.aget_rerank("question", TEXTS, "model", "local")
+
+    embeddings, scores = asyncio.run(main())
+    np.testing.assert_allclose(
+        embeddings, np.stack([mock_embedding(text, 8) for text in TEXTS]), rtol=1e-6
+    )
+    np.testing.assert_allclose(
+        scores, [mock_score("question", text, 8) for text in TEXTS], rtol=1e-6
+    )
+
+
+def test_unknown_backend_is_rejected():
+    with pytest.raises(ValueError, match="Unknown local backend"):
+        local_backend.get_local_model("model", "embedding", backend="tensorrt")
+
+
+@pytest.mark.skipif(
+    importlib.util.find_spec("sentence_transformers") is not None,
+    reason="sentence-transformers is installed",
+)
+def test_missing_dependency_is_reported():
+    with pytest.raises(ImportError, match=r"a-vert\[local\]"):
+        local_backend.get_local_model("model", "embedding")
+
+
+def test_sentence_transformers_models():
+    pytest.importorskip("sentence_transformers")
+    model = "sentence-transformers/all-MiniLM-L6-v2"
+    embeddings = embedding_tools.get_embedding(TEXTS, model, "local", max_batch_size=2)
+    assert embeddings.shape == (len(TEXTS), 384)
+    np.testing.assert_allclose(np.linalg.norm(embeddings, axis=1), 1.0, rtol=1e-4)
+    # Loaded once
+    assert sum(key[0] == model for key in local_backend._LOCAL_MODELS) == 1
@@ -0,0 +1,118 @@
+import threading
+
+import numpy as np
+import pytest
+import requests
+
+from a_vert.mock_server import MockServer, mock_embedding, mock_score
+
+TEXTS = ["first text", "second text", "third text"]
+
+
+def post(server, path, payload):
+    return requests.post(server.url + path, json=payload, timeout=10)
+
+
+def test_mock_embeddings_are_deterministic():
+    embedding = mock_embedding("text", 16)
+    np.testing.assert_array_equal(embedding, mock_embedding("text", 16))
+    assert np.linalg.norm(embedding) == pytest.approx(1.0)
+    assert mock_score("query", "text", 16) == mock_score("query", "text", 16)
+    assert mock_score("query", "text", 16) != mock_score("query", "other", 16)
+
+
+def test_tei_routes(mock_server):
+    response = post(mock_server, "/embed", {"inputs": TEXTS})
+    assert response.status_code == 200
+    np.testing.assert_allclose(
+        response.json(), [mock_embedding(text, 8) for text in TEXTS], rtol=1e-6
+    )
+    results = post(
+        mock_server, "/rerank", {"query": "q", "texts": TEXTS, "return_text": True}
+    ).json()
+    # Sorted by score, as TEI does
+    scores = [result["score"] for result in results]
+    assert scores == sorted(scores, reverse=True)
+    for result in results:
+        assert result["text"] == TEXTS[result["index"]]
+        assert result["score"] == pytest.approx(mock_score("q", result["text"], 8))
+    info = requests.get(mock_server.url + "/info", timeout=10).json()
+    assert info["max_input_length"] == 512
+
+
+def test_vllm_routes(mock_server):
+    body = post(
+        mock_server, "/v1/embeddings", {"input": TEXTS, "model": "m", "dimensions": 4}
+    ).json()
+    assert [len(item["embedding"]) for item in body["data"]] == [4, 4, 4]
+    assert body["usage"]["prompt_tokens"] > 0
+
+    body = post(
+        mock_server,
+        "/v1/rerank",
+        {"query": "q", "documents": TEXTS, "model": "m", "top_n": 2},
+    ).json()
+    assert len(body["results"]) == 2
+    assert body["results"][0]["document"]["text"] == TEXTS[body["results"][0]["index"]]
+
+    for text_1 in ("q", ["q", "q", "q"]):
+        body = post(
+            mock_server, "/v1/score", {"text_1": text_1, "text_2": TEXTS, "model": "m"}
+        ).json()
+        assert [item["score"] for item in body["data"]] == pytest.approx(
+            [mock_score("q", text, 8) for text in TEXTS]
+        )
+    models = requests.get(mock_server.url + "/v1/models", timeout=10).json()
+    assert models["data"][0]["id"] == "avert-model"
+
+
+def test_bad_requests(mock_server):
+    assert post(mock_server, "/unknown", {"inputs": TEXTS}).status_code == 404
+    assert requests.get(mock_server.url + "/unknown", timeout=10).status_code == 404
+    response = requests.post(mock_server.url + "/embed", data=b"{", timeout=10)
+    assert response.status_code == 400
+    assert requests.get(mock_server.url + "/health", timeout=10).status_code == 200
+    metrics = requests.get(mock_server.url + "/metrics", timeout=10).json()
+    assert metrics == {"requests": 1, "texts": 3, "status": {"404": 1}}
+
+
+def test_injected_errors():
+    with MockServer(
+        dim=8, error_rate=1.0, error_status=(429,), retry_after=2
+    ) as server:
+        response = post(server, "/embed", {"inputs": TEXTS})
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "2"
+    with MockServer(dim=8, max_batch_tokens=10) as server:
+        response = post(server, "/embed", {"inputs": TEXTS})
+        assert response.status_code == 413
+        assert "tokens" in response.json()["error"]
+        assert post(server, "/embed", {"inputs": TEXTS[:1]}).status_code == 200
+    with pytest.raises(ValueError, match="Unknown latency distribution"):
+        MockServer(latency_dist="uniform")
+
+
+def test_requests_above_max_in_flight_are_rejected():
+    with MockServer(dim=8, latency=0.3, max_in_flight=1) as server:
+        statuses = list()
+
+        def call():
+            statuses.append(post(server, "/embed", {"inputs": TEXTS}).status_code)
+
+        threads = [threading.Thread(target=call) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert sorted(statuses) == [200, 503, 503]
+
+
+def test_errors_follow_the_seed():
+    def statuses(seed):
+        with MockServer(dim=8, error_rate=0.5, seed=seed) as server:
+            return [
+                post(server, "/embed", {"inputs": TEXTS}).status_code for _ in range(20)
+            ]
+
+    assert statuses(1) == statuses(1)
+    assert set(statuses(1)) == {200, 503}
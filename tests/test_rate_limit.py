@@ -0,0 +1,84 @@
+import multiprocessing
+import time
+
+import pytest
+
+from a_vert import embedding_tools
+
+pytest.importorskip("fcntl")
+
+HOST = "http://127.0.0.1:1"
+
+
+def reserve(rate_limit_dir, queue, requests_per_second=1.0):
+    limiter = embedding_tools._RateLimiter(
+        HOST, requests_per_second=requests_per_second, rate_limit_dir=rate_limit_dir
+    )
+    queue.put(limiter.reserve())
+
+
+def acquire_many(rate_limit_dir, n_requests, queue):
+    limiter = embedding_tools._RateLimiter(
+        HOST, requests_per_second=20.0, rate_limit_dir=rate_limit_dir
+    )
+    times = list()
+    for _ in range(n_requests):
+        limiter.acquire()
+        times.append(time.time())
+    queue.put(times)
+
+
+def run(target, *args):
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=target, args=args + (queue,))
+    process.start()
+    result = queue.get(timeout=30)
+    process.join(30)
+    assert process.exitcode == 0
+    return result
+
+
+def test_processes_draw_from_the_same_bucket(tmp_path):
+    limiter = embedding_tools._RateLimiter(
+        HOST, requests_per_second=1.0, rate_limit_dir=str(tmp_path)
+    )
+    # The first request is free, the others put the bucket 4 seconds in debt
+    delays = [limiter.reserve() for _ in range(5)]
+    assert delays[0] == 0.0
+    assert delays[-1] == pytest.approx(4.0, abs=0.1)
+    # Another process waits for the debt, less the time it took to start
+    assert 2.0 < run(reserve, str(tmp_path)) <= 5.0
+    # Other directories hold other buckets
+    (tmp_path / "other").mkdir()
+    assert run(reserve, str(tmp_path / "other")) == 0.0
+
+
+def test_texts_per_second_lets_large_requests_through(tmp_path):
+    limiter = embedding_tools._RateLimiter(
+        HOST, texts_per_second=10.0, rate_limit_dir=str(tmp_path)
+    )
+    # Larger than the bucket, sent right away
+    assert limiter.reserve(50) == 0.0
+    assert limiter.reserve(10) == pytest.approx(1.0, abs=0.1)
+    assert embedding_tools.get_endpoint_stats()["rate_limited"] == 1
+
+
+def test_concurrent_processes_are_paced(tmp_path):
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    processes = [
+        context.Process(target=acquire_many, args=(str(tmp_path), 10, queue))
+        for _ in range(4)
+    ]
+    for process in processes:
+        process.start()
+    times = sorted(sum((queue.get(timeout=60) for _ in processes), []))
+    for process in processes:
+        process.join(30)
+        assert process.exitcode == 0
+    # Up to a second of requests at once, 20 per second afterwards
+    for first in range(len(times)):
+        for last in range(first + 1, len(times)):
+            sent = last - first + 1
+            assert sent <= 20 + 20 * (times[last] - times[first]) + 1
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import threading
+
+import numpy as np
+import pytest
+
+from a_vert import embedding_tools, processing, recording
+from a_vert.mock_server import MockServer
+
+TEXTS = [f"text {idx}" for idx in range(6)]
+
+
+def test_replay_without_server(tmp_path):
+    path = str(tmp_path / "recording.bin")
+    with MockServer(dim=8) as server:
+        url = server.url
+        recorded = embedding_tools.get_embedding(
+            TEXTS, url, "tei", max_batch_size=2, record_mode="record", record_path=path
+        )
+    replayed = embedding_tools.get_embedding(
+        TEXTS, url, "tei", max_batch_size=2, record_mode="replay", record_path=path
+    )
+    np.testing.assert_array_equal(replayed, recorded)
+
+
+def test_async_recording_runs_off_the_loop(tmp_path, monkeypatch):
+    pytest.importorskip("aiohttp")
+    path = str(tmp_path / "recording.bin")
+    threads = list()
+    for name in ("record", "replay"):
+        method = getattr(recording.RequestRecording, name)
+
+        def wrapper(self, *args, method=method):
+            threads.append(threading.current_thread())
+            return method(self, *args)
+
+        monkeypatch.setattr(recording.RequestRecording, name, wrapper)
+
+    async def embed(url, record_mode):
+        embeddings = await embedding_tools.aget_embedding(
+            TEXTS,
+            url,
+            "tei",
+            max_batch_size=2,
+            record_mode=record_mode,
+            record_path=path,
+        )
+        await embedding_tools.aclose_sessions()
+        return embeddings
+
+    with MockServer(dim=8) as server:
+        url = server.url
+        recorded = asyncio.run(embed(url, "record"))
+    replayed = asyncio.run(embed(url, "replay"))
+    np.testing.assert_array_equal(replayed, recorded)
+    assert len(threads) == 6
+    assert threading.main_thread() not in threads
+
+
+def test_full_run_is_replayed_anywhere(tmp_path, avert_setup, mock_server):
+    path = str(tmp_path / "recording.bin")
+    groups = {"correct": ["Paris"], "wrong": ["London", "Rome"]}
+    config = avert_setup(RECORD_MODE="record", RECORD_PATH=path)
+    recorded = processing.get_candidate_groups_embedings_ranking(
+        "Paris", groups, config
+    )
+    requests = mock_server.metrics["requests"]
+    # The host is not part of the request key
+    config = avert_setup(
+        RECORD_MODE="replay", RECORD_PATH=path, MODEL_ENDPOINT="http://127.0.0.1:1"
+    )
+    replayed = processing.get_candidate_groups_embedings_ranking(
+        "Paris", groups, config
+    )
+    assert replayed[0] == recorded[0]
+    np.testing.assert_array_equal(replayed[1], recorded[1])
+    assert mock_server.metrics["requests"] == requests
+    assert embedding_tools.get_endpoint_stats()["replayed"] == requests
+
+    with pytest.raises(ValueError, match="not found in the recording"):
+        processing.get_candidate_groups_embedings_ranking("Rome", groups, config)
+
+
+def test_rejections_are_replayed(tmp_path, mock_server):
+    path = str(tmp_path / "recording.bin")
+    mock_server.error_rate = 1.0
+    mock_server.error_status = (400,)
+    for record_mode in ("record", "replay"):
+        with pytest.raises(embedding_tools.EndpointError) as exc_info:
+            embedding_tools.get_embedding(
+                TEXTS, mock_server.url, "tei", record_mode=record_mode, record_path=path
+            )
+        assert exc_info.value.status_code == 400
+    assert mock_server.metrics["requests"] == 1
+
+
+def test_request_key_ignores_host_and_key_order():
+    key = recording.request_key("http://a:1/embed", {"inputs": ["x"], "truncate": True})
+    assert key == recording.request_key(
+        "http://b:2/embed", {"truncate": True, "inputs": ["x"]}
+    )
+    assert key != recording.request_key("http://a:1/rerank", {"inputs": ["x"]})
+
+
+def test_incomplete_records_are_dropped(tmp_path, caplog):
+    path = tmp_path / "recording.bin"
+    first = recording.RequestRecording(str(path))
+    first.record("/embed", {"inputs": "a"}, 200, b"[[1.0]]")
+    first.record("/embed", {"inputs": "b"}, 200, b"[[2.0]]")
+    size = path.stat().st_size
+    # An interrupted run left half a record
+    with open(path, "r+b") as f:
+        f.truncate(size - 3)
+    with caplog.at_level(logging.WARNING):
+        second = recording.RequestRecording(str(path))
+    assert "incomplete record" in caplog.records[0].getMessage()
+    assert len(second) == 1
+    assert second.replay("/embed", {"inputs": "a"}) == (200, b"[[1.0]]")
+    second.record("/embed", {"inputs": "b"}, 200, b"[[2.0]]")
+    assert len(recording.RequestRecording(str(path))) == 2
+    assert path.stat().st_size == size
+
+    path.write_bytes(b"not a recording")
+    with pytest.raises(ValueError, match="not an A-VERT recording"):
+        recording.RequestRecording(str(path))
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from a_vert import embedding_tools
+from a_vert.mock_server import MockServer, mock_embedding
+
+TEXTS = [f"text {idx}" for idx in range(8)]
+EXPECTED = np.stack([mock_embedding(text, 8) for text in TEXTS])
+
+
+@pytest.fixture
+def replicas():
+    with MockServer(dim=8) as first, MockServer(dim=8) as second:
+        yield first, second
+
+
+def embed(endpoint, **kwargs):
+    return embedding_tools.get_embedding(
+        TEXTS, endpoint, "tei", max_batch_size=1, **kwargs
+    )
+
+
+def open_circuit(server):
+    breaker = embedding_tools._get_circuit_breaker(server.url, 1, 60.0)
+    breaker.record_failure()
+    return breaker
+
+
+def test_calls_go_to_the_least_loaded_replica(replicas):
+    for server in replicas:
+        server.latency = 0.05
+    endpoint = ",".join(server.url for server in replicas)
+    embeddings = embed(endpoint, max_concurrency=2)
+    np.testing.assert_allclose(embeddings, EXPECTED, rtol=1e-6)
+    assert [server.metrics["requests"] for server in replicas] == [4, 4]
+    stats = embedding_tools._get_replica_pool(endpoint).stats()
+    assert [replica["requests"] for replica in stats.values()] == [4, 4]
+    assert all(replica["outstanding"] == 0 for replica in stats.values())
+
+
+def test_replicas_with_open_circuit_are_skipped(replicas):
+    first, second = replicas
+    open_circuit(first)
+    endpoint = [first.url, second.url]
+    np.testing.assert_allclose(embed(endpoint), EXPECTED, rtol=1e-6)
+    assert first.metrics["requests"] == 0
+    assert second.metrics["requests"] == len(TEXTS)
+    stats = embedding_tools._get_replica_pool(endpoint).stats()
+    assert stats[first.url]["available"] is False
+
+
+def test_open_circuit_fails_over_to_another_replica(replicas, monkeypatch):
+    first, second = replicas
+    open_circuit(first)
+    pool = embedding_tools._get_replica_pool([first.url, second.url])
+    # The circuit opens between the routing decision and the request
+    monkeypatch.setattr(pool, "is_available", lambda replica: True)
+    embedding_tools.get_embedding("text", pool.replicas, "tei")
+    assert embedding_tools.get_endpoint_stats()["replica_failovers"] == 1
+    assert (first.metrics["requests"], second.metrics["requests"]) == (0, 1)
+
+    open_circuit(second)
+    with pytest.raises(embedding_tools.CircuitOpenError):
+        embedding_tools.get_embedding("text", pool.replicas, "tei")
+
+
+def test_healthy_replicas_are_put_back_in_rotation(replicas):
+    first, second = replicas
+    breaker = open_circuit(first)
+    endpoint = [first.url, second.url]
+    embedding_tools.get_embedding("text", endpoint, "tei")
+    assert first.metrics["requests"] == 0
+    # The next call probes `/health` of the replica out of rotation
+    embedding_tools.get_embedding("text", endpoint, "tei", health_check_interval=0)
+    assert breaker.state == "closed"
+    assert first.metrics["requests"] == 1
@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+from a_vert import embedding_tools
+from a_vert.mock_server import mock_score
+
+TARGETS = [f"answer {idx}" for idx in range(7)]
+
+
+@pytest.mark.parametrize("endpoint_type", ["tei", "vllm"])
+def test_scores_in_target_order(mock_server, endpoint_type):
+    scores = embedding_tools.get_rerank(
+        "question",
+        TARGETS,
+        mock_server.url,
+        endpoint_type,
+        model_name="m",
+        max_batch_size=4,
+        dtype="float64",
+    )
+    assert scores.dtype == np.float64
+    np.testing.assert_allclose(
+        scores, [mock_score("question", target, 8) for target in TARGETS]
+    )
+
+
+def test_invalid_indexes_are_rejected():
+    results = [{"index": 0, "score": 0.5}, {"index": 0, "score": 0.2}]
+    with pytest.raises(ValueError, match="indexes"):
+        embedding_tools._parse_rerank_results(results, "q", ["a", "b"], results)
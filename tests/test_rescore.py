@@ -0,0 +1,131 @@
+import concurrent.futures
+import json
+import os
+
+import numpy as np
+import pytest
+
+from a_vert import processing, rescore
+
+UTILS = """
+import os
+
+
+def process_results(doc, results):
+    if os.path.exists(doc.get("fail_if", "")):
+        raise ValueError("endpoint down")
+    return {"acc": float(results[0] == doc["answer"])}
+"""
+
+
+@pytest.fixture
+def task(tmp_path):
+    utils_path = tmp_path / "utils.py"
+    utils_path.write_text(UTILS)
+    samples_path = tmp_path / "samples_demo_2025-01-01T00-00-00.000000.jsonl"
+    marker = tmp_path / "down"
+
+    def add_samples(answers, fail=()):
+        with open(samples_path, "a") as f:
+            for idx, answer in enumerate(answers):
+                doc = {"answer": "A", "fail_if": str(marker) if idx in fail else ""}
+                sample = {"doc_id": idx, "doc": doc, "filtered_resps": [answer]}
+                f.write(json.dumps(sample) + "\n")
+
+    return str(utils_path), str(samples_path), marker, add_samples
+
+
+def read_rows(output_dir):
+    rows = list()
+    for name in sorted(os.listdir(output_dir)):
+        if name.startswith("part-"):
+            with open(os.path.join(output_dir, name)) as f:
+                rows += [json.loads(line) for line in f]
+    return rows
+
+
+def run(utils_path, samples_path, output_dir, **kwargs):
+    return rescore.rescore(
+        [samples_path], utils_path, output_dir, output_format="jsonl", **kwargs
+    )
+
+
+def test_failed_samples_are_recorded_and_skipped(task, tmp_path):
+    utils_path, samples_path, marker, add_samples = task
+    output_dir = str(tmp_path / "out")
+    marker.touch()
+    add_samples(["A", "B", "A", "A", "C"], fail=(2,))
+
+    assert run(utils_path, samples_path, output_dir, chunk_size=2) == 5
+    rows = read_rows(output_dir)
+    assert [row["line"] for row in rows] == [0, 1, 2, 3, 4]
+    assert rows[2]["error"] == "ValueError: endpoint down"
+    assert "acc" not in rows[2]
+    assert [row["acc"] for row in rows if row["error"] is None] == [1, 0, 1, 0]
+
+    # Resuming skips the done and failed samples, and scores the new ones
+    add_samples(["A"])
+    assert run(utils_path, samples_path, output_dir, chunk_size=2) == 1
+    assert read_rows(output_dir)[-1]["line"] == 5
+
+    # Still failing: the sample stays in the checkpoint
+    assert run(utils_path, samples_path, output_dir, retry_errors=True) == 1
+    assert read_rows(output_dir)[-1]["error"] is not None
+
+    marker.unlink()
+    assert run(utils_path, samples_path, output_dir, retry_errors=True) == 1
+    last = read_rows(output_dir)[-1]
+    assert (last["line"], last["error"], last["acc"]) == (2, None, 1.0)
+    assert run(utils_path, samples_path, output_dir, retry_errors=True) == 0
+
+
+def test_parquet_parts_keep_every_column(task, tmp_path):
+    pyarrow = pytest.importorskip("pyarrow")
+    parquet = pytest.importorskip("pyarrow.parquet")
+
+    utils_path, samples_path, marker, add_samples = task
+    output_dir = str(tmp_path / "out")
+    marker.touch()
+    # The first sample of the part fails
+    add_samples(["A", "B"], fail=(0,))
+    rescore.rescore([samples_path], utils_path, output_dir)
+    table = parquet.read_table(os.path.join(output_dir, "part-00000.parquet"))
+    assert table.schema.field("error").type == pyarrow.string()
+    assert table.column("acc").to_pylist() == [None, 0.0]
+
+
+def test_concurrent_rankings_are_batched(avert_setup, mock_server):
+    config = avert_setup()
+    responses = ["Paris", "Rome", "London, I think", "The capital is Paris"]
+    groups = {"correct": ["Paris"], "wrong": ["London", "Rome"]}
+
+    def rank(response):
+        try:
+            return processing.get_candidate_groups_embedings_ranking(
+                response, groups, config
+            )
+        except ValueError as exc:
+            return exc
+
+    def rank_concurrently(responses):
+        with (
+            concurrent.futures.ThreadPoolExecutor(len(responses)) as executor,
+            processing.batch_concurrent_rankings(max_wait=0.05),
+        ):
+            return list(executor.map(rank, responses))
+
+    expected = [rank(response) for response in responses]
+    requests = mock_server.metrics["requests"]
+    results = rank_concurrently(responses)
+    # The unique texts of all the rankings are embedded in a single request
+    assert mock_server.metrics["requests"] - requests == 1
+    for result, other in zip(results, expected):
+        assert result[0] == pytest.approx(other[0], abs=1e-6)
+        np.testing.assert_allclose(result[1], other[1], atol=1e-6)
+    assert processing._RANKING_BATCHER is None
+
+    # The empty response fails the batch, then fails on its own
+    results = rank_concurrently(responses[:2] + ["  "] + responses[2:])
+    assert str(results.pop(2)) == "model_response cannot be an empty string."
+    for result, other in zip(results, expected):
+        assert result[0] == pytest.approx(other[0], abs=1e-6)
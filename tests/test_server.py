@@ -0,0 +1,145 @@
+import numpy as np
+import pytest
+
+from a_vert import embedding_tools, processing, stream
+from a_vert.server import ScoringClient, ScoringServer, _EmbeddingCache
+
+RECORDS = [
+    dict(id=0, response="The capital is Paris", correct="Paris", wrong=["London"]),
+    dict(id=1, response="Maybe Rome", correct="Rome", wrong=["Paris", "Madrid"]),
+    dict(id=2, response="I do not know", correct="Berlin", wrong=["Vienna"]),
+    dict(id=3, response="London, I think", correct="Paris", wrong=["London"]),
+]
+
+
+@pytest.fixture
+def config(avert_setup):
+    return avert_setup()
+
+
+@pytest.fixture
+def client(config):
+    with ScoringServer(config, port=0, max_wait=0.05, workers=2) as server:
+        client = ScoringClient(server.url)
+        yield client
+        client.close()
+
+
+def expected_result(record, config):
+    return dict(
+        id=record["id"],
+        **stream.distribution_fields(stream.score_record(record, config)),
+    )
+
+
+def assert_same_results(results, expected):
+    assert len(results) == len(expected)
+    for result, other in zip(results, expected):
+        assert result.keys() == other.keys()
+        assert result["prediction"] == other["prediction"]
+        for group, score in other["distribution"].items():
+            assert result["distribution"][group] == pytest.approx(score, abs=1e-6)
+
+
+def test_batch_matches_per_record_scoring(client, config):
+    results = client.score_batch(RECORDS)
+    assert_same_results(results, [expected_result(r, config) for r in RECORDS])
+    service = client.stats()["service"]
+    assert service["records"] == len(RECORDS)
+    assert service["mean_batch_size"] > 1
+    assert service["fallbacks"] == 0
+
+    result = client.score(**{k: v for k, v in RECORDS[0].items() if k != "id"})
+    assert result["prediction"] == results[0]["prediction"]
+
+
+def test_bad_records_get_their_own_error(client, config):
+    records = list(RECORDS)
+    # Fails before scoring, the others are still batched
+    records.insert(1, dict(id="no wrong", response="Paris", correct="Paris"))
+    results = client.score_batch(records)
+    assert results[1] == {"id": "no wrong", "error": "KeyError: 'wrong'"}
+    del results[1]
+    assert_same_results(results, [expected_result(r, config) for r in RECORDS])
+    assert client.stats()["service"]["fallbacks"] == 0
+    with pytest.raises(ValueError, match="400"):
+        client.score("Paris", correct="Paris", wrong=None, groups=["unknown"])
+
+
+def test_failed_batch_falls_back_to_one_record_at_a_time(client, config):
+    records = list(RECORDS)
+    # Fails when the batch is scored
+    records.insert(2, dict(id="empty", response="  ", correct="Paris", wrong="Rome"))
+    results = client.score_batch(records)
+    assert results[2]["id"] == "empty"
+    assert results[2]["error"].startswith("ValueError: model_response cannot be")
+    del results[2]
+    assert_same_results(results, [expected_result(r, config) for r in RECORDS])
+    service = client.stats()["service"]
+    assert service["fallbacks"] == 1
+    assert service["errors"] == 1
+
+
+def test_batch_ranking_matches_single_ranking(config):
+    groups = [stream.record_groups(record, config) for record in RECORDS]
+    responses = [record["response"] for record in RECORDS]
+    batch = processing.get_candidate_groups_embedings_ranking_batch(
+        responses, groups, config
+    )
+    for response, record_groups, (distribution, distances) in zip(
+        responses, groups, batch
+    ):
+        expected, expected_distances = (
+            processing.get_candidate_groups_embedings_ranking(
+                response, record_groups, config
+            )
+        )
+        assert distribution == pytest.approx(expected, abs=1e-6)
+        np.testing.assert_allclose(distances, expected_distances, atol=1e-6)
+
+    config.avert_method = "rerank"
+    with pytest.raises(ValueError, match="embedding method"):
+        processing.get_candidate_groups_embedings_ranking_batch(
+            responses, groups, config
+        )
+
+
+def test_embedding_cache_skips_embedded_texts(mock_server):
+    responses = ["first response", "second response"]
+    batches = [["a", "b", "c"], ["b", "c", "d"]]
+    cache = _EmbeddingCache(100)
+    scores = embedding_tools.calculate_embedding_distances_batch(
+        responses, batches, mock_server.url, "tei", embedding_cache=cache
+    )
+    for response, batch, similarities in zip(responses, batches, scores):
+        np.testing.assert_allclose(
+            similarities,
+            embedding_tools.calculate_embedding_distances(
+                response, batch, mock_server.url, "tei"
+            ),
+            atol=1e-6,
+        )
+    # The shared candidates are embedded once
+    assert len(cache) == 6
+    texts = mock_server.metrics["texts"]
+    embedding_tools.calculate_embedding_distances_batch(
+        responses, batches, mock_server.url, "tei", embedding_cache=cache
+    )
+    assert mock_server.metrics["texts"] == texts
+    assert cache.stats() == dict(size=6, hits=6, misses=6)
+
+
+def test_embedding_cache_evicts_least_recently_used():
+    cache = _EmbeddingCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    # Updating a text also makes it the most recent
+    cache.put("a", 4)
+    cache.put("d", 5)
+    assert cache.get("c") is None
+    assert (cache.get("a"), cache.get("d")) == (4, 5)
+    assert cache.stats() == dict(size=2, hits=5, misses=2)
@@ -0,0 +1,70 @@
+import io
+import json
+
+import pytest
+
+from a_vert import stream
+
+RECORDS = [
+    {"id": 0, "response": "The answer is Paris", "correct": "Paris", "wrong": "Rome"},
+    {"id": 1, "response": "Rome", "correct": "Paris", "wrong": ["Rome", "Berlin"]},
+    {"id": 2, "response": "", "correct": "Paris", "wrong": "Rome"},
+    {"id": 3, "response": "Berlin", "correct": "Paris", "wrong": "Berlin"},
+]
+
+
+@pytest.fixture
+def config(avert_setup):
+    return avert_setup()
+
+
+def to_lines(records):
+    return "".join(json.dumps(record) + "\n" for record in records)
+
+
+def read_results(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_lines_are_scored(config):
+    output = io.StringIO()
+    lines = to_lines(RECORDS)
+    assert stream.score_stream(io.StringIO(lines), output, config, ordered=True) == 4
+    results = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [result["id"] for result in results] == [0, 1, 2, 3]
+    assert [result.get("prediction") for result in results] == [
+        "correct",
+        "wrong",
+        None,
+        "wrong",
+    ]
+    assert "error" in results[2]
+
+
+def test_resume(config, tmp_path):
+    path = str(tmp_path / "scores.jsonl")
+    lines = to_lines(RECORDS)
+    output = open(path, "w")
+    stream.score_stream(io.StringIO(to_lines(RECORDS[:2])), output, config)
+    output.close()
+    # Interrupted in the middle of a line
+    with open(path, "a") as f:
+        f.write('{"line": 3, "id"')
+
+    output, skip = stream.resume_output(path)
+    assert skip == {0, 1}
+    with output:
+        assert stream.score_stream(io.StringIO(lines), output, config, skip=skip) == 2
+    results = read_results(path)
+    assert sorted(result["line"] for result in results) == [0, 1, 2, 3]
+
+    # The failed line is only scored again on request
+    output, skip = stream.resume_output(path)
+    with output:
+        assert stream.score_stream(io.StringIO(lines), output, config, skip=skip) == 0
+    output, skip = stream.resume_output(path, retry_errors=True)
+    assert skip == {0, 1, 3}
+    with output:
+        assert stream.score_stream(io.StringIO(lines), output, config, skip=skip) == 1
+    assert read_results(path)[-1]["line"] == 2
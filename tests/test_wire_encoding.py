@@ -0,0 +1,59 @@
+import json
+
+import numpy as np
+import pytest
+
+from a_vert import embedding_tools
+from a_vert.mock_server import mock_embedding, mock_score
+
+TEXTS = ["plain text", "café, naïve", "答案是 42", 'quoted "text" \\ 🙂']
+
+
+@pytest.fixture(params=["orjson", "json"])
+def codec(request, monkeypatch):
+    if request.param == "orjson":
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr(embedding_tools, "orjson", None)
+    return request.param
+
+
+def test_payloads_round_trip(codec):
+    payload = {"inputs": TEXTS, "truncate": True, "dimensions": None}
+    body = embedding_tools._json_dumps(payload)
+    assert isinstance(body, bytes)
+    assert json.loads(body) == payload
+    assert embedding_tools._json_loads(body) == payload
+
+
+def test_responses_are_decoded_from_bytes(mock_server, codec):
+    embeddings = embedding_tools.get_embedding(
+        TEXTS, mock_server.url, "vllm", model_name="m"
+    )
+    np.testing.assert_allclose(
+        embeddings, np.stack([mock_embedding(text, 8) for text in TEXTS]), rtol=1e-6
+    )
+    stats = embedding_tools.get_endpoint_stats()
+    _, payload, _, _ = embedding_tools._vllm_embedding_request(TEXTS, "", "m")
+    assert stats["bytes_sent"] == len(embedding_tools._json_dumps(payload))
+    assert stats["bytes_received"] > 0
+
+
+@pytest.mark.parametrize("endpoint_type", ["tei", "vllm"])
+def test_rerank_responses_do_not_echo_the_targets(mock_server, endpoint_type):
+    long_target = "a long candidate answer " * 50
+    scores = embedding_tools.get_rerank(
+        "question",
+        [long_target, "short"],
+        mock_server.url,
+        endpoint_type,
+        model_name="m",
+    )
+    np.testing.assert_allclose(
+        scores,
+        [mock_score("question", text, 8) for text in (long_target, "short")],
+        rtol=1e-6,
+    )
+    # Only indexes and scores come back
+    stats = embedding_tools.get_endpoint_stats()
+    assert stats["bytes_received"] < len(long_target)